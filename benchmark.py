@@ -0,0 +1,659 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""截图工具的性能基准测试
+
+用法:
+    python benchmark.py probe      # 对比弹窗/登录页检测的协议调用次数
+    python benchmark.py pipeline   # 本地合成站点上的端到端吞吐量、延迟和内存基准
+"""
+
+import argparse
+import asyncio
+import contextlib
+import csv
+import inspect
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from playwright.async_api import async_playwright
+
+import screenshot_downloader_enhanced as sde
+
+# ---------------------------------------------------------------------------
+# 基线实现（逐元素往返），只用于对比，保持与改造前的代码一致
+# ---------------------------------------------------------------------------
+
+async def legacy_is_login_page(page):
+    """基线版本的登录页检测（逐项查询 + page.content()）"""
+    try:
+        # 检查URL是否包含登录相关字符串
+        current_url = page.url
+        if "login" in current_url.lower() or "sign-in" in current_url.lower():
+            return True
+        
+        # 检查页面是否包含登录表单元素
+        password_field = await page.query_selector("input[type='password']")
+        login_button = await page.query_selector("button:has-text('登录'), button:has-text('Login'), button:has-text('Sign in')")
+        
+        if password_field and login_button:
+            return True
+        
+        # 检查页面内容是否包含登录相关文本
+        content = await page.content()
+        login_terms = ["登录", "login", "sign in", "signin"]
+        if any(term in content.lower() for term in login_terms):
+            return True
+            
+        return False
+    except Exception as e:
+        print(f"检查登录页面时出错: {e}")
+        return False
+async def legacy_close_popups(page):
+    """基线版本的弹窗关闭（每个选择器、每个元素都单独往返）"""
+    try:
+        # 1. 首先尝试点击右上角的叉叉按钮(通常是关闭弹窗的最常见方式)
+        close_x_selectors = [
+            "button.close", 
+            ".close",
+            ".modal-close",
+            "button[aria-label='Close']",
+            ".dialog-close-button",
+            "[data-testid='close-button']",
+            ".modal .close",
+            ".dialog .close",
+            ".popup .close",
+            "button.modal-close",
+            "button.dialog-close",
+            "button.popup-close"
+        ]
+        
+        # 查找可能的关闭按钮
+        for selector in close_x_selectors:
+            try:
+                close_buttons = await page.query_selector_all(selector)
+                for button in close_buttons:
+                    # 检查按钮是否可见
+                    if await button.is_visible():
+                        # 点击前等待确保元素稳定
+                        await button.hover()  # 先悬停在按钮上
+                        await page.wait_for_timeout(300)
+                        await button.click()
+                        print(f"已点击关闭按钮: {selector}")
+                        await page.wait_for_timeout(1000)
+                        return True
+            except Exception as e:
+                # print(f"尝试点击 {selector} 时出错: {e}") # 调试时可以取消注释
+                continue
+
+        # 2. 针对性查找包含 × 符号的元素
+        close_x_symbols = [
+            "text='×'",
+            "text='✕'",
+            "text='✖'",
+            "text='X'",
+            "[aria-label='Close'] >> text=×",
+            "[title='Close'] >> text=×"
+        ]
+        
+        for selector in close_x_symbols:
+            try:
+                x_button = await page.query_selector(selector)
+                if x_button and await x_button.is_visible():
+                    await x_button.hover()
+                    await page.wait_for_timeout(300)
+                    await x_button.click()
+                    print(f"已点击包含 × 符号的按钮: {selector}")
+                    await page.wait_for_timeout(1000)
+                    return True
+            except Exception:
+                continue
+
+        # 3. 尝试通过XPath查找右上角位置的关闭按钮
+        try:
+            # 查找位于弹窗右上角的按钮
+            corner_buttons = await page.query_selector_all("xpath=//div[contains(@class, 'modal') or contains(@class, 'dialog') or contains(@class, 'popup')]//button[position()=1]")
+            for button in corner_buttons:
+                if await button.is_visible():
+                    await button.hover()
+                    await page.wait_for_timeout(300)
+                    await button.click()
+                    print("已点击弹窗右上角按钮")
+                    await page.wait_for_timeout(1000)
+                    return True
+        except Exception:
+            pass
+
+        # 4. 查找Next和Previous按钮
+        try:
+            # 查找Next/Previous按钮 - 为顺序浏览弹窗支持
+            next_button = await page.query_selector("button:has-text('Next')")
+            if next_button and await next_button.is_visible():
+                await next_button.click()
+                print("已点击'Next'按钮")
+                await page.wait_for_timeout(1000)
+                # 继续检查是否还有其他弹窗
+                await legacy_close_popups(page)
+                return True
+            
+            # 如果没有Next按钮，但找到了关闭按钮
+            done_button = await page.query_selector("button:has-text('Done'), button:has-text('Finish'), button:has-text('Got it')")
+            if done_button and await done_button.is_visible():
+                await done_button.click()
+                print("已点击'Done/Finish/Got it'按钮")
+                await page.wait_for_timeout(1000)
+                return True
+        except Exception:
+            pass
+
+        # 5. 尝试点击任何可能含有关闭意图的按钮
+        try:
+            close_text_buttons = await page.query_selector_all("button, a")
+            for button in close_text_buttons:
+                if await button.is_visible():
+                    button_text = await button.text_content()
+                    if button_text:
+                        button_text = button_text.lower().strip()
+                        if any(keyword in button_text for keyword in ["close", "got it", "ok", "next", "dismiss", "关闭", "确定", "知道了"]):
+                            await button.hover()
+                            await page.wait_for_timeout(300)
+                            await button.click()
+                            print(f"已点击文本为'{button_text}'的按钮")
+                            await page.wait_for_timeout(1000)
+                            return True
+        except Exception:
+            pass
+        
+        # 6. 通用的JavaScript方法尝试关闭各类弹窗
+        try:
+            # 使用JavaScript查找并点击可能的关闭按钮
+            # 重新编写JS代码，使用标准的三引号语法
+            close_button_clicked = await page.evaluate("""
+                () => { 
+                    function closePopupsInternal() {
+                        var closeSymbols = ['×', '✕', '✖', 'X', 'x'];
+                        var elements = document.querySelectorAll('*');
+                        
+                        for (var i = 0; i < elements.length; i++) {
+                            var el = elements[i];
+                            var text = el.textContent ? el.textContent.trim() : '';
+                            
+                            if (closeSymbols.includes(text) && el.offsetParent !== null) {
+                                el.click();
+                                console.log('JS: 点击了关闭符号按钮');
+                                return true;
+                            }
+                            
+                            if (el.tagName === 'BUTTON' || el.tagName === 'A') {
+                                var className = el.className ? el.className.toLowerCase() : '';
+                                var ariaLabel = el.getAttribute('aria-label');
+                                if ((className.includes('close') || 
+                                    className.includes('dismiss') || 
+                                    (ariaLabel && ariaLabel.toLowerCase() === 'close')) && 
+                                    el.offsetParent !== null) {
+                                    el.click();
+                                    console.log('JS: 点击了带有关闭类名/aria-label的按钮');
+                                    return true;
+                                }
+                            }
+                        }
+                        
+                        var actionButtons = document.querySelectorAll('button');
+                        for (var i = 0; i < actionButtons.length; i++) {
+                            var button = actionButtons[i];
+                            var text = button.textContent ? button.textContent.toLowerCase().trim() : '';
+                            if ((text === 'next' || text === 'done' || text === 'finish' || text === 'got it' || text === 'accept' || text === 'allow') && 
+                                button.offsetParent !== null) {
+                                button.click();
+                                console.log('JS: 点击了操作按钮: ' + text);
+                                return true;
+                            }
+                        }
+                        
+                        var dialogs = document.querySelectorAll('.modal, .dialog, .popup, [role="dialog"]');
+                        for (var i = 0; i < dialogs.length; i++) {
+                            var dialog = dialogs[i];
+                            var buttonsInDialog = dialog.querySelectorAll('button');
+                            if (buttonsInDialog.length > 0) {
+                                if (buttonsInDialog[0].offsetParent !== null) {
+                                    buttonsInDialog[0].click();
+                                    console.log('JS: 点击了对话框的第一个按钮');
+                                    return true;
+                                }
+                                if (buttonsInDialog.length > 1 && buttonsInDialog[buttonsInDialog.length-1].offsetParent !== null) {
+                                    buttonsInDialog[buttonsInDialog.length-1].click();
+                                    console.log('JS: 点击了对话框的最后一个按钮');
+                                    return true;
+                                }
+                            }
+                        }
+                        return false;
+                    }
+                    return closePopupsInternal();
+                }
+            """)
+            
+            if close_button_clicked:
+                print("已通过JavaScript点击关闭按钮")
+                await page.wait_for_timeout(1000)
+                return True
+        except Exception as e:
+            print(f"JavaScript关闭弹窗失败: {e}") # 保持此日志以观察是否修复
+        
+        # 检查是否有弹窗仍然存在
+        modals = await page.query_selector_all(".modal, .dialog, .popup, [role='dialog']")
+        if not modals: # 如果modals列表为空，直接返回False
+            print("未发现需要关闭的弹窗 (通过选择器)")
+            return False
+
+        visible_modals = [modal for modal in modals if await modal.is_visible()]
+        
+        if not visible_modals:
+            print("未发现可见的弹窗")
+            return False
+        else:
+            print(f"检测到 {len(visible_modals)} 个弹窗，但无法自动关闭")
+            return False # 明确返回False
+            
+    except Exception as e:
+        print(f"尝试关闭弹窗时出错: {e}")
+        return False
+
+
+# ---------------------------------------------------------------------------
+# 协议调用计数
+# ---------------------------------------------------------------------------
+
+class CountingProxy:
+    """包装 Page / ElementHandle，统计每个异步方法（即一次协议往返）的调用次数"""
+
+    def __init__(self, target, counter):
+        self._target = target
+        self._counter = counter
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if not inspect.iscoroutinefunction(value):
+            return value
+
+        async def counted(*args, **kwargs):
+            self._counter[f"{type(self._target).__name__}.{name}"] += 1
+            return self._wrap(await value(*args, **kwargs))
+        return counted
+
+    def _wrap(self, result):
+        if isinstance(result, list):
+            return [self._wrap(item) for item in result]
+        if type(result).__name__ == 'ElementHandle':
+            return CountingProxy(result, self._counter)
+        return result
+
+def build_probe_page(links, popup=None):
+    """生成一个带有大量链接和可选弹窗的合成页面"""
+    items = "\n".join(f'<li><a href="#item-{i}">Article {i}</a></li>' for i in range(links))
+    overlay = ""
+    if popup == 'cookie':
+        overlay = """
+        <div class="cookie-banner" role="dialog" style="position:fixed;bottom:0;left:0;right:0;background:#eee;padding:16px">
+            We use cookies. <button onclick="this.parentElement.remove()">Accept</button>
+        </div>"""
+    elif popup == 'modal':
+        overlay = """
+        <div class="modal" style="position:fixed;top:20%;left:30%;width:40%;background:#fff;padding:24px;border:1px solid #999">
+            <button class="close" aria-label="Close" onclick="this.parentElement.remove()">×</button>
+            <p>Subscribe to our newsletter!</p>
+        </div>"""
+    return f"""<!doctype html><html><head><title>Probe fixture</title></head>
+    <body><h1>Fixture</h1><nav><ul>{items}</ul></nav>{overlay}</body></html>"""
+
+# (场景名, 链接数量, 弹窗类型)
+PROBE_SCENARIOS = [
+    ("无弹窗, 300个链接", 300, None),
+    ("Cookie横幅, 300个链接", 300, 'cookie'),
+    ("右上角关闭的模态框", 50, 'modal'),
+]
+
+async def measure(page, html, func):
+    """在新加载的合成页面上运行一次 func，返回 (协议调用次数, 耗时秒数, 返回值)"""
+    await page.set_content(html)
+    counter = Counter()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = await func(CountingProxy(page, counter))
+    return sum(counter.values()), time.perf_counter() - start, result
+
+async def bench_probe(args):
+    """对比基线实现与单次探针实现的协议调用次数和耗时"""
+    pairs = [
+        ("close_popups", legacy_close_popups, sde.close_popups),
+        ("is_login_page", legacy_is_login_page, sde.is_login_page),
+    ]
+    async with async_playwright() as p:
+        browser = await p.chromium.launch(headless=True)
+        page = await browser.new_page()
+        print(f"{'场景':<24}{'函数':<16}{'基线调用':>10}{'探针调用':>10}{'基线耗时':>12}{'探针耗时':>12}")
+        for scenario, links, popup in PROBE_SCENARIOS:
+            html = build_probe_page(links, popup)
+            for name, legacy, probe in pairs:
+                legacy_calls, legacy_time, _ = await measure(page, html, legacy)
+                probe_calls, probe_time, _ = await measure(page, html, probe)
+                print(f"{scenario:<24}{name:<16}{legacy_calls:>10}{probe_calls:>10}"
+                      f"{legacy_time * 1000:>10.0f}ms{probe_time * 1000:>10.0f}ms")
+        await browser.close()
+
+
+# ---------------------------------------------------------------------------
+# 端到端基准：本地合成站点 + 真实的CSV批量流程
+# ---------------------------------------------------------------------------
+
+FIXTURE_STYLE = """
+body { font-family: sans-serif; margin: 0; }
+section { padding: 24px; border-bottom: 1px solid #ddd; }
+img { display: block; width: 600px; height: 300px; background: #f3f3f3; }
+.cookie-banner { position: fixed; bottom: 0; left: 0; right: 0; background: #eee; padding: 16px; }
+.modal { position: fixed; top: 20%; left: 30%; width: 40%; background: #fff; padding: 24px; border: 1px solid #999; }
+"""
+
+def fixture_page(title, body, overlay="", script=""):
+    """合成页面的外壳。注意正文不能出现 is_login_page() 识别的登录关键词"""
+    return f"""<!doctype html><html><head><title>{title}</title><style>{FIXTURE_STYLE}</style></head>
+    <body><h1>{title}</h1><p class="description">Synthetic benchmark fixture.</p>{body}{overlay}
+    <script>{script}</script></body></html>"""
+
+def fixture_sections(count, image_every=0, image_delay=0, lazy="native"):
+    """生成 count 个内容区块，每 image_every 个区块带一张（懒加载）图片"""
+    parts = []
+    for i in range(count):
+        image = ""
+        if image_every and i % image_every == 0:
+            src = f"/img/{i}.svg?delay={image_delay}"
+            if lazy == "observer":
+                image = f'<img data-src="{src}" alt="">'
+            else:
+                image = f'<img loading="lazy" src="{src}" alt="">'
+        parts.append(f'<section><h2>Section {i}</h2><p>{"Lorem ipsum dolor sit amet. " * 8}</p>{image}</section>')
+    return "\n".join(parts)
+
+# 用 IntersectionObserver 实现的懒加载，和很多站点自带的实现一致
+OBSERVER_LAZY_SCRIPT = """
+const observer = new IntersectionObserver(entries => {
+    for (const entry of entries) {
+        if (entry.isIntersecting) {
+            entry.target.src = entry.target.dataset.src;
+            observer.unobserve(entry.target);
+        }
+    }
+});
+document.querySelectorAll('img[data-src]').forEach(img => observer.observe(img));
+"""
+
+COOKIE_BANNER = """<div class="cookie-banner" role="dialog">We use cookies.
+    <button onclick="this.parentElement.remove()">Accept</button></div>"""
+
+# 延迟弹出的模态框，右上角有关闭按钮
+MODAL_SCRIPT = """
+setTimeout(() => {
+    const modal = document.createElement('div');
+    modal.className = 'modal';
+    modal.innerHTML = '<button class="close" aria-label="Close">×</button><p>Subscribe to our newsletter!</p>';
+    modal.querySelector('button').onclick = () => modal.remove();
+    document.body.appendChild(modal);
+}, 800);
+"""
+
+# 需要凭据的页面：密码表单提交后设置Cookie并跳回原地址
+AUTH_FORM = """<form method="post" action="/auth?next={next}">
+    <input type="email" name="email"><input type="password" name="password">
+    <button type="submit">Sign in</button></form>"""
+
+def fixture_routes(hang_ms):
+    """场景名 -> (路径, 说明)。每个场景对应合成站点上的一类页面"""
+    return {
+        'lazy': ("/lazy", "原生与IntersectionObserver懒加载图片"),
+        'cookie': ("/cookie", "底部Cookie横幅"),
+        'modal': ("/modal", "延迟弹出的模态框"),
+        'auth': ("/account", "密码表单，提交后才能看到内容"),
+        'tall': ("/tall", "约 40000px 高的长页面"),
+        'slow': ("/slow", f"慢图片，加载完成后再发出一个 {hang_ms}ms 才返回的请求"),
+    }
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    """合成站点的请求处理。hang_ms 和 stop_event 由 FixtureServer 设置"""
+    protocol_version = "HTTP/1.1"
+    hang_ms = 20000
+    stop_event = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, body, content_type="text/html; charset=utf-8", status=200, headers=()):
+        data = body.encode("utf-8") if isinstance(body, str) else body
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Cache-Control", "no-store")
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        query = parse_qs(parsed.query)
+        path = parsed.path
+        if path.startswith("/img/"):
+            delay = int(query.get('delay', ['0'])[0])
+            if delay:
+                self.stop_event.wait(delay / 1000)
+            hue = sum(map(ord, path)) % 360
+            svg = (f'<svg xmlns="http://www.w3.org/2000/svg" width="600" height="300">'
+                   f'<rect width="600" height="300" fill="hsl({hue},60%,70%)"/></svg>')
+            self.send_body(svg, "image/svg+xml")
+        elif path == "/hang":
+            self.stop_event.wait(self.hang_ms / 1000)
+            self.send_body("{}", "application/json")
+        elif path.startswith("/lazy"):
+            body = fixture_sections(40, image_every=2, image_delay=150)
+            body += fixture_sections(20, image_every=2, image_delay=150, lazy="observer")
+            self.send_body(fixture_page("Lazy gallery", body, script=OBSERVER_LAZY_SCRIPT))
+        elif path.startswith("/cookie"):
+            self.send_body(fixture_page("Cookie notice", fixture_sections(12), overlay=COOKIE_BANNER))
+        elif path.startswith("/modal"):
+            self.send_body(fixture_page("Newsletter modal", fixture_sections(12), script=MODAL_SCRIPT))
+        elif path.startswith("/account"):
+            if "bench_session=1" in (self.headers.get("Cookie") or ""):
+                self.send_body(fixture_page("Account dashboard", fixture_sections(15, image_every=5)))
+            else:
+                self.send_body(fixture_page("Members only", AUTH_FORM.format(next=path)))
+        elif path.startswith("/tall"):
+            self.send_body(fixture_page("Tall page", fixture_sections(250, image_every=25)))
+        elif path.startswith("/slow"):
+            script = "window.addEventListener('load', () => fetch('/hang?t=' + Date.now()));"
+            self.send_body(fixture_page("Slow resources", fixture_sections(10, image_every=3, image_delay=1500),
+                                        script=script))
+        else:
+            self.send_body("not found", "text/plain", status=404)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        self.rfile.read(length)
+        target = parse_qs(urlparse(self.path).query).get('next', ['/'])[0]
+        self.send_body("", status=303, headers=[("Location", target),
+                                                ("Set-Cookie", "bench_session=1; Path=/; HttpOnly")])
+
+class FixtureServer:
+    """在后台线程中运行合成站点，端口由系统分配"""
+
+    def __init__(self, hang_ms=20000):
+        self.stop_event = threading.Event()
+        handler = type("Handler", (FixtureHandler,), {'hang_ms': hang_ms, 'stop_event': self.stop_event})
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        # 先放行所有挂起的请求，再关闭服务
+        self.stop_event.set()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+def write_fixture_csv(path, base_url, scenarios, urls):
+    """按场景轮流生成 urls 行CSV，每5行一组"""
+    routes = fixture_routes(0)
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["case_name", "site_type", "prod_url"])
+        for i in range(urls):
+            scenario = scenarios[i % len(scenarios)]
+            writer.writerow([f"bench{i // 5:04d}", f"{scenario}-{i}", f"{base_url}{routes[scenario][0]}/{i}"])
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+def process_tree_rss():
+    """当前进程及其所有子孙进程（Playwright驱动、Chromium）的常驻内存之和，字节。
+    依赖 /proc，其他平台上返回 None"""
+    if not os.path.isdir("/proc"):
+        return None
+    children = {}
+    rss = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "rb") as f:
+                # comm 可能包含空格，从最后一个右括号之后开始解析
+                fields = f.read().rsplit(b")", 1)[1].split()
+        except OSError:
+            continue
+        pid = int(entry)
+        children.setdefault(int(fields[1]), []).append(pid)
+        rss[pid] = int(fields[21]) * PAGE_SIZE
+    total, stack = 0, [os.getpid()]
+    while stack:
+        pid = stack.pop()
+        total += rss.get(pid, 0)
+        stack.extend(children.get(pid, ()))
+    return total
+
+async def sample_peak_rss(peak, interval=0.5):
+    """定期采样进程树内存，把峰值写入 peak['rss']"""
+    while True:
+        rss = await asyncio.to_thread(process_tree_rss)
+        if rss is None:
+            return
+        peak['rss'] = max(peak['rss'], rss)
+        await asyncio.sleep(interval)
+
+async def bench_pipeline(args):
+    """启动合成站点，用真实的 process_csv 流程批量截图，报告吞吐量、延迟分布和内存峰值"""
+    routes = fixture_routes(args.hang_ms)
+    scenarios = split_scenarios(args.scenarios, routes)
+    workdir = args.keep or tempfile.mkdtemp(prefix="screenshot-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    csv_path = os.path.join(workdir, "urls.csv")
+    outdir = os.path.join(workdir, "screenshots")
+
+    settings = sde.CaptureSettings(
+        settle_budget_ms=args.settle_budget,
+        session_cache=sde.SessionCache(os.path.join(workdir, ".session_cache")),
+        request_filter=sde.RequestFilter.from_options(),
+        encoder=sde.ImageEncoder(workers=args.encode_workers),
+    )
+    metrics = sde.RunMetrics(os.path.join(workdir, "metrics.jsonl"))
+    peak = {'rss': 0}
+    sampler = asyncio.create_task(sample_peak_rss(peak))
+
+    print("场景: " + ", ".join(f"{name} ({routes[name][1]})" for name in scenarios))
+    try:
+        with FixtureServer(hang_ms=args.hang_ms) as server:
+            write_fixture_csv(csv_path, server.base_url, scenarios, args.urls)
+            print(f"合成站点: {server.base_url}，{args.urls} 个URL，并发数 {args.concurrency}，工作目录 {workdir}")
+            start = time.monotonic()
+            # 流程本身的日志很多，默认只保留进度条（输出到stderr）
+            output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+            with output:
+                async with sde.BrowserPool(headless=True, max_pages_per_browser=args.recycle_after) as pool:
+                    await sde.process_csv(csv_path, outdir, pool=pool, concurrency=args.concurrency,
+                                          per_host_limit=args.per_host, settings=settings, metrics=metrics)
+            elapsed = time.monotonic() - start
+    finally:
+        sampler.cancel()
+        settings.encoder.close()
+    metrics.close()
+
+    latencies = metrics.totals
+    report = {
+        'urls': args.urls,
+        'concurrency': args.concurrency,
+        'scenarios': scenarios,
+        'outcomes': dict(metrics.outcomes),
+        'elapsed_seconds': round(elapsed, 2),
+        'urls_per_minute': round(len(latencies) / elapsed * 60, 2) if elapsed else 0.0,
+        'latency_seconds': {f"p{q}": round(sde.percentile(latencies, q), 3) for q in (50, 90, 95, 99)},
+        'peak_rss_mb': round(peak['rss'] / 2 ** 20, 1) if peak['rss'] else None,
+    }
+    report['latency_seconds']['max'] = round(max(latencies), 3) if latencies else 0.0
+
+    print(f"\n完成 {len(latencies)}/{args.urls} 个URL ({report['outcomes']})，用时 {elapsed:.1f} 秒")
+    print(f"吞吐量: {report['urls_per_minute']:.1f} URL/分钟")
+    print("单URL耗时: " + ", ".join(f"{key} {value:.2f}s" for key, value in report['latency_seconds'].items()))
+    if report['peak_rss_mb'] is not None:
+        print(f"内存峰值（本进程+浏览器）: {report['peak_rss_mb']:.0f} MB")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"报告已写入: {args.json}")
+    if not args.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+def split_scenarios(value, routes):
+    names = [name.strip() for name in value.split(",") if name.strip()]
+    unknown = [name for name in names if name not in routes]
+    if unknown:
+        raise SystemExit(f"未知场景: {', '.join(unknown)}（可选: {', '.join(routes)}）")
+    return names
+
+def main():
+    parser = argparse.ArgumentParser(description="截图工具的性能基准测试")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("probe", help="对比弹窗/登录页检测的协议调用次数")
+    pipeline = subparsers.add_parser("pipeline", help="在本地合成站点上运行完整的CSV批量流程")
+    pipeline.add_argument("--urls", type=int, default=30, help="URL数量（默认30）")
+    pipeline.add_argument("--scenarios", type=str, default=",".join(fixture_routes(0)),
+                          help="逗号分隔的场景，按顺序轮流分配给URL（默认全部: "
+                               + ", ".join(fixture_routes(0)) + "）")
+    pipeline.add_argument("--concurrency", type=int, default=4, help="并发截图数（默认4）")
+    pipeline.add_argument("--per-host", type=int, default=0, help="同一主机的并发上限（默认0不限制，合成站点只有一个主机）")
+    pipeline.add_argument("--recycle-after", type=int, default=50, help="每个浏览器实例分发多少个页面后重启（默认50）")
+    pipeline.add_argument("--encode-workers", type=int, default=2, help="图片编码进程数（默认2）")
+    pipeline.add_argument("--settle-budget", type=int, default=15000, help="每次等待页面稳定的最长时间，毫秒（默认15000）")
+    pipeline.add_argument("--hang-ms", type=int, default=20000, help="slow场景中挂起请求的时长，毫秒（默认20000）")
+    pipeline.add_argument("--keep", type=str, metavar="DIR", help="把CSV、截图和耗时明细保留在该目录（默认用完即删）")
+    pipeline.add_argument("--json", type=str, metavar="PATH", help="把报告写成JSON，便于和基线对比")
+    pipeline.add_argument("--verbose", action="store_true", help="显示截图流程本身的日志")
+    args = parser.parse_args()
+
+    if args.command == "probe":
+        asyncio.run(bench_probe(args))
+    elif args.command == "pipeline":
+        asyncio.run(bench_pipeline(args))
+
+if __name__ == "__main__":
+    main()
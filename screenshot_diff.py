@@ -0,0 +1,449 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""比较两次截图运行的输出目录，找出有变化的截图
+
+用法:
+    python screenshot_diff.py 旧目录 新目录 --report diff_report
+
+每对同名图片依次经过:
+    1. 文件内容完全相同                        -> identical
+    2. 分段感知哈希（每 512 行一段）全部一致     -> unchanged（--exact 关闭这一步）
+    3. 按行分条逐像素比较（NumPy向量化），内存中只保留当前分条，
+       输出变化热力图和变化区域                  -> changed / unchanged
+结果写入 <report>/report.json，热力图写入 <report>/heatmaps/
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import struct
+import sys
+import zlib
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import zip_longest
+
+from tqdm import tqdm
+
+try:
+    import numpy as np
+    from PIL import Image
+except ImportError:  # 只有对比功能需要
+    np = Image = None
+
+from screenshot_png import PNG_SIGNATURE, TiledPngWriter, _png_chunk, write_file_atomic
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp")
+
+# 每个分条的高度，同时也是感知哈希的分段高度
+STRIP_HEIGHT = 512
+
+# 变化区域按这个大小的网格合并（像素）
+CELL_SIZE = 32
+
+# PNG颜色类型 -> (通道数, Pillow模式)
+PNG_FORMATS = {0: (1, "L"), 2: (3, "RGB"), 4: (2, "LA"), 6: (4, "RGBA")}
+
+# ---------------------------------------------------------------------------
+# 分条读取
+# ---------------------------------------------------------------------------
+
+def iter_png_chunks(f):
+    """依次返回PNG文件中的 (类型, 数据)，不读入整个文件"""
+    while True:
+        head = f.read(8)
+        if len(head) < 8:
+            return
+        length, kind = struct.unpack(">I4s", head)
+        body = f.read(length)
+        f.read(4)  # CRC
+        yield kind, body
+        if kind == b'IEND':
+            return
+
+def decode_png_strip(raw, previous, width, rows, color_type):
+    """把一段过滤后的扫描线还原为像素。
+    过滤依赖上一行，所以在前面补上上一分条的最后一行（已还原、0号过滤），交给Pillow的C解码器处理"""
+    data = (previous or b"") + raw
+    total = rows + (1 if previous else 0)
+    png = (PNG_SIGNATURE
+           + _png_chunk(b'IHDR', struct.pack(">IIBBBBB", width, total, 8, color_type, 0, 0, 0))
+           + _png_chunk(b'IDAT', zlib.compress(data, 0))
+           + _png_chunk(b'IEND', b''))
+    with Image.open(io.BytesIO(png)) as image:
+        pixels = np.asarray(image)
+    if previous:
+        pixels = pixels[1:]
+    last_row = b"\x00" + pixels[-1].tobytes()
+    return to_rgb(pixels), last_row
+
+def to_rgb(pixels):
+    """统一为 (高, 宽, 3) 的RGB数组，忽略透明通道"""
+    if pixels.ndim == 2:
+        return np.repeat(pixels[:, :, None], 3, axis=2)
+    if pixels.shape[2] == 2:
+        return np.repeat(pixels[:, :, :1], 3, axis=2)
+    return pixels[:, :, :3]
+
+def iter_strips(path, strip_height=STRIP_HEIGHT):
+    """按行分条读取图片，每次返回一个 (高, 宽, 3) 的数组。
+    8位非交错PNG边解压边还原，内存中只有当前分条；其他格式（JPEG、WebP、调色板PNG）整张解码后再分条"""
+    with open(path, "rb") as f:
+        header = None
+        if f.read(8) == PNG_SIGNATURE:
+            kind, body = next(iter_png_chunks(f), (None, b""))
+            if kind == b'IHDR':
+                header = struct.unpack(">IIBBBBB", body)
+        if header is None or header[2] != 8 or header[6] or header[3] not in PNG_FORMATS:
+            f.seek(0)
+            with Image.open(f) as image:
+                pixels = np.asarray(image.convert("RGB"))
+            for top in range(0, pixels.shape[0], strip_height):
+                yield pixels[top:top + strip_height]
+            return
+
+        width, height, _, color_type = header[:4]
+        stride = width * PNG_FORMATS[color_type][0] + 1
+        decompressor = zlib.decompressobj()
+        pending = bytearray()
+        previous = None
+        remaining = height
+        for kind, body in iter_png_chunks(f):
+            if kind != b'IDAT':
+                continue
+            pending += decompressor.decompress(body)
+            while remaining and len(pending) >= min(strip_height, remaining) * stride:
+                rows = min(strip_height, remaining)
+                raw = bytes(pending[:rows * stride])
+                del pending[:rows * stride]
+                strip, previous = decode_png_strip(raw, previous, width, rows, color_type)
+                remaining -= rows
+                yield strip
+
+def image_size(path):
+    with Image.open(path) as image:
+        return image.size
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# ---------------------------------------------------------------------------
+# 感知哈希
+# ---------------------------------------------------------------------------
+
+def band_hash(strip):
+    """一个分段的差值哈希（dHash）：缩成 16 行 x 17 列的灰度网格，比较水平相邻格子，最多256位"""
+    gray = strip.astype(np.float32).mean(axis=2)
+    height, width = gray.shape
+    row_edges = np.unique(np.linspace(0, height, 16, endpoint=False).astype(int))
+    col_edges = np.unique(np.linspace(0, width, 17, endpoint=False).astype(int))
+    # 按格子求和再除以格子大小，得到每格的平均亮度
+    sums = np.add.reduceat(np.add.reduceat(gray, row_edges, axis=0), col_edges, axis=1)
+    counts = np.outer(np.diff(np.append(row_edges, height)), np.diff(np.append(col_edges, width)))
+    grid = sums / counts
+    return np.packbits(grid[:, 1:] > grid[:, :-1]).tobytes().hex()
+
+def image_signature(path):
+    """图片的签名：文件哈希、尺寸和每个分段的感知哈希"""
+    width = height = 0
+    bands = []
+    for strip in iter_strips(path):
+        height += strip.shape[0]
+        width = strip.shape[1]
+        bands.append(band_hash(strip))
+    return {'sha256': file_digest(path), 'width': width, 'height': height, 'bands': bands}
+
+def hamming(a, b):
+    return bin(int(a, 16) ^ int(b, 16)).count("1") if a and b else 0
+
+def signatures_match(old, new, threshold):
+    """尺寸相同且每个分段的哈希差异都不超过 threshold 位"""
+    if (old['width'], old['height']) != (new['width'], new['height']) or len(old['bands']) != len(new['bands']):
+        return False
+    return all(a == b or hamming(a, b) <= threshold for a, b in zip(old['bands'], new['bands']))
+
+# ---------------------------------------------------------------------------
+# 逐像素比较
+# ---------------------------------------------------------------------------
+
+def cell_counts(mask):
+    """把变化掩码按 CELL_SIZE 网格统计每格的变化像素数"""
+    height, width = mask.shape
+    pad_h, pad_w = -height % CELL_SIZE, -width % CELL_SIZE
+    if pad_h or pad_w:
+        mask = np.pad(mask, ((0, pad_h), (0, pad_w)))
+    rows, cols = mask.shape[0] // CELL_SIZE, mask.shape[1] // CELL_SIZE
+    return mask.reshape(rows, CELL_SIZE, cols, CELL_SIZE).sum(axis=(1, 3), dtype=np.int64)
+
+def heatmap_strip(base, mask):
+    """热力图：原图转为浅灰作为底色，变化的像素标红"""
+    gray = base.astype(np.uint16).mean(axis=2, dtype=np.float32) * 0.35 + 160
+    out = np.repeat(gray.astype(np.uint8)[:, :, None], 3, axis=2)
+    out[mask] = (230, 30, 30)
+    return out
+
+def find_regions(grid, max_regions):
+    """在网格上找8连通的变化区域，返回按变化像素数排序的包围框"""
+    rows, cols = grid.shape
+    seen = np.zeros(grid.shape, dtype=bool)
+    regions = []
+    for r0, c0 in zip(*np.nonzero(grid)):
+        if seen[r0, c0]:
+            continue
+        seen[r0, c0] = True
+        queue = deque([(r0, c0)])
+        top, bottom, left, right, pixels = r0, r0, c0, c0, 0
+        while queue:
+            r, c = queue.popleft()
+            pixels += int(grid[r, c])
+            top, bottom, left, right = min(top, r), max(bottom, r), min(left, c), max(right, c)
+            for nr in (r - 1, r, r + 1):
+                for nc in (c - 1, c, c + 1):
+                    if 0 <= nr < rows and 0 <= nc < cols and grid[nr, nc] and not seen[nr, nc]:
+                        seen[nr, nc] = True
+                        queue.append((nr, nc))
+        regions.append({'x': int(left * CELL_SIZE), 'y': int(top * CELL_SIZE),
+                        'width': int((right - left + 1) * CELL_SIZE), 'height': int((bottom - top + 1) * CELL_SIZE),
+                        'changed_pixels': pixels})
+    regions.sort(key=lambda region: -region['changed_pixels'])
+    return regions[:max_regions]
+
+def pixel_diff(old_path, new_path, tolerance, heatmap_path=None, max_regions=50):
+    """两张图逐条比较。尺寸不同时只比较重叠部分，多出的行和列都算作变化。
+    返回 (变化像素数, 总像素数, 变化区域)；有变化且指定了 heatmap_path 时写出热力图"""
+    width = max(image_size(old_path)[0], image_size(new_path)[0])
+    writer = TiledPngWriter(heatmap_path) if heatmap_path else None
+    grid_rows = []
+    changed = total = 0
+    try:
+        for old, new in zip_longest(iter_strips(old_path), iter_strips(new_path)):
+            base = new if new is not None else old
+            height = max(s.shape[0] for s in (old, new) if s is not None)
+            mask = np.ones((height, width), dtype=bool)
+            if old is not None and new is not None:
+                h, w = min(old.shape[0], new.shape[0]), min(old.shape[1], new.shape[1])
+                delta = np.abs(old[:h, :w].astype(np.int16) - new[:h, :w].astype(np.int16)).max(axis=2)
+                mask[:h, :w] = delta > tolerance
+            changed += int(mask.sum())
+            total += mask.size
+            grid_rows.append(cell_counts(mask))
+            if writer:
+                # 热力图以新图（没有时用旧图）为底，宽度取两者较大值
+                canvas = np.full((height, width, 3), 255, dtype=np.uint8)
+                canvas[:base.shape[0], :base.shape[1]] = base
+                png = io.BytesIO()
+                Image.fromarray(heatmap_strip(canvas, mask)).save(png, "PNG", compress_level=1)
+                writer.append(png.getvalue())
+        if writer and changed:
+            writer.close()
+        elif writer:
+            writer.abort()
+    except BaseException:
+        if writer:
+            writer.abort()
+        raise
+
+    regions = []
+    if changed:
+        regions = find_regions(np.vstack(grid_rows), max_regions)
+        # 网格边缘的格子可能超出图片，裁剪到图片范围内
+        for region in regions:
+            region['width'] = min(region['width'], width - region['x'])
+            region['height'] = min(region['height'], total // width - region['y'])
+    return changed, total, regions
+
+# ---------------------------------------------------------------------------
+# 对比一对图片（在工作进程中运行）
+# ---------------------------------------------------------------------------
+
+def diff_pair(rel_path, old_path, new_path, old_sig, new_sig, options):
+    """对比一对图片，返回 (结果, 新计算出的签名 {路径: 签名})"""
+    result = {'path': rel_path, 'status': None, 'method': None}
+    computed = {}
+    try:
+        if old_path is None or new_path is None:
+            result['status'] = 'added' if old_path is None else 'removed'
+            size = image_size(new_path or old_path)
+            result['new_size' if old_path is None else 'old_size'] = list(size)
+            return result, computed
+
+        # 1. 文件完全相同
+        old_digest = old_sig['sha256'] if old_sig else file_digest(old_path)
+        new_digest = new_sig['sha256'] if new_sig else file_digest(new_path)
+        if old_digest == new_digest:
+            result.update(status='identical', method='bytes')
+            return result, computed
+
+        # 2. 感知哈希一致时直接认为没有变化；旧图的签名通常已经缓存，只需解码新图
+        if not options['exact']:
+            if new_sig is None:
+                new_sig = computed[new_path] = image_signature(new_path)
+            if old_sig is None:
+                old_sig = computed[old_path] = image_signature(old_path)
+            result['old_size'] = [old_sig['width'], old_sig['height']]
+            result['new_size'] = [new_sig['width'], new_sig['height']]
+            if signatures_match(old_sig, new_sig, options['phash_threshold']):
+                result.update(status='unchanged', method='phash')
+                return result, computed
+
+        # 3. 逐像素比较
+        heatmap_rel = None
+        heatmap_path = None
+        if options['heatmaps']:
+            # 非PNG截图的热力图保留原扩展名（a.jpg -> a.jpg.png），避免和同名PNG冲突
+            name = rel_path if rel_path.lower().endswith(".png") else rel_path + ".png"
+            heatmap_rel = os.path.join("heatmaps", name)
+            heatmap_path = os.path.join(options['report_dir'], heatmap_rel)
+            os.makedirs(os.path.dirname(heatmap_path), exist_ok=True)
+        changed, total, regions = pixel_diff(old_path, new_path, options['tolerance'], heatmap_path,
+                                             options['max_regions'])
+        result['method'] = 'pixel'
+        if not changed:
+            result['status'] = 'unchanged'
+            return result, computed
+        result.update(status='changed', changed_pixels=changed, changed_ratio=round(changed / total, 6),
+                      regions=regions, heatmap=heatmap_rel)
+        if 'old_size' not in result:
+            result['old_size'], result['new_size'] = list(image_size(old_path)), list(image_size(new_path))
+        return result, computed
+    except Exception as e:
+        result.update(status='error', error=f"{type(e).__name__}: {e}")
+        return result, computed
+
+# ---------------------------------------------------------------------------
+# 目录对比
+# ---------------------------------------------------------------------------
+
+def list_images(root):
+    """目录下所有截图的相对路径（不含缩略图和未写完的临时文件）"""
+    images = set()
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            lower = name.lower()
+            if lower.endswith(IMAGE_EXTENSIONS) and ".thumb." not in lower:
+                images.add(os.path.relpath(os.path.join(dirpath, name), root))
+    return images
+
+class SignatureCache:
+    """图片签名缓存：以文件路径为键，文件大小和修改时间不变时直接复用。
+    定期对比同一批截图时，上一次的新图就是这一次的旧图，不需要再解码"""
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"读取签名缓存失败，重新计算: {e}")
+
+    @staticmethod
+    def _stamp(path):
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def get(self, path):
+        if path is None:
+            return None
+        entry = self._entries.get(os.path.abspath(path))
+        if entry and entry['stamp'] == self._stamp(path):
+            return entry['signature']
+        return None
+
+    def put(self, path, signature):
+        self._entries[os.path.abspath(path)] = {'stamp': self._stamp(path), 'signature': signature}
+
+    def save(self):
+        if self.path:
+            write_file_atomic(self.path, json.dumps(self._entries).encode("utf-8"))
+
+def diff_directories(old_dir, new_dir, report_dir, workers=None, tolerance=16, phash_threshold=0, exact=False,
+                     heatmaps=True, max_regions=50, cache_path=None):
+    """对比两个输出目录中的同名截图，写出 report.json 并返回报告"""
+    os.makedirs(report_dir, exist_ok=True)
+    old_images, new_images = list_images(old_dir), list_images(new_dir)
+    pairs = sorted(old_images | new_images)
+    cache = SignatureCache(cache_path)
+    options = {'report_dir': report_dir, 'tolerance': tolerance, 'phash_threshold': phash_threshold,
+               'exact': exact, 'heatmaps': heatmaps, 'max_regions': max_regions}
+    print(f"对比 {len(pairs)} 张截图: {old_dir} -> {new_dir}")
+
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for rel_path in pairs:
+            old_path = os.path.join(old_dir, rel_path) if rel_path in old_images else None
+            new_path = os.path.join(new_dir, rel_path) if rel_path in new_images else None
+            futures.append(executor.submit(diff_pair, rel_path, old_path, new_path,
+                                           cache.get(old_path), cache.get(new_path), options))
+        with tqdm(total=len(futures), desc="对比进度") as progress:
+            for future in as_completed(futures):
+                result, computed = future.result()
+                results.append(result)
+                for path, signature in computed.items():
+                    cache.put(path, signature)
+                progress.update(1)
+    cache.save()
+
+    results.sort(key=lambda result: result['path'])
+    report = {
+        'old': os.path.abspath(old_dir),
+        'new': os.path.abspath(new_dir),
+        'tolerance': tolerance,
+        'summary': dict(Counter(result['status'] for result in results)),
+        'pairs': results,
+    }
+    write_file_atomic(os.path.join(report_dir, "report.json"),
+                      json.dumps(report, ensure_ascii=False, indent=2).encode("utf-8"))
+    return report
+
+def print_report(report, limit=20):
+    summary = report['summary']
+    print("\n对比结果: " + ", ".join(f"{status} {count}" for status, count in sorted(summary.items())))
+    changed = sorted((r for r in report['pairs'] if r['status'] == 'changed'), key=lambda r: -r['changed_ratio'])
+    for result in changed[:limit]:
+        print(f"  {result['path']}: {result['changed_ratio'] * 100:.2f}% 像素变化, "
+              f"{len(result['regions'])} 个区域, 热力图 {result['heatmap'] or '-'}")
+    if len(changed) > limit:
+        print(f"  ... 另有 {len(changed) - limit} 张有变化")
+    for result in report['pairs']:
+        if result['status'] == 'error':
+            print(f"  对比失败 {result['path']}: {result['error']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="比较两次截图运行的输出目录，输出变化热力图和JSON报告")
+    parser.add_argument("old", help="上一次的输出目录")
+    parser.add_argument("new", help="这一次的输出目录")
+    parser.add_argument("--report", type=str, default="diff_report", help="报告和热力图的输出目录（默认diff_report）")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="对比进程数（默认为CPU核数）")
+    parser.add_argument("--tolerance", type=int, default=16, help="像素任一通道差值超过该值才算变化（0-255，默认16）")
+    parser.add_argument("--phash-threshold", type=int, default=0, help="分段感知哈希允许的差异位数（默认0）")
+    parser.add_argument("--exact", action="store_true", help="不使用感知哈希跳过，内容不完全相同的图片都逐像素比较")
+    parser.add_argument("--no-heatmaps", action="store_true", help="不输出热力图")
+    parser.add_argument("--max-regions", type=int, default=50, help="每张图最多报告的变化区域数（默认50）")
+    parser.add_argument("--cache", type=str, default=".diff_signatures.json",
+                        help="图片签名缓存文件（默认.diff_signatures.json，空字符串表示不缓存）")
+    parser.add_argument("--fail-on-change", action="store_true", help="有变化、新增、删除或对比失败时以状态码1退出")
+    args = parser.parse_args()
+
+    if np is None:
+        raise SystemExit("截图对比需要安装NumPy和Pillow: pip install numpy Pillow")
+
+    report = diff_directories(args.old, args.new, args.report, workers=args.workers, tolerance=args.tolerance,
+                              phash_threshold=args.phash_threshold, exact=args.exact,
+                              heatmaps=not args.no_heatmaps, max_regions=args.max_regions,
+                              cache_path=args.cache or None)
+    print_report(report)
+    print(f"报告已写入: {os.path.join(args.report, 'report.json')}")
+    if args.fail_on_change and set(report['summary']) - {'identical', 'unchanged'}:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -2,18 +2,66 @@
 # -*- coding: utf-8 -*-
 
 import os
+import io
+import sys
+import csv
+import fnmatch
+import random
+import json
+import sqlite3
+import hashlib
+import base64
+import socket
+import threading
+import tempfile
+import time
 import asyncio
-import pandas as pd
+import multiprocessing
+from contextlib import asynccontextmanager, contextmanager, nullcontext
 from playwright.async_api import async_playwright, TimeoutError
 from tqdm import tqdm
+
+from screenshot_png import TiledPngWriter, write_file_atomic
+
+try:
+    import fcntl
+except ImportError:  # Windows 没有 fcntl，跨进程的文件锁退化为不加锁
+    fcntl = None
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow 只在需要转码、压缩或生成缩略图时使用
+    Image = None
 import re
 import argparse
-from urllib.parse import urlparse
+from collections import Counter, deque
+from itertools import chain, islice
+from queue import Empty
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field, replace
+from urllib.parse import parse_qs, urlparse
 
 # 用户账号和密码 (如果需要登录)
 USERNAME = "your_email@example.com"
 PASSWORD = "your_password"
 
+# 登录页检测探针：在页面内一次性检查密码框、登录按钮和页面文本，避免把整个DOM序列化回Python
+LOGIN_PROBE_SCRIPT = """
+(terms) => {
+    const passwordField = !!document.querySelector("input[type='password']");
+    const loginButton = Array.from(document.querySelectorAll('button')).some(button => {
+        const text = (button.textContent || '').toLowerCase();
+        return text.includes('登录') || text.includes('login') || text.includes('sign in');
+    });
+    const html = document.documentElement ? document.documentElement.outerHTML.toLowerCase() : '';
+    return {
+        passwordField: passwordField,
+        loginButton: loginButton,
+        loginText: terms.some(term => html.includes(term))
+    };
+}
+"""
+
 async def is_login_page(page):
     """检测当前页面是否为登录页面"""
     try:
@@ -22,17 +70,14 @@ async def is_login_page(page):
         if "login" in current_url.lower() or "sign-in" in current_url.lower():
             return True
         
-        # 检查页面是否包含登录表单元素
-        password_field = await page.query_selector("input[type='password']")
-        login_button = await page.query_selector("button:has-text('登录'), button:has-text('Login'), button:has-text('Sign in')")
+        # 检查页面是否包含登录表单元素，以及页面内容是否包含登录相关文本（一次往返完成）
+        login_terms = ["登录", "login", "sign in", "signin"]
+        probe = await page.evaluate(LOGIN_PROBE_SCRIPT, login_terms)
         
-        if password_field and login_button:
+        if probe['passwordField'] and probe['loginButton']:
             return True
         
-        # 检查页面内容是否包含登录相关文本
-        content = await page.content()
-        login_terms = ["登录", "login", "sign in", "signin"]
-        if any(term in content.lower() for term in login_terms):
+        if probe['loginText']:
             return True
             
         return False
@@ -145,8 +190,12 @@ async def login(page):
             else:
                 print("无法找到登录按钮，请手动登录")
         
-        # 等待登录完成
-        await page.wait_for_timeout(5000)  # 等待5秒
+        # 等待登录完成：密码框消失（通常伴随页面跳转），最多等待10秒
+        try:
+            await page.wait_for_function("() => !document.querySelector(\"input[type='password']\")", timeout=10000)
+            await page.wait_for_load_state('load', timeout=10000)
+        except Exception:
+            pass
         
         # 检查是否登录成功
         if await is_login_page(page):
@@ -159,593 +208,3913 @@ async def login(page):
         print(f"登录过程出错: {e}")
         return False
 
-async def close_popups(page):
-    """关闭页面上的弹窗和提示"""
-    try:
-        # 1. 首先尝试点击右上角的叉叉按钮(通常是关闭弹窗的最常见方式)
-        close_x_selectors = [
-            "button.close", 
-            ".close",
-            ".modal-close",
-            "button[aria-label='Close']",
-            ".dialog-close-button",
-            "[data-testid='close-button']",
-            ".modal .close",
-            ".dialog .close",
-            ".popup .close",
-            "button.modal-close",
-            "button.dialog-close",
-            "button.popup-close"
-        ]
-        
-        # 查找可能的关闭按钮
-        for selector in close_x_selectors:
-            try:
-                close_buttons = await page.query_selector_all(selector)
-                for button in close_buttons:
-                    # 检查按钮是否可见
-                    if await button.is_visible():
-                        # 点击前等待确保元素稳定
-                        await button.hover()  # 先悬停在按钮上
-                        await page.wait_for_timeout(300)
-                        await button.click()
-                        print(f"已点击关闭按钮: {selector}")
-                        await page.wait_for_timeout(1000)
-                        return True
-            except Exception as e:
-                # print(f"尝试点击 {selector} 时出错: {e}") # 调试时可以取消注释
-                continue
+def get_origin(url):
+    """返回URL的源（协议+主机+端口），作为登录会话缓存的键"""
+    parsed = urlparse(url)
+    return f"{parsed.scheme}://{parsed.netloc}".lower()
 
-        # 2. 针对性查找包含 × 符号的元素
-        close_x_symbols = [
-            "text='×'",
-            "text='✕'",
-            "text='✖'",
-            "text='X'",
-            "[aria-label='Close'] >> text=×",
-            "[title='Close'] >> text=×"
-        ]
-        
-        for selector in close_x_symbols:
+@contextmanager
+def file_lock_sync(path):
+    """对 path 加跨进程排他锁（fcntl.flock），阻塞直到取得锁；锁文件不存在时自动创建"""
+    with open(path, "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        yield
+
+@asynccontextmanager
+async def file_lock(path, poll_interval=0.2):
+    """file_lock_sync 的异步版本：以非阻塞方式轮询取锁，等待期间不阻塞事件循环，也可以被取消"""
+    with open(path, "a") as f:
+        while fcntl is not None:
             try:
-                x_button = await page.query_selector(selector)
-                if x_button and await x_button.is_visible():
-                    await x_button.hover()
-                    await page.wait_for_timeout(300)
-                    await x_button.click()
-                    print(f"已点击包含 × 符号的按钮: {selector}")
-                    await page.wait_for_timeout(1000)
-                    return True
-            except Exception:
-                continue
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                await asyncio.sleep(poll_interval)
+        # 关闭文件时锁自动释放
+        yield
 
-        # 3. 尝试通过XPath查找右上角位置的关闭按钮
-        try:
-            # 查找位于弹窗右上角的按钮
-            corner_buttons = await page.query_selector_all("xpath=//div[contains(@class, 'modal') or contains(@class, 'dialog') or contains(@class, 'popup')]//button[position()=1]")
-            for button in corner_buttons:
-                if await button.is_visible():
-                    await button.hover()
-                    await page.wait_for_timeout(300)
-                    await button.click()
-                    print("已点击弹窗右上角按钮")
-                    await page.wait_for_timeout(1000)
-                    return True
-        except Exception:
-            pass
+class SessionCache:
+    """按源缓存Playwright的storage_state（cookies和localStorage），新上下文直接带着登录状态启动。
+    缓存文件超过TTL后失效；同一个源的重新登录通过锁串行化，避免并发任务重复登录。
+    锁同时覆盖同一进程内的任务和其他工作进程（--processes、共享队列的多个节点共用缓存目录时）"""
 
-        # 4. 查找Next和Previous按钮
+    def __init__(self, cache_dir=".session_cache", ttl_seconds=12 * 3600):
+        self.cache_dir = cache_dir
+        self.ttl_seconds = ttl_seconds
+        self._locks = {}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, origin):
+        return os.path.join(self.cache_dir, re.sub(r'[^A-Za-z0-9._-]', '_', origin) + ".json")
+
+    def version(self, origin):
+        """返回缓存文件的修改时间（纳秒），没有有效缓存时返回None"""
         try:
-            # 查找Next/Previous按钮 - 为顺序浏览弹窗支持
-            next_button = await page.query_selector("button:has-text('Next')")
-            if next_button and await next_button.is_visible():
-                await next_button.click()
-                print("已点击'Next'按钮")
-                await page.wait_for_timeout(1000)
-                # 继续检查是否还有其他弹窗
-                await close_popups(page)
-                return True
-            
-            # 如果没有Next按钮，但找到了关闭按钮
-            done_button = await page.query_selector("button:has-text('Done'), button:has-text('Finish'), button:has-text('Got it')")
-            if done_button and await done_button.is_visible():
-                await done_button.click()
-                print("已点击'Done/Finish/Got it'按钮")
-                await page.wait_for_timeout(1000)
-                return True
-        except Exception:
-            pass
+            mtime_ns = os.stat(self._path(origin)).st_mtime_ns
+        except OSError:
+            return None
+        if time.time() - mtime_ns / 1e9 > self.ttl_seconds:
+            return None
+        return mtime_ns
+
+    def get(self, origin):
+        """返回有效的storage_state文件路径，没有或已过期时返回None"""
+        if self.version(origin) is None:
+            return None
+        return self._path(origin)
 
-        # 5. 尝试点击任何可能含有关闭意图的按钮
+    async def save(self, origin, context):
+        """保存上下文当前的登录状态（先写临时文件再原子替换）"""
+        path = self._path(origin)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        await context.storage_state(path=tmp_path)
+        os.replace(tmp_path, path)
+        print(f"已缓存登录会话: {origin}")
+
+    def invalidate(self, origin):
+        """删除某个源的缓存会话"""
         try:
-            close_text_buttons = await page.query_selector_all("button, a")
-            for button in close_text_buttons:
-                if await button.is_visible():
-                    button_text = await button.text_content()
-                    if button_text:
-                        button_text = button_text.lower().strip()
-                        if any(keyword in button_text for keyword in ["close", "got it", "ok", "next", "dismiss", "关闭", "确定", "知道了"]):
-                            await button.hover()
-                            await page.wait_for_timeout(300)
-                            await button.click()
-                            print(f"已点击文本为'{button_text}'的按钮")
-                            await page.wait_for_timeout(1000)
-                            return True
-        except Exception:
+            os.remove(self._path(origin))
+            print(f"已清除失效的登录会话: {origin}")
+        except OSError:
             pass
-        
-        # 6. 通用的JavaScript方法尝试关闭各类弹窗
-        try:
-            # 使用JavaScript查找并点击可能的关闭按钮
-            # 重新编写JS代码，使用标准的三引号语法
-            close_button_clicked = await page.evaluate("""
-                () => { 
-                    function closePopupsInternal() {
-                        var closeSymbols = ['×', '✕', '✖', 'X', 'x'];
-                        var elements = document.querySelectorAll('*');
-                        
-                        for (var i = 0; i < elements.length; i++) {
-                            var el = elements[i];
-                            var text = el.textContent ? el.textContent.trim() : '';
-                            
-                            if (closeSymbols.includes(text) && el.offsetParent !== null) {
-                                el.click();
-                                console.log('JS: 点击了关闭符号按钮');
-                                return true;
-                            }
-                            
-                            if (el.tagName === 'BUTTON' || el.tagName === 'A') {
-                                var className = el.className ? el.className.toLowerCase() : '';
-                                var ariaLabel = el.getAttribute('aria-label');
-                                if ((className.includes('close') || 
-                                    className.includes('dismiss') || 
-                                    (ariaLabel && ariaLabel.toLowerCase() === 'close')) && 
-                                    el.offsetParent !== null) {
-                                    el.click();
-                                    console.log('JS: 点击了带有关闭类名/aria-label的按钮');
-                                    return true;
-                                }
-                            }
-                        }
-                        
-                        var actionButtons = document.querySelectorAll('button');
-                        for (var i = 0; i < actionButtons.length; i++) {
-                            var button = actionButtons[i];
-                            var text = button.textContent ? button.textContent.toLowerCase().trim() : '';
-                            if ((text === 'next' || text === 'done' || text === 'finish' || text === 'got it' || text === 'accept' || text === 'allow') && 
-                                button.offsetParent !== null) {
-                                button.click();
-                                console.log('JS: 点击了操作按钮: ' + text);
-                                return true;
-                            }
-                        }
-                        
-                        var dialogs = document.querySelectorAll('.modal, .dialog, .popup, [role="dialog"]');
-                        for (var i = 0; i < dialogs.length; i++) {
-                            var dialog = dialogs[i];
-                            var buttonsInDialog = dialog.querySelectorAll('button');
-                            if (buttonsInDialog.length > 0) {
-                                if (buttonsInDialog[0].offsetParent !== null) {
-                                    buttonsInDialog[0].click();
-                                    console.log('JS: 点击了对话框的第一个按钮');
-                                    return true;
-                                }
-                                if (buttonsInDialog.length > 1 && buttonsInDialog[buttonsInDialog.length-1].offsetParent !== null) {
-                                    buttonsInDialog[buttonsInDialog.length-1].click();
-                                    console.log('JS: 点击了对话框的最后一个按钮');
-                                    return true;
-                                }
-                            }
-                        }
-                        return false;
-                    }
-                    return closePopupsInternal();
-                }
-            """)
-            
-            if close_button_clicked:
-                print("已通过JavaScript点击关闭按钮")
-                await page.wait_for_timeout(1000)
-                return True
-        except Exception as e:
-            print(f"JavaScript关闭弹窗失败: {e}") # 保持此日志以观察是否修复
-        
-        # 检查是否有弹窗仍然存在
-        modals = await page.query_selector_all(".modal, .dialog, .popup, [role='dialog']")
-        if not modals: # 如果modals列表为空，直接返回False
-            print("未发现需要关闭的弹窗 (通过选择器)")
-            return False
 
-        visible_modals = [modal for modal in modals if await modal.is_visible()]
-        
-        if not visible_modals:
-            print("未发现可见的弹窗")
-            return False
-        else:
-            print(f"检测到 {len(visible_modals)} 个弹窗，但无法自动关闭")
-            return False # 明确返回False
-            
-    except Exception as e:
-        print(f"尝试关闭弹窗时出错: {e}")
-        return False
+    def clear(self):
+        """删除所有缓存会话"""
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".json"):
+                os.remove(os.path.join(self.cache_dir, name))
 
-async def take_screenshot(url, output_path, timeout=90000):
-    """使用增强的Playwright方法访问URL并截图，解决网站反爬检测问题"""
-    browser = None
-    try:
-        async with async_playwright() as p:
-            print(f"使用增强截图方式访问: {url}")
-            
-            # 使用启动参数来隐藏自动化特征
-            browser_args = [
-                '--disable-blink-features=AutomationControlled',
-                '--disable-features=site-per-process',
-                '--user-agent=Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/112.0.0.0 Safari/537.36',
-            ]
-            
-            # 使用有头模式以获得更好的渲染效果
-            browser = await p.chromium.launch(
-                headless=False,
-                args=browser_args
-            )
-            
-            # 使用特殊的上下文配置
-            context = await browser.new_context(
-                viewport={'width': 1920, 'height': 1080},  # 标准屏幕尺寸
-                java_script_enabled=True,
-                ignore_https_errors=True,
-                device_scale_factor=1.0,
-                has_touch=False,
-                is_mobile=False,
-                locale="en-US"
+    @asynccontextmanager
+    async def lock(self, origin):
+        """同一个源的登录操作共用一把锁：进程内先用 asyncio.Lock 排队，
+        再对 <源>.lock 加文件锁，与其他进程串行化检查、登录和保存"""
+        async with self._locks.setdefault(origin, asyncio.Lock()):
+            async with file_lock(self._path(origin)[:-len(".json")] + ".lock"):
+                yield
+
+async def apply_storage_state(context, path):
+    """把storage_state文件中的cookies和localStorage加载到已存在的上下文中"""
+    with open(path, encoding="utf-8") as f:
+        state = json.load(f)
+    if state.get("cookies"):
+        await context.add_cookies(state["cookies"])
+    for entry in state.get("origins", []):
+        items = {item["name"]: item["value"] for item in entry.get("localStorage", [])}
+        if items:
+            await context.add_init_script(
+                f"if (location.origin === {json.dumps(entry['origin'])}) {{"
+                f" for (const [k, v] of Object.entries({json.dumps(items)})) localStorage.setItem(k, v); }}"
             )
-            
-            # 先创建页面
-            page = await context.new_page()
-            
-            # 使用CDP隐藏自动化特征
-            cdp_session = await context.new_cdp_session(page)
-            await cdp_session.send('Page.addScriptToEvaluateOnNewDocument', {
-                'source': '''
-                Object.defineProperty(navigator, 'webdriver', {
-                    get: () => undefined
-                });
-                
-                // 隐藏其他常见的自动化指标
-                const originalQuery = window.navigator.permissions.query;
-                window.navigator.permissions.query = (parameters) => (
-                    parameters.name === 'notifications' ?
-                        Promise.resolve({state: Notification.permission}) :
-                        originalQuery(parameters)
-                );
-                
-                // 添加/修改一些常规只读属性，使其难以检测
-                Object.defineProperties(navigator, {
-                    plugins: { get: () => [1, 2, 3, 4, 5] },
-                    languages: { get: () => ['en-US', 'en'] }
-                });
-                '''
-            })
-            
-            # 设置超时
-            page.set_default_navigation_timeout(timeout)
-            page.set_default_timeout(timeout)
 
-            print(f"导航到URL: {url}")
-            # 使用更接近人类行为的导航方式
-            await page.goto(url, wait_until='networkidle', timeout=timeout)
-            
-            print("应用增强截图处理方式...")
-            # 禁用CSS动画和过渡效果
-            await page.add_style_tag(content="""
-                * {
-                    transition: none !important;
-                    animation: none !important;
-                    transform: none !important;
-                }
-            """)
-            
-            # 等待页面元素稳定
-            await page.wait_for_timeout(5000)
-            
-            # 检查是否需要登录
-            if await is_login_page(page):
-                login_successful = await login(page)
-                if not login_successful:
-                    print(f"登录失败 ({url})")
-                    return False
-                print(f"重新访问URL: {url}")
-                await page.goto(url, wait_until='networkidle', timeout=timeout)
-                await page.wait_for_timeout(5000)
-                if await is_login_page(page):
-                    print(f"登录后仍是登录页 ({url})")
-                    return False
-            
-            # 模拟正常用户行为：随机鼠标移动和滚动
-            print("模拟用户行为...")
-            for _ in range(3):  # 鼠标移动次数
-                x = 100 + (1820 * 0.7)  # 在页面上部区域移动
-                y = 100 + (800 * 0.6)  # 保持在上半部分
-                await page.mouse.move(x, y)
-                await page.wait_for_timeout(500)  # 短暂停顿
-            
-            # 缓慢滚动以更自然地加载页面
-            print("缓慢滚动页面...")
-            
-            # 先快速预览整个页面
-            for scroll_pos in [300, 600, 1000, 1500, 0]:  # 多个滚动位置，最后回到顶部
-                await page.evaluate(f'window.scrollTo(0, {scroll_pos});')
-                await page.wait_for_timeout(800)
-            
-            # 然后更慢地从顶部滚到底部，给足时间加载内容
-            scroll_height = await page.evaluate('document.body.scrollHeight;')
-            view_height = await page.evaluate('window.innerHeight;')
-            scroll_steps = min(10, max(5, int(scroll_height / view_height)))
-            step_size = scroll_height / scroll_steps
-            
-            print(f"分{scroll_steps}步滚动页面，总高度: {scroll_height}px...")
-            for i in range(scroll_steps + 1):
-                current_pos = i * step_size
-                await page.evaluate(f'window.scrollTo(0, {current_pos});')
-                
-                # 每次滚动后稍等一会，让更多内容加载
-                await page.wait_for_timeout(1000)
-                
-                # 尝试点击某些可能的交互元素（如Cookie通知）
-                await close_popups(page)
-            
-            # 回到顶部，从新开始观察页面加载
-            await page.evaluate('window.scrollTo(0, 0);')
-            await page.wait_for_timeout(3000)
-            
-            # 等待关键内容显示
-            try:
-                # 等待页面主标题或主要内容元素出现
-                await page.wait_for_selector('h1, .main-title, .hero-title, [class*="title"], [class*="heading"]', 
-                                           timeout=10000, state='visible')
-                print("找到页面标题元素")
-                
-                # 尝试获取更多可能的关键内容
-                await page.wait_for_selector('p, .description, article, [class*="content"]', 
-                                           timeout=8000, state='visible')
-                print("找到页面内容元素")
-            except Exception as e:
-                print(f"等待内容元素时出错: {e}")
-            
-            # 确保所有图片加载完成
-            print("确保所有图片加载完成...")
-            await page.evaluate("""
-                async () => {
-                    const images = Array.from(document.images);
-                    const promises = [];
-                    for (const img of images) {
-                        if (!img.complete || img.naturalWidth === 0) {
-                            promises.push(new Promise((resolve, reject) => {
-                                img.onload = () => { console.log('Image loaded:', img.src); resolve(); };
-                                img.onerror = () => { console.log('Image error:', img.src); resolve(); };
-                                if (!img.src) resolve();
-                            }));
-                        }
-                    }
-                    await Promise.race([
-                        Promise.all(promises),
-                        new Promise(resolve => setTimeout(resolve, 10000))
-                    ]);
-                }
-            """)
-            
-            # 最后，给页面最终的等待时间，让页面完全稳定
-            print("最终等待，确保页面完全加载...")
-            await page.wait_for_timeout(8000)  # 等待8秒
-            
-            # 再次回到顶部
-            await page.evaluate('window.scrollTo(0, 0);')
-            await page.wait_for_timeout(2000)
-            
-            # 直接截全屏
-            print(f"开始截图，URL: {url}")
-            await page.screenshot(path=output_path, full_page=True, timeout=60000)
-            print(f"截图成功保存至: {output_path}")
+async def ensure_logged_in(page, context, origin, session_cache=None, started_version=None):
+    """登录页检测触发后恢复登录状态：优先复用其他任务刚保存的会话，否则重新登录并写入缓存"""
+    if session_cache is None:
+        return await login(page)
+
+    async with session_cache.lock(origin):
+        current_version = session_cache.version(origin)
+        if current_version is not None and current_version != started_version:
+            # 等锁期间其他任务已经完成登录，直接使用它保存的会话
+            print(f"复用其他任务刚保存的登录会话: {origin}")
+            await apply_storage_state(context, session_cache.get(origin))
             return True
-    except TimeoutError as te:
-        print(f"截图时发生超时错误 ({url}): {te}")
-        return False
-    except Exception as e:
-        print(f"截图时发生一般错误 ({url}): {e}")
-        import traceback
-        print(traceback.format_exc())
-        return False
-    finally:
-        if browser:
-            await browser.close()
-            print(f"浏览器已关闭 ({url})")
+        if started_version is not None:
+            # 使用缓存会话仍然看到登录页，说明缓存已失效
+            session_cache.invalidate(origin)
 
-def get_clean_folder_name(text):
-    """将文本转换为有效的文件夹名称"""
-    if not text or pd.isna(text):
-        return "未分类"
-    
-    # 截取前30个字符，避免文件夹名过长
-    text = str(text)[:30]
-    
-    # 移除非法字符
-    text = re.sub(r'[\\/*?:"<>|]', "", text)
-    text = text.strip()
-    
-    # 如果为空，返回默认名称
-    if not text:
-        return "未分类"
-    
-    return text
+        if not await login(page):
+            return False
+        await session_cache.save(origin, context)
+        return True
 
-async def process_csv(csv_path, output_dir):
-    """处理CSV文件并下载截图"""
-    # 创建输出目录
-    os.makedirs(output_dir, exist_ok=True)
-    
-    # 读取CSV文件
+# 右上角叉叉按钮(通常是关闭弹窗的最常见方式)
+CLOSE_X_SELECTORS = [
+    "button.close", 
+    ".close",
+    ".modal-close",
+    "button[aria-label='Close']",
+    ".dialog-close-button",
+    "[data-testid='close-button']",
+    ".modal .close",
+    ".dialog .close",
+    ".popup .close",
+    "button.modal-close",
+    "button.dialog-close",
+    "button.popup-close"
+]
+
+# 按钮文本中包含这些关键词时认为有关闭意图
+CLOSE_KEYWORDS = ["close", "got it", "ok", "next", "dismiss", "关闭", "确定", "知道了"]
+
+# 弹窗探针：在页面内一次遍历完成所有查找策略，返回按优先级排序的候选按钮。
+# 候选元素会被打上 data-popup-candidate 属性，Python端再按序号点击。
+# 每个候选附带一条可复用的规则（弹窗容器内的选择器+可选文本），该域名之前成功过的规则排在最前。
+# 规则只对弹窗内（对话框类容器或 position: fixed 的祖先元素中）的元素生效，避免误点页面本身的按钮和链接
+POPUP_PROBE_SCRIPT = """
+({ closeSelectors, keywords, limit, learned }) => {
+    const isVisible = (el) => {
+        const rect = el.getBoundingClientRect();
+        if (rect.width <= 0 || rect.height <= 0) return false;
+        const style = getComputedStyle(el);
+        return style.visibility !== 'hidden' && style.display !== 'none';
+    };
+    const textOf = (el) => (el.textContent || '').trim();
+    const stableClasses = (el) => Array.from(el.classList).filter(c => !/\\d{3,}|^css-|^sc-|^jsx-/.test(c));
+
+    // 元素所在的弹窗容器：对话框类的祖先，或 position: fixed 的祖先；不在弹窗内时返回null
+    const overlayOf = (el) => {
+        const parent = el.parentElement;
+        const container = parent && parent.closest('[role="dialog"], [role="alertdialog"], [aria-modal="true"], [class*="modal"], [class*="dialog"], [class*="popup"], [class*="cookie"], [class*="consent"]');
+        if (container) return container;
+        for (let node = parent; node && node !== document.body; node = node.parentElement) {
+            if (getComputedStyle(node).position === 'fixed') return node;
+        }
+        return null;
+    };
+    const scopeFor = (container) => {
+        if (container.id && !/\\d{3,}/.test(container.id)) return '#' + CSS.escape(container.id);
+        const classes = stableClasses(container).slice(0, 2);
+        if (classes.length) return container.tagName.toLowerCase() + classes.map(c => '.' + CSS.escape(c)).join('');
+        const role = container.getAttribute('role');
+        return role ? '[role="' + role + '"]' : '';
+    };
+
+    // 按文本找到的按钮，规则里必须带上文本，否则同样类名的其他按钮也会被点击
+    const textStrategies = ['close-symbol', 'next', 'done', 'close-text', 'action'];
+
+    // 为弹窗内的候选元素生成一条尽量稳定的规则：弹窗容器 + 元素的id，或标签+aria-label+非生成的类名；
+    // 文本类策略和只剩标签名的选择器附带按钮文本。不在弹窗内的元素不生成规则（只点击这一次，不记住）
+    const ruleFor = (el, strategy, label) => {
+        const container = overlayOf(el);
+        if (!container) return null;
+        if (strategy === 'close-selector') return { selector: label, text: '', strategy };
+        let selector;
+        const aria = el.getAttribute('aria-label');
+        const classes = stableClasses(el).slice(0, 3);
+        if (el.id && !/\\d{3,}/.test(el.id)) {
+            selector = '#' + CSS.escape(el.id);
+        } else {
+            selector = el.tagName.toLowerCase();
+            if (aria) selector += '[aria-label="' + aria.replace(/["\\\\]/g, '\\\\$&') + '"]';
+            selector += classes.map(c => '.' + CSS.escape(c)).join('');
+            const scope = scopeFor(container);
+            if (scope) selector = scope + ' ' + selector;
+        }
+        const generic = !el.id && !aria && classes.length === 0;
+        const keepText = generic || textStrategies.includes(strategy);
+        return { selector, text: keepText ? textOf(el).toLowerCase().slice(0, 40) : '', strategy };
+    };
+
+    document.querySelectorAll('[data-popup-candidate]').forEach(el => el.removeAttribute('data-popup-candidate'));
+
+    const candidates = [];
+    const seen = new Set();
+    const add = (el, rank, strategy, label, rule) => {
+        if (seen.has(el) || !isVisible(el)) return;
+        seen.add(el);
+        candidates.push({ el, rank, strategy, label, text: textOf(el).slice(0, 40), rule: rule || ruleFor(el, strategy, label) });
+    };
+
+    // 0. 该域名之前成功关闭过弹窗的规则
+    for (const rule of learned) {
+        let matches;
+        try { matches = document.querySelectorAll(rule.selector); } catch (e) { continue; }
+        matches.forEach(el => {
+            if (!overlayOf(el)) return;
+            if (!rule.text || textOf(el).toLowerCase().slice(0, 40) === rule.text) add(el, 0, 'learned', rule.selector, rule);
+        });
+    }
+
+    // 1. 常见的关闭按钮选择器
+    for (const selector of closeSelectors) {
+        let matches;
+        try { matches = document.querySelectorAll(selector); } catch (e) { continue; }
+        matches.forEach(el => add(el, 1, 'close-selector', selector));
+    }
+
+    const buttons = Array.from(document.querySelectorAll('button, a'));
+    const symbols = ['×', '✕', '✖', 'X'];
+
+    // 2. 只包含 × 符号的元素
+    for (const el of document.querySelectorAll('body *')) {
+        if (el.children.length === 0 && symbols.includes(textOf(el))) add(el, 2, 'close-symbol', textOf(el));
+    }
+
+    // 3. 弹窗容器内的第一个按钮(通常位于右上角)
+    for (const dialog of document.querySelectorAll("div[class*='modal'], div[class*='dialog'], div[class*='popup']")) {
+        for (const button of dialog.querySelectorAll('button')) {
+            if (button.parentElement.querySelector(':scope > button') === button) add(button, 3, 'dialog-corner', '');
+        }
+    }
+
+    // 4. 引导弹窗的 Next / Done / Finish / Got it 按钮
+    for (const button of buttons) {
+        if (button.tagName === 'BUTTON' && textOf(button).toLowerCase().includes('next')) add(button, 4, 'next', 'Next');
+    }
+    for (const button of buttons) {
+        const text = textOf(button).toLowerCase();
+        if (button.tagName === 'BUTTON' && ['done', 'finish', 'got it'].some(k => text.includes(k))) add(button, 4, 'done', text);
+    }
+
+    // 5. 文本中带有关闭意图的按钮或链接
+    for (const button of buttons) {
+        const text = textOf(button).toLowerCase();
+        if (text && keywords.some(k => text.includes(k))) add(button, 5, 'close-text', text);
+    }
+
+    // 6. 类名/aria-label 带关闭含义的按钮、同意类按钮、对话框的首尾按钮
+    for (const button of buttons) {
+        const className = typeof button.className === 'string' ? button.className.toLowerCase() : '';
+        const ariaLabel = (button.getAttribute('aria-label') || '').toLowerCase();
+        if (className.includes('close') || className.includes('dismiss') || ariaLabel === 'close') add(button, 6, 'close-class', className || ariaLabel);
+    }
+    for (const button of document.querySelectorAll('button')) {
+        const text = textOf(button).toLowerCase();
+        if (['next', 'done', 'finish', 'got it', 'accept', 'allow'].includes(text)) add(button, 6, 'action', text);
+    }
+    const dialogs = Array.from(document.querySelectorAll('.modal, .dialog, .popup, [role="dialog"]'));
+    for (const dialog of dialogs) {
+        const inDialog = dialog.querySelectorAll('button');
+        if (inDialog.length > 0) add(inDialog[0], 6, 'dialog-first', '');
+        if (inDialog.length > 1) add(inDialog[inDialog.length - 1], 6, 'dialog-last', '');
+    }
+
+    candidates.sort((a, b) => a.rank - b.rank);
+    const top = candidates.slice(0, limit);
+    top.forEach((c, i) => c.el.setAttribute('data-popup-candidate', String(i)));
+    return {
+        candidates: top.map((c, i) => ({ index: i, rank: c.rank, strategy: c.strategy, label: c.label, text: c.text, rule: c.rule })),
+        visibleModals: dialogs.filter(isVisible).length
+    };
+}
+"""
+
+async def probe_popups(page, limit=5, learned=()):
+    """在一次页面调用中找出所有可能关闭弹窗的按钮，按优先级返回；learned 中的规则最先尝试"""
+    return await page.evaluate(POPUP_PROBE_SCRIPT, {
+        'closeSelectors': CLOSE_X_SELECTORS,
+        'keywords': CLOSE_KEYWORDS,
+        'limit': limit,
+        'learned': list(learned),
+    })
+
+async def click_popup_candidate(page, candidate):
+    """点击探针标记的候选按钮，真实点击失败时退回到页面内的 click()"""
+    selector = f"[data-popup-candidate='{candidate['index']}']"
     try:
-        df = pd.read_csv(csv_path)
-        print(f"成功读取CSV文件，共 {len(df)} 行数据")
-        print(f"CSV 文件列名: {', '.join(df.columns)}")
-    except Exception as e:
-        print(f"读取CSV文件时发生错误: {e}")
-        return
-    
-    # 检查必要的列是否存在
-    if 'prod_url' not in df.columns:
-        print("CSV文件中缺少'prod_url'列")
-        return
-    
-    # 确保case_name列存在
-    if 'case_name' not in df.columns:
-        print("警告: CSV文件中没有'case_name'列，所有截图将保存在同一文件夹中")
-        df['case_name'] = "未分类"
-    
-    # 按case_name分组
-    for case_name, group_df in df.groupby('case_name'):
-        clean_case_name = get_clean_folder_name(case_name)
-        group_dir = os.path.join(output_dir, clean_case_name)
-        os.makedirs(group_dir, exist_ok=True)
-        
-        print(f"\n处理查询组: {clean_case_name} (共 {len(group_df)} 个URL)")
-        
-        # 统计已存在和需要处理的URL数量
-        existing_files = 0
-        urls_to_process = 0
+        await page.click(selector, timeout=2000)
+        return True
+    except Exception:
+        pass
+    try:
+        await page.eval_on_selector(selector, "el => el.click()")
+        return True
+    except Exception:
+        return False
+
+async def close_popups(page, rule_cache=None, _depth=0):
+    """关闭页面上的弹窗和提示。传入 rule_cache 时优先尝试该域名记住的规则，并记住这次成功的规则"""
+    try:
+        host = urlparse(page.url).hostname or ""
+        probe = await probe_popups(page, learned=rule_cache.rules_for(host) if rule_cache else ())
         
-        # 遍历该组中的每个URL并截图
-        for i, (_, row) in enumerate(tqdm(group_df.iterrows(), desc=f"组 {clean_case_name} 的截图", total=len(group_df))):
-            url = row.get('prod_url')
-            if pd.isna(url) or not url:
-                continue
-                
-            # 创建包含site_type的文件名
-            site_type = row.get('site_type', "Unknown")
-            filename = f"{site_type.lower()}.png"
-            
-            output_path = os.path.join(group_dir, filename)
-            
-            # 检查文件是否已存在
-            if os.path.exists(output_path):
-                print(f"\n文件已存在，跳过: {output_path}")
-                existing_files += 1
+        # 按优先级依次尝试，点击成功一个即返回
+        for candidate in probe['candidates']:
+            if not await click_popup_candidate(page, candidate):
                 continue
-            
-            urls_to_process += 1
-            
-            # 尝试获取截图
-            print(f"\n正在处理 {url} ({site_type})")
-            success = await take_screenshot(url, output_path)
-            
-            if success:
-                print(f"截图已保存到: {output_path}")
-            else:
-                print(f"无法截取 {url} 的截图")
+            label = candidate['label'] or candidate['text']
+            print(f"已点击关闭按钮 ({candidate['strategy']}): {label}")
+            # 弹窗以外的元素没有规则，不记住
+            if rule_cache and candidate['rule']:
+                rule_cache.learn(host, candidate['rule'])
+            await page.wait_for_timeout(500)
+            if (candidate['rule'] or candidate).get('strategy') == 'next' and _depth < 5:
+                # 继续检查顺序浏览弹窗的下一页（包括记住的 Next 按钮规则）
+                await close_popups(page, rule_cache, _depth + 1)
+            return True
         
-        print(f"\n组 {clean_case_name} 处理完成: {existing_files} 个文件已存在，{urls_to_process} 个URL已处理")
+        # 检查是否有弹窗仍然存在
+        if probe['visibleModals']:
+            print(f"检测到 {probe['visibleModals']} 个弹窗，但无法自动关闭")
+        else:
+            print("未发现可见的弹窗")
+        return False
+            
+    except Exception as e:
+        print(f"尝试关闭弹窗时出错: {e}")
+        return False
 
-async def main():
-    # 解析命令行参数
-    parser = argparse.ArgumentParser(description="增强版网页截图工具，支持从CSV批量截图或单个URL截图。")
-    parser.add_argument("--url", type=str, help="需要单独截图的URL。")
-    parser.add_argument("--output", type=str, help="单个URL截图的输出文件名（可选，可包含路径）。")
-    parser.add_argument("--csv", type=str, default="case_urls.csv", help="CSV文件路径（可选，默认为case_urls.csv）")
-    parser.add_argument("--outdir", type=str, default="enhanced_screenshots", help="输出目录名（可选，默认为enhanced_screenshots）")
-    
-    args = parser.parse_args()
+class PopupRuleCache:
+    """按域名记住哪条规则（选择器+可选按钮文本）关掉过弹窗，之后在同一域名上最先尝试。
+    规则保存在JSON文件中，跨行、跨运行复用；每个域名只保留命中次数最多的几条。
+    多个工作进程共用同一个文件：保存时在文件锁内重新读取，合并其他进程新记住的规则后再写入"""
 
-    if args.url:
-        # 单个URL截图模式
-        single_url = args.url
-        output_file_path = args.output
-        
-        if not output_file_path:
-            # 如果未指定输出路径，创建默认路径和文件名
-            domain = urlparse(single_url).netloc.replace(".", "_")
-            # 移除非法字符并截断
-            safe_domain = re.sub(r'[\\/*?:"<>|]', '', domain)[:50]
-            filename = f"enhanced_{safe_domain}_{pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')}.png"
-            output_dir_single = "enhanced_single"
-            os.makedirs(output_dir_single, exist_ok=True)
-            output_file_path = os.path.join(output_dir_single, filename)
+    def __init__(self, path=".popup_rules.json", max_rules=5):
+        self.path = path
+        self.max_rules = max_rules
+        self._rules = self._load()
+        self._learned = {}   # 上次保存以来本进程的命中：(域名, 选择器, 文本) -> 规则
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"读取弹窗规则缓存失败，重新开始记录: {e}")
+            return {}
+
+    def _add(self, rules, host, rule, hits, last_used):
+        """把一条规则的命中累加到 rules 中该域名的列表，并只保留命中最多的 max_rules 条"""
+        known_rules = rules.setdefault(host, [])
+        for known in known_rules:
+            if known['selector'] == rule['selector'] and known.get('text', '') == rule.get('text', ''):
+                known['hits'] += hits
+                known['last_used'] = max(known['last_used'], last_used)
+                break
         else:
-            # 如果指定了输出路径，确保目录存在
-            output_dir_single = os.path.dirname(output_file_path)
-            if output_dir_single:
-                 os.makedirs(output_dir_single, exist_ok=True)
+            known_rules.append({'selector': rule['selector'], 'text': rule.get('text', ''),
+                                'strategy': rule.get('strategy', ''), 'hits': hits, 'last_used': last_used})
+        known_rules.sort(key=lambda known: (-known['hits'], -known['last_used']))
+        del known_rules[self.max_rules:]
 
-        print(f"开始为单个URL截图: {single_url}")
-        print(f"截图将保存至: {output_file_path}")
-        
-        success = await take_screenshot(single_url, output_file_path)
-        if success:
-            print(f"单个URL截图成功: {output_file_path}")
+    def rules_for(self, host):
+        return self._rules.get(host, [])
+
+    def learn(self, host, rule):
+        """记录一次成功的关闭操作"""
+        now = time.time()
+        key = (host, rule['selector'], rule.get('text', ''))
+        pending = self._learned.setdefault(key, {'rule': rule, 'hits': 0})
+        pending['hits'] += 1
+        pending['last_used'] = now
+        self._add(self._rules, host, rule, 1, now)
+        self.save()
+
+    def save(self):
+        """在文件锁内重新读取文件，合并本进程上次保存以来的命中后写回"""
+        with file_lock_sync(self.path + ".lock"):
+            rules = self._load()
+            for (host, _, _), pending in self._learned.items():
+                self._add(rules, host, pending['rule'], pending['hits'], pending['last_used'])
+            write_file_atomic(self.path, json.dumps(rules, ensure_ascii=False, indent=1).encode("utf-8"))
+        self._rules = rules
+        self._learned.clear()
+
+# 常见Cookie同意管理平台（CMP）的容器，使用 --suppress 时在首次绘制前隐藏
+DEFAULT_SUPPRESS_SELECTORS = [
+    "#onetrust-consent-sdk", "#CybotCookiebotDialog", "#CybotCookiebotDialogBodyUnderlay",
+    "#usercentrics-root", "#didomi-host", ".qc-cmp2-container", "#truste-consent-track",
+    ".cc-window", ".cky-consent-container", "#cmpbox", "#cmpbox2", ".osano-cm-window",
+    "#hs-eu-cookie-confirmation",
+]
+
+# 在文档最开始插入隐藏样式；此时 head 可能还不存在，直接挂到根元素上
+SUPPRESS_INIT_SCRIPT = """
+(() => {
+    const css = %s;
+    const inject = () => {
+        const style = document.createElement('style');
+        style.setAttribute('data-popup-suppress', '');
+        style.textContent = css;
+        (document.head || document.documentElement).appendChild(style);
+    };
+    if (document.documentElement) inject();
+    else document.addEventListener('readystatechange', inject, { once: true });
+})();
+"""
+
+class PopupSuppressor:
+    """在首次绘制前屏蔽已知的Cookie横幅和引导弹窗，页面上根本不出现弹窗，也就不需要关闭。
+    规则按域名配置（包含子域名，'*' 对所有域名生效）：
+        {"example.com": {"hide": [".onboarding-modal"], "script": "localStorage.setItem('tour_done', '1')"}}
+    hide 中的选择器通过样式隐藏，script 在页面自身脚本之前执行（例如预先写入已同意/已看过引导的标记）"""
+
+    def __init__(self, rules=None, use_defaults=True):
+        self.rules = dict(rules or {})
+        if use_defaults:
+            defaults = self.rules.setdefault('*', {})
+            defaults['hide'] = DEFAULT_SUPPRESS_SELECTORS + list(defaults.get('hide', []))
+
+    @classmethod
+    def from_file(cls, path=None, use_defaults=True):
+        rules = {}
+        if path:
+            with open(path, encoding="utf-8") as f:
+                rules = json.load(f)
+        return cls(rules, use_defaults)
+
+    def rules_for(self, url):
+        """适用于该URL的规则：'*'、主域名和子域名的规则依次合并"""
+        host = (urlparse(url).hostname or "").lower()
+        hide, scripts = [], []
+        for domain, rule in self.rules.items():
+            if domain == '*' or host == domain or host.endswith("." + domain):
+                hide.extend(rule.get('hide', []))
+                if rule.get('script'):
+                    scripts.append(rule['script'])
+        return hide, scripts
+
+    def script_for(self, url):
+        hide, scripts = self.rules_for(url)
+        parts = []
+        if hide:
+            css = ",\n".join(hide) + " { display: none !important; visibility: hidden !important; }"
+            parts.append(SUPPRESS_INIT_SCRIPT % json.dumps(css))
+        # 每段脚本单独捕获异常，一条规则出错不影响其他规则和页面
+        parts += [f"try {{ {script}\n}} catch (e) {{}}" for script in scripts]
+        return "\n".join(parts)
+
+    async def attach(self, context, url):
+        script = self.script_for(url)
+        if script:
+            await context.add_init_script(script)
+
+# 启动参数，用来隐藏自动化特征
+BROWSER_ARGS = [
+    '--disable-blink-features=AutomationControlled',
+    '--disable-features=site-per-process',
+    '--user-agent=Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/112.0.0.0 Safari/537.36',
+]
+
+# 每个新上下文使用的默认配置
+CONTEXT_OPTIONS = {
+    'viewport': {'width': 1920, 'height': 1080},  # 标准屏幕尺寸
+    'java_script_enabled': True,
+    'ignore_https_errors': True,
+    'device_scale_factor': 1.0,
+    'has_touch': False,
+    'is_mobile': False,
+    'locale': "en-US",
+}
+
+# 在每个文档加载前注入的脚本，隐藏自动化特征
+STEALTH_INIT_SCRIPT = '''
+Object.defineProperty(navigator, 'webdriver', {
+    get: () => undefined
+});
+
+// 隐藏其他常见的自动化指标
+const originalQuery = window.navigator.permissions.query;
+window.navigator.permissions.query = (parameters) => (
+    parameters.name === 'notifications' ?
+        Promise.resolve({state: Notification.permission}) :
+        originalQuery(parameters)
+);
+
+// 添加/修改一些常规只读属性，使其难以检测
+Object.defineProperties(navigator, {
+    plugins: { get: () => [1, 2, 3, 4, 5] },
+    languages: { get: () => ['en-US', 'en'] }
+});
+'''
+
+class _BrowserSlot:
+    """浏览器池中的一个浏览器实例及其使用计数"""
+
+    def __init__(self, browser):
+        self.browser = browser
+        self.served = 0      # 已分发的上下文数量
+        self.active = 0      # 正在使用的上下文数量
+        self.retired = False # 是否已被标记为待回收
+
+class BrowserPool:
+    """整个运行期间共享的浏览器池：只启动一次Chromium，为每个URL分发新的BrowserContext，
+    在分发N个页面后或浏览器崩溃时自动回收重启。
+    spare_contexts 大于0时，每种上下文选项都预先准备好几个空白上下文，分发时不必等待创建"""
+
+    def __init__(self, headless=True, max_pages_per_browser=50, spare_contexts=0):
+        self.headless = headless
+        self.max_pages_per_browser = max_pages_per_browser
+        self.spare_contexts = spare_contexts
+        self._playwright = None
+        self._slot = None
+        self._lock = asyncio.Lock()
+        self._spares = {}    # 上下文选项 -> [(slot, context), ...]
+        self._refills = {}   # 上下文选项 -> 补充预热上下文的任务
+        self.launches = 0
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def start(self):
+        """启动Playwright驱动（浏览器在第一次分发上下文时才启动）"""
+        if self._playwright is None:
+            self._playwright = await async_playwright().start()
+        return self
+
+    async def warm_up(self, **overrides):
+        """提前启动浏览器，并按 overrides 准备好预热上下文"""
+        if self.spare_contexts:
+            await self._refill(self._spare_key(overrides), overrides)
         else:
-            print(f"单个URL截图失败: {single_url}")
-        return
+            await self._release(await self._acquire())
 
-    # 批量CSV处理模式
-    csv_path = args.csv
-    output_dir = args.outdir 
-    
-    # 预检查任务状态
-    print("预检查任务状态...")
-    try:
-        df = pd.read_csv(csv_path)
-        total_urls = len(df)
-        completed_urls = 0
-        pending_urls = 0
-        
-        # 确保case_name列存在
-        if 'case_name' not in df.columns:
-            df['case_name'] = "未分类"
-        
-        # 按case_name分组检查
-        for case_name, group_df in df.groupby('case_name'):
-            clean_case_name = get_clean_folder_name(case_name)
-            group_dir = os.path.join(output_dir, clean_case_name)
-            
-            # 确保目录存在
-            os.makedirs(group_dir, exist_ok=True)
-            
-            group_completed = 0
-            group_pending = 0
-            
-            # 检查每个URL对应的截图是否已存在
-            for _, row in group_df.iterrows():
-                url = row.get('prod_url')
-                if pd.isna(url) or not url:
-                    continue
-                    
-                site_type = row.get('site_type', "Unknown")
-                filename = f"{site_type.lower()}.png"
-                output_path = os.path.join(group_dir, filename)
-                
-                if os.path.exists(output_path):
-                    group_completed += 1
-                    completed_urls += 1
-                else:
-                    group_pending += 1
-                    pending_urls += 1
-            
-            print(f"组 {clean_case_name}: {group_completed}/{len(group_df)} 已完成, {group_pending} 待处理")
-        
-        print(f"\n总任务状态: {completed_urls}/{total_urls} 已完成 ({completed_urls/total_urls*100:.1f}%), {pending_urls} 待处理")
-        
-        if pending_urls == 0:
-            print("所有截图任务已完成！无需继续执行。")
-            return
+    async def close(self):
+        """关闭当前浏览器和Playwright驱动"""
+        for task in self._refills.values():
+            task.cancel()
+        for key in list(self._spares):
+            for slot, context in self._spares.pop(key):
+                await self._discard(slot, context)
+        async with self._lock:
+            if self._slot:
+                await self._close_browser(self._slot)
+                self._slot = None
+        if self._playwright:
+            await self._playwright.stop()
+            self._playwright = None
+
+    async def _launch(self):
+        browser = await self._playwright.chromium.launch(
+            headless=self.headless,
+            args=BROWSER_ARGS
+        )
+        slot = _BrowserSlot(browser)
+        # 浏览器崩溃或被意外关闭时标记为待回收，下次分发时重新启动
+        browser.on("disconnected", lambda _: setattr(slot, 'retired', True))
+        self.launches += 1
+        print(f"浏览器已启动 (第 {self.launches} 次, {'无头' if self.headless else '有头'}模式)")
+        return slot
+
+    async def _close_browser(self, slot):
+        slot.retired = True
+        try:
+            if slot.browser.is_connected():
+                await slot.browser.close()
+        except Exception as e:
+            print(f"关闭浏览器时出错: {e}")
+
+    async def _acquire(self):
+        async with self._lock:
+            if self._playwright is None:
+                await self.start()
+            slot = self._slot
+            if slot and (slot.retired or not slot.browser.is_connected()
+                         or slot.served >= self.max_pages_per_browser):
+                slot.retired = True
+                self._slot = None
+                # 旧浏览器上的预热上下文一并释放
+                for spares in self._spares.values():
+                    stale = [spare for spare in spares if spare[0] is slot]
+                    spares[:] = [spare for spare in spares if spare[0] is not slot]
+                    for _, context in stale:
+                        await self._discard(slot, context)
+                # 没有正在使用的上下文时立即关闭，否则等最后一个上下文释放时再关闭
+                if slot.active == 0:
+                    await self._close_browser(slot)
+                print(f"回收浏览器 (已分发 {slot.served} 个页面)")
+            if self._slot is None:
+                self._slot = await self._launch()
+            self._slot.served += 1
+            self._slot.active += 1
+            return self._slot
+
+    async def _release(self, slot):
+        slot.active -= 1
+        if slot.retired and slot.active == 0 and slot is not self._slot:
+            await self._close_browser(slot)
+
+    async def _new_context(self, overrides):
+        """在当前浏览器上创建一个已注入隐藏脚本的上下文，返回 (slot, context)"""
+        slot = await self._acquire()
+        try:
+            options = dict(CONTEXT_OPTIONS)
+            options.update(overrides)
+            context = await slot.browser.new_context(**options)
+            # 对上下文中的所有页面生效，等同于逐页发送 Page.addScriptToEvaluateOnNewDocument
+            await context.add_init_script(STEALTH_INIT_SCRIPT)
+        except Exception:
+            if not slot.browser.is_connected():
+                slot.retired = True
+            await self._release(slot)
+            raise
+        return slot, context
+
+    async def _discard(self, slot, context):
+        try:
+            await context.close()
+        except Exception:
+            pass
+        await self._release(slot)
+
+    @staticmethod
+    def _spare_key(overrides):
+        # 带登录状态的上下文每次都不同，不做预热
+        if 'storage_state' in overrides:
+            return None
+        return json.dumps(overrides, sort_keys=True)
+
+    async def _take_spare(self, key):
+        spares = self._spares.get(key)
+        while spares:
+            slot, context = spares.pop()
+            if not slot.retired and slot.browser.is_connected():
+                return slot, context
+            await self._discard(slot, context)
+        return None
+
+    async def _refill(self, key, overrides):
+        try:
+            spares = self._spares.setdefault(key, [])
+            while len(spares) < self.spare_contexts:
+                spares.append(await self._new_context(overrides))
+        except Exception as e:
+            print(f"预热浏览器上下文失败: {e}")
+        finally:
+            self._refills.pop(key, None)
+
+    def recycle(self, browser):
+        """标记该浏览器待回收：不再分发新的上下文，正在使用的上下文全部释放后关闭"""
+        slot = self._slot
+        if slot and slot.browser is browser and not slot.retired:
+            slot.retired = True
+            print(f"浏览器内存超出上限，回收浏览器 (已分发 {slot.served} 个页面)")
+
+    @asynccontextmanager
+    async def context(self, **overrides):
+        """分发一个已注入隐藏脚本的新BrowserContext，使用结束后自动关闭"""
+        key = self._spare_key(overrides) if self.spare_contexts else None
+        spare = await self._take_spare(key) if key else None
+        if key and key not in self._refills:
+            # 后台补充被取走的预热上下文
+            self._refills[key] = asyncio.create_task(self._refill(key, overrides))
+        slot, context = spare or await self._new_context(overrides)
+        try:
+            yield context
+        except Exception:
+            # 浏览器已断开说明发生了崩溃，标记后下次分发时重新启动
+            if not slot.browser.is_connected():
+                slot.retired = True
+            raise
+        finally:
+            await self._discard(slot, context)
+
+MB = 1024 * 1024
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+def process_rss(pid):
+    """进程的常驻内存，字节；依赖 /proc，其他平台或进程已退出时返回 None"""
+    try:
+        with open(f"/proc/{pid}/statm", "rb") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return None
+
+class MemoryWatchdog:
+    """截图期间采样浏览器内存：每个页面的JS堆（CDP Performance.getMetrics），
+    以及浏览器各进程的RSS（CDP SystemInfo.getProcessInfo 取进程号，再从 /proc 读取，仅Linux）。
+    页面JS堆超过 page_heap_budget_mb 时该页面停止滚动加载并降级为只截取视口；
+    浏览器进程总RSS超过 browser_rss_limit_mb 时回收浏览器，正在截图的页面完成后换用新浏览器"""
+
+    def __init__(self, page_heap_budget_mb=1024, browser_rss_limit_mb=4096, interval=1.0):
+        self.page_heap_budget = page_heap_budget_mb * MB
+        self.browser_rss_limit = browser_rss_limit_mb * MB
+        self.interval = interval
+        self._sessions = {}   # 浏览器 -> 浏览器级CDP会话
+        self._samples = {}    # 浏览器 -> (采样时间, 样本)，同一浏览器的页面共用
+        self._lock = asyncio.Lock()
+
+    def monitor(self, pool, context, page):
+        return PageMemoryMonitor(self, pool, context, page)
+
+    async def sample_browser(self, browser):
+        """返回 {'total': 进程总RSS, 'renderer': 最大的渲染进程RSS}（字节），interval 秒内重复调用返回缓存；
+        无法读取进程内存时返回 None"""
+        async with self._lock:
+            now = time.monotonic()
+            cached = self._samples.get(browser)
+            if cached and now - cached[0] < self.interval:
+                return cached[1]
+            # 已断开的浏览器不再采样
+            for stale in [b for b in self._sessions if not b.is_connected()]:
+                self._sessions.pop(stale, None)
+                self._samples.pop(stale, None)
+            session = self._sessions.get(browser)
+            if session is None:
+                session = self._sessions[browser] = await browser.new_browser_cdp_session()
+            info = await session.send("SystemInfo.getProcessInfo")
+            total = renderer = 0
+            readable = False
+            for process in info.get('processInfo', []):
+                rss = process_rss(process['id'])
+                if rss is None:
+                    continue
+                readable = True
+                total += rss
+                if process.get('type') == 'renderer':
+                    renderer = max(renderer, rss)
+            sample = {'total': total, 'renderer': renderer} if readable else None
+            self._samples[browser] = (now, sample)
+            return sample
+
+class PageMemoryMonitor:
+    """一个页面的内存采样任务，页面关闭时自动结束"""
+
+    def __init__(self, watchdog, pool, context, page):
+        self.watchdog = watchdog
+        self.pool = pool
+        self.context = context
+        self.page = page
+        self.peak_js_heap = 0
+        self.peak_browser_rss = 0
+        self.peak_renderer_rss = 0
+        self.over_budget = False   # JS堆超过预算
+        self.downgraded = False    # 已降级为只截取视口
+        self._cdp = None
+        self._task = None
+
+    async def start(self):
+        try:
+            self._cdp = await self.context.new_cdp_session(self.page)
+            await self._cdp.send("Performance.enable")
+        except Exception as e:
+            print(f"无法采样页面JS堆: {e}")
+            self._cdp = None
+        self._task = asyncio.create_task(self._run())
+        self.page.once("close", lambda _: self._task.cancel())
+        return self
+
+    async def sample(self):
+        if self._cdp:
+            metrics = await self._cdp.send("Performance.getMetrics")
+            heap = next((m['value'] for m in metrics['metrics'] if m['name'] == 'JSHeapUsedSize'), 0)
+            self.peak_js_heap = max(self.peak_js_heap, heap)
+            if heap > self.watchdog.page_heap_budget and not self.over_budget:
+                self.over_budget = True
+                print(f"页面JS堆 {heap / MB:.0f}MB 超出预算 {self.watchdog.page_heap_budget / MB:.0f}MB")
+        browser = self.context.browser
+        if browser is None:
+            return
+        sample = await self.watchdog.sample_browser(browser)
+        if sample:
+            self.peak_browser_rss = max(self.peak_browser_rss, sample['total'])
+            self.peak_renderer_rss = max(self.peak_renderer_rss, sample['renderer'])
+            if sample['total'] > self.watchdog.browser_rss_limit:
+                self.pool.recycle(browser)
+
+    async def stop(self):
+        """截图完成后再采样一次并结束采样任务"""
+        try:
+            await self.sample()
+        except Exception:
+            pass
+        self._task.cancel()
+
+    async def _run(self):
+        while not self.page.is_closed():
+            try:
+                await self.sample()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # 页面或浏览器已关闭时采样失败，等待下一轮或任务取消
+                pass
+            await asyncio.sleep(self.watchdog.interval)
+
+    def as_dict(self):
+        """内存峰值（MB）以及是否降级；渲染进程和浏览器的值是页面打开期间整个浏览器的峰值"""
+        return {
+            'js_heap_peak_mb': round(self.peak_js_heap / MB, 1),
+            'renderer_rss_peak_mb': round(self.peak_renderer_rss / MB, 1),
+            'browser_rss_peak_mb': round(self.peak_browser_rss / MB, 1),
+            'downgraded': self.downgraded,
+        }
+
+    @staticmethod
+    def merge(monitors):
+        """合并多个页面（多组规格）的峰值"""
+        merged = {}
+        for monitor in monitors:
+            for key, value in monitor.as_dict().items():
+                merged[key] = max(merged.get(key, value), value)
+        return merged
+
+@dataclass
+class CaptureSettings:
+    """一次运行中所有截图共用的配置"""
+    settle_budget_ms: int = 15000  # 等待页面稳定的总预算
+    settle_quiet_ms: int = 500     # 各项信号需要保持安静的时长
+    session_cache: object = None   # SessionCache，为None时每次都重新登录
+    profiles: list = None          # CaptureProfile列表，默认只截desktop
+    encoder: object = None         # ImageEncoder，负责编码和写盘
+    request_filter: object = None  # RequestFilter，为None时不拦截任何请求
+    network_archive: object = None # NetworkArchive，录制或回放网络请求
+    tiled: str = "auto"            # 分块截图: auto（超过 tile_threshold 时）、always、never
+    tile_height: int = 4096        # 每个分块的高度（CSS像素）
+    tile_threshold: int = 16384    # auto 模式下启用分块截图的页面高度
+    max_page_height: int = 0       # 整页截图的最大高度，0表示不限制
+    scroll_budget_ms: int = 20000  # 滚动加载的时间上限
+    scroll_max_distance: int = 60000  # 滚动加载的距离上限（CSS像素）
+    popup_rules: object = None     # PopupRuleCache，按域名记住关闭弹窗的规则
+    popup_suppressor: object = None  # PopupSuppressor，首次绘制前隐藏已知弹窗
+    memory_watchdog: object = None   # MemoryWatchdog，为None时不采样内存
+    network_profile_top: int = 0     # 记录每个请求并在截图旁写出 .network.json，列出前N个最慢/最大的请求；0表示不记录
+    virtual_time_budget_ms: int = 0  # 虚拟时间模式下每次等待稳定前快进的页面时间，0表示不使用虚拟时间
+    virtual_time_wall_ms: int = 2000  # 每次快进最多等待的实际时间（有请求一直未完成时页面时间不走）
+    animation_playback_rate: float = 100  # 虚拟时间模式下CSS动画和过渡的播放倍速
+
+    def __post_init__(self):
+        if not self.profiles:
+            self.profiles = [BUILTIN_PROFILES['desktop']]
+        if self.encoder is None:
+            self.encoder = ImageEncoder()
+
+# 内置拦截的第三方域名：统计分析、广告、会话录制和在线客服组件，它们不影响页面外观却经常拖慢加载。
+# 公司官网和脚本/上报服务共用一个域名时只列出脚本和上报用的子域名，截图这些公司自己的网站时不受影响
+DEFAULT_BLOCKED_DOMAINS = [
+    "google-analytics.com", "googletagmanager.com", "analytics.google.com", "doubleclick.net",
+    "googlesyndication.com", "googleadservices.com", "connect.facebook.net", "facebook.com/tr",
+    "static.hotjar.com", "script.hotjar.com", "hotjar.io", "clarity.ms", "edge.fullstory.com", "rs.fullstory.com",
+    "cdn.mouseflow.com", "cdn.logrocket.io", "cdn.segment.com", "api.segment.io", "cdn.mxpnl.com",
+    "api-js.mixpanel.com", "cdn.amplitude.com", "api2.amplitude.com", "heapanalytics.com",
+    "widget.intercom.io", "api-iam.intercom.io", "intercomcdn.com", "client.crisp.chat", "js.driftt.com",
+    "embed.tawk.to", "static.zdassets.com", "hs-analytics.net", "hs-scripts.com", "track.hubspot.com",
+    "i.posthog.com", "plausible.io/js", "plausible.io/api/event", "browser.sentry-cdn.com", "ingest.sentry.io",
+    "sessions.bugsnag.com", "notify.bugsnag.com", "js-agent.newrelic.com", "nr-data.net",
+]
+
+# 内置的长连接URL模式：这些请求放行，但不参与网络空闲判断
+DEFAULT_IDLE_IGNORE_PATTERNS = [
+    "*/socket.io/*", "*/sockjs/*", "*/longpoll*", "*/long-poll*",
+    "*firestore.googleapis.com/*/Listen/*", "*/realtime/*", "*/subscribe*",
+]
+
+class RequestFilter:
+    """基于 context.route 的请求过滤层：按域名、资源类型或URL模式拦截请求，并按页面计数。
+    另有一组只从网络空闲判断中排除、但仍然放行的长连接模式"""
+
+    def __init__(self, domains=(), resource_types=(), patterns=(), idle_ignore_patterns=()):
+        self.domains = set()
+        self.domain_paths = []   # 带路径的域名规则，如 facebook.com/tr -> ('facebook.com', '/tr')
+        for domain in domains:
+            domain, slash, path = domain.strip().lower().partition("/")
+            if domain and slash:
+                self.domain_paths.append((domain, "/" + path))
+            elif domain:
+                self.domains.add(domain)
+        self.resource_types = {t.strip().lower() for t in resource_types if t.strip()}
+        self.patterns = [p for p in patterns if p]
+        self.idle_ignore_patterns = [p for p in idle_ignore_patterns if p]
+
+    @classmethod
+    def from_options(cls, use_defaults=True, domains=(), resource_types=(), patterns=(), blocklist_file=None):
+        """合并内置规则、命令行规则和规则文件。
+        规则文件每行一条: domain:x.com、type:media、pattern:*/ads/*、ignore:*/poll*，不带前缀的行视为域名"""
+        domains, resource_types, patterns = list(domains), list(resource_types), list(patterns)
+        idle_ignore = list(DEFAULT_IDLE_IGNORE_PATTERNS)
+        if use_defaults:
+            domains += DEFAULT_BLOCKED_DOMAINS
+        if blocklist_file:
+            targets = {'domain': domains, 'type': resource_types, 'pattern': patterns, 'ignore': idle_ignore}
+            with open(blocklist_file, encoding="utf-8") as f:
+                for line in f:
+                    line = line.split("#", 1)[0].strip()
+                    if not line:
+                        continue
+                    kind, sep, value = line.partition(":")
+                    if sep and kind in targets:
+                        targets[kind].append(value.strip())
+                    else:
+                        domains.append(line)
+        return cls(domains, resource_types, patterns, idle_ignore)
+
+    @staticmethod
+    def _host_matches(host, domain):
+        return host == domain or host.endswith("." + domain)
+
+    def _match_domain(self, url):
+        parsed = urlparse(url)
+        host = (parsed.hostname or "").lower()
+        parts = host.split(".")
+        # 逐级检查父域名，集合查找与规则数量无关
+        if any(".".join(parts[i:]) in self.domains for i in range(len(parts) - 1)):
+            return True
+        path = parsed.path.lower()
+        return any(self._host_matches(host, domain) and path.startswith(prefix)
+                   for domain, prefix in self.domain_paths)
+
+    @staticmethod
+    def _page_site(request):
+        """发出请求的页面所属的站点（get_host_key），无法确定时返回None"""
+        try:
+            return get_host_key(request.frame.page.url)
+        except Exception:
+            # Service Worker 发出的请求没有所属的 frame
+            return None
+
+    def block_reason(self, request):
+        """返回拦截原因（'domain'/'type'/'pattern'），放行时返回None。
+        与页面同一站点的请求不按域名拦截：截图 hubspot.com 时不会拦掉它自己的资源"""
+        # 页面本身的文档请求永远放行
+        if request.resource_type == "document" and request.frame.parent_frame is None:
+            return None
+        if request.resource_type in self.resource_types:
+            return 'type'
+        url = request.url
+        if self._match_domain(url) and get_host_key(url) != self._page_site(request):
+            return 'domain'
+        if any(fnmatch.fnmatchcase(url, pattern) for pattern in self.patterns):
+            return 'pattern'
+        return None
+
+    def ignored_for_idle(self, request):
+        """该请求是否不参与网络空闲判断（被拦截的请求或长连接）"""
+        if self.block_reason(request):
+            return True
+        return any(fnmatch.fnmatchcase(request.url, pattern) for pattern in self.idle_ignore_patterns)
+
+    async def attach(self, context):
+        """在上下文上注册路由，返回该上下文中被拦截请求的计数（按原因和资源类型）"""
+        blocked = Counter()
+
+        async def handle(route, request):
+            reason = self.block_reason(request)
+            if reason is None:
+                await route.fallback()
+                return
+            blocked[f"{reason}:{request.resource_type}"] += 1
+            await route.abort("blockedbyclient")
+
+        await context.route("**/*", handle)
+        return blocked
+
+class NetworkTracker:
+    """跟踪页面上进行中的网络请求，用于判断网络是否已空闲。
+    只统计被 request_filter 放行、且不是长连接的请求"""
+
+    # 长连接类请求不会结束，不参与空闲判断
+    IGNORED_RESOURCE_TYPES = {'websocket', 'eventsource'}
+
+    def __init__(self, page, request_filter=None):
+        self.request_filter = request_filter
+        self._inflight = set()
+        self._last_activity = time.monotonic()
+        page.on("request", self._on_request)
+        page.on("requestfinished", self._on_request_done)
+        page.on("requestfailed", self._on_request_done)
+
+    def counts_for_idle(self, request):
+        """该请求是否参与网络空闲判断"""
+        if request.resource_type in self.IGNORED_RESOURCE_TYPES:
+            return False
+        return self.request_filter is None or not self.request_filter.ignored_for_idle(request)
+
+    def _on_request(self, request):
+        if not self.counts_for_idle(request):
+            return
+        self._inflight.add(request)
+        self._last_activity = time.monotonic()
+
+    def _on_request_done(self, request):
+        if request in self._inflight:
+            self._inflight.discard(request)
+            self._last_activity = time.monotonic()
+
+    @property
+    def inflight(self):
+        return len(self._inflight)
+
+    def idle_ms(self):
+        """网络已经空闲了多少毫秒（有进行中的请求时为0）"""
+        if self._inflight:
+            return 0
+        return (time.monotonic() - self._last_activity) * 1000
+
+def request_phases(timing):
+    """把 request.timing（相对 startTime 的毫秒数，不可用为-1）换算成各阶段耗时"""
+    def span(begin, end):
+        begin, end = timing.get(begin, -1), timing.get(end, -1)
+        return round(end - begin, 1) if begin >= 0 and end >= begin else None
+
+    phases = {
+        'dns': span('domainLookupStart', 'domainLookupEnd'),
+        'connect': span('connectStart', 'connectEnd'),
+        'tls': span('secureConnectionStart', 'connectEnd'),
+        'wait': span('requestStart', 'responseStart'),
+        'download': span('responseStart', 'responseEnd'),
+    }
+    return {name: ms for name, ms in phases.items() if ms}
+
+class NetworkProfiler:
+    """记录页面发出的每个请求：URL、资源类型、状态码、字节数、各阶段耗时，
+    以及它在等待页面稳定期间一直未完成、拖住网络空闲判断的时长（blocked_idle_ms）。
+    被 request_filter 拦截的请求不记录（已计入 blocked_requests）"""
+
+    # 单条记录中URL的最大长度，避免 data: 之类的长URL撑大汇总文件
+    MAX_URL_LENGTH = 200
+
+    def __init__(self, request_filter=None, top=10):
+        self.request_filter = request_filter
+        self.top = top
+        self.entries = []
+        self._open = {}           # request -> 记录
+        self._tasks = set()
+        self._waits = []          # 等待页面稳定的时间段 [(开始, 结束), ...]
+        self._wait_started = None
+
+    def attach(self, page, network):
+        """开始记录一个页面的请求；network 为该页面的 NetworkTracker，用于判断请求是否参与空闲判断"""
+        page.on("request", lambda request: self._on_request(request, network))
+        page.on("requestfinished", lambda request: self._on_done(request, None))
+        page.on("requestfailed", lambda request: self._on_done(request, request.failure or "failed"))
+
+    def _on_request(self, request, network):
+        if self.request_filter is not None and self.request_filter.block_reason(request):
+            return
+        self._open[request] = {
+            'url': request.url[:self.MAX_URL_LENGTH],
+            'host': (urlparse(request.url).hostname or "").lower(),
+            'type': request.resource_type,
+            'status': None,
+            'bytes': 0,
+            'ms': None,
+            'phases': {},
+            'idle': network.counts_for_idle(request),
+            'started': time.monotonic(),
+            'ended': None,
+        }
+
+    def _on_done(self, request, failure):
+        entry = self._open.pop(request, None)
+        if entry is None:
+            return
+        entry['ended'] = time.monotonic()
+        if failure:
+            entry['failure'] = failure
+        self.entries.append(entry)
+        # 状态码和字节数需要再向浏览器查询，放到后台完成
+        task = asyncio.ensure_future(self._fill(entry, request))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _fill(self, entry, request):
+        timing = request.timing
+        phases = request_phases(timing)
+        if timing.get('responseEnd', -1) >= 0:
+            entry['ms'] = round(timing['responseEnd'], 1)
+        entry['phases'] = phases
+        if entry.get('failure'):
+            return
+        try:
+            response = await request.response()
+            entry['status'] = response.status if response else None
+            sizes = await request.sizes()
+            entry['bytes'] = sizes['responseBodySize'] + sizes['responseHeadersSize']
+        except Exception:
+            # 页面已关闭等情况下取不到，只保留时间信息
+            pass
+
+    @contextmanager
+    def waiting(self):
+        """标记一段等待页面稳定的时间，这段时间里未完成的请求计入 blocked_idle_ms"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._waits.append((started, time.monotonic()))
+
+    async def flush(self):
+        """等待后台查询完成；在页面关闭前调用"""
+        if self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    def _blocked_ms(self, entry, now):
+        if not entry['idle']:
+            return 0
+        started, ended = entry['started'], entry['ended'] or now
+        overlap = sum(max(0.0, min(ended, wait_end) - max(started, wait_start))
+                      for wait_start, wait_end in self._waits)
+        return round(overlap * 1000)
+
+    def summary(self, url):
+        """本页所有请求的汇总：按资源类型和主机统计，以及最慢、最大、最拖累空闲判断的前N个请求"""
+        now = time.monotonic()
+        rows = []
+        # 截图时仍未完成的请求也要记录，它们往往就是问题所在
+        for entry in self.entries + [dict(entry, pending=True) for entry in self._open.values()]:
+            ms = entry['ms']
+            if ms is None:
+                ms = round(((entry['ended'] or now) - entry['started']) * 1000, 1)
+            row = {key: entry[key] for key in ('url', 'host', 'type', 'status', 'bytes', 'phases')}
+            row['ms'] = ms
+            row['blocked_idle_ms'] = self._blocked_ms(entry, now)
+            for key in ('failure', 'pending'):
+                if entry.get(key):
+                    row[key] = entry[key]
+            rows.append(row)
+
+        by_type, hosts = {}, {}
+        for row in rows:
+            stats = by_type.setdefault(row['type'], {'requests': 0, 'bytes': 0})
+            stats['requests'] += 1
+            stats['bytes'] += row['bytes']
+            stats = hosts.setdefault(row['host'], {'requests': 0, 'bytes': 0, 'ms': 0.0, 'failed': 0,
+                                                   'blocked_idle_ms': 0})
+            stats['requests'] += 1
+            stats['bytes'] += row['bytes']
+            stats['ms'] = round(stats['ms'] + row['ms'], 1)
+            stats['failed'] += 'failure' in row
+            stats['blocked_idle_ms'] += row['blocked_idle_ms']
+
+        def top(key):
+            return [row for row in sorted(rows, key=lambda row: -row[key]) if row[key]][:self.top]
+
+        return {
+            'url': url,
+            'requests': len(rows),
+            'bytes': sum(row['bytes'] for row in rows),
+            'failed': sum('failure' in row for row in rows),
+            'blocked_idle_ms': sum(row['blocked_idle_ms'] for row in rows),
+            'by_type': by_type,
+            'hosts': hosts,
+            'slowest': top('ms'),
+            'largest': top('bytes'),
+            'blocking': top('blocked_idle_ms'),
+        }
+
+# 页面内的稳定性探针：首次调用时安装 MutationObserver，之后每次调用返回当前各项信号
+SETTLE_PROBE_SCRIPT = """
+() => {
+    const state = window.__settleState || (window.__settleState = (() => {
+        const s = { lastMutation: performance.now(), mutations: 0, backgrounds: new Map(), scanned: new WeakSet() };
+        new MutationObserver(() => { s.lastMutation = performance.now(); s.mutations++; })
+            .observe(document.documentElement, {
+                childList: true, subtree: true, characterData: true,
+                attributes: true, attributeFilter: ['src', 'srcset', 'hidden']
+            });
+        return s;
+    })());
+
+    // 只检查新出现的元素的CSS背景图，并在页面内预加载以得知其是否完成
+    for (const el of document.querySelectorAll('*')) {
+        if (state.scanned.has(el)) continue;
+        state.scanned.add(el);
+        const bg = getComputedStyle(el).backgroundImage;
+        if (!bg || bg === 'none') continue;
+        for (const match of bg.matchAll(/url\\(["']?([^"')]+)["']?\\)/g)) {
+            const src = match[1];
+            if (src.startsWith('data:') || state.backgrounds.has(src)) continue;
+            state.backgrounds.set(src, false);
+            const img = new Image();
+            img.onload = img.onerror = () => state.backgrounds.set(src, true);
+            img.src = src;
+        }
+    }
+
+    // 只统计视口附近未加载完成的图片，懒加载的远处图片不会开始加载
+    const viewHeight = window.innerHeight;
+    let pendingImages = 0;
+    for (const img of document.images) {
+        if (img.complete || !img.currentSrc && !img.src) continue;
+        const rect = img.getBoundingClientRect();
+        if (rect.bottom > -viewHeight && rect.top < viewHeight * 2) pendingImages++;
+    }
+
+    let pendingBackgrounds = 0;
+    for (const done of state.backgrounds.values()) if (!done) pendingBackgrounds++;
+
+    return {
+        sinceMutation: performance.now() - state.lastMutation,
+        mutations: state.mutations,
+        fontsReady: !document.fonts || document.fonts.status === 'loaded',
+        pendingImages: pendingImages,
+        pendingBackgrounds: pendingBackgrounds,
+        height: Math.max(document.documentElement.scrollHeight, document.body ? document.body.scrollHeight : 0)
+    };
+}
+"""
+
+@dataclass
+class SettleResult:
+    """一次等待页面稳定的结果"""
+    settled: bool
+    elapsed_ms: float
+    signals: list   # 稳定前最后等待的信号，或超时时仍未满足的信号
+    height: int = 0
+
+    def __str__(self):
+        waited = ", ".join(self.signals) or "无"
+        if self.settled:
+            return f"页面已稳定，用时 {self.elapsed_ms:.0f}ms (最后等待: {waited})"
+        return f"等待页面稳定超时，用时 {self.elapsed_ms:.0f}ms (未满足: {waited})"
+
+async def wait_for_page_settled(page, network=None, budget_ms=15000, quiet_ms=500, poll_ms=100):
+    """等待页面真正稳定：网络空闲、DOM不再变化、字体和图片加载完成、页面高度不再变化。
+    所有信号同时满足时立即返回，超出总预算时返回仍未满足的信号"""
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    height = None
+    height_since = start
+    mutations = None
+    mutation_since = start
+    last_unmet = []
+    while True:
+        now = loop.time()
+        elapsed_ms = (now - start) * 1000
+        try:
+            probe = await page.evaluate(SETTLE_PROBE_SCRIPT)
+        except Exception:
+            # 页面正在跳转，执行上下文被销毁
+            probe = None
+
+        if probe is None:
+            unmet = ['page']
+        else:
+            if probe['height'] != height:
+                height, height_since = probe['height'], now
+            if probe['mutations'] != mutations:
+                mutations, mutation_since = probe['mutations'], now
+            unmet = []
+            if network is not None and network.idle_ms() < quiet_ms:
+                unmet.append('network')
+            # 页面内的 performance.now() 在虚拟时间暂停时不走，所以也按实际时间看变更计数是否保持不变
+            if probe['sinceMutation'] < quiet_ms and (now - mutation_since) * 1000 < quiet_ms:
+                unmet.append('dom')
+            if not probe['fontsReady']:
+                unmet.append('fonts')
+            if probe['pendingImages']:
+                unmet.append('images')
+            if probe['pendingBackgrounds']:
+                unmet.append('backgrounds')
+            if (now - height_since) * 1000 < quiet_ms:
+                unmet.append('layout')
+
+        if not unmet:
+            return SettleResult(True, elapsed_ms, last_unmet, height or 0)
+        if elapsed_ms >= budget_ms:
+            return SettleResult(False, elapsed_ms, unmet, height or 0)
+        last_unmet = unmet
+        await asyncio.sleep(poll_ms / 1000)
+
+# 页面内的滚动探针：按 delta 滚动后等两帧（让 IntersectionObserver 回调先执行），
+# 返回滚动位置、页面高度，以及视口附近还没加载完的图片数量
+SCROLL_PROBE_SCRIPT = """
+async (delta) => {
+    if (delta) window.scrollBy(0, delta);
+    await new Promise(resolve => requestAnimationFrame(() => requestAnimationFrame(resolve)));
+    const viewHeight = window.innerHeight;
+    let pendingImages = 0;
+    for (const img of document.images) {
+        if (img.complete || !img.currentSrc && !img.src) continue;
+        const rect = img.getBoundingClientRect();
+        if (rect.bottom > -viewHeight && rect.top < viewHeight * 2) pendingImages++;
+    }
+    return {
+        y: window.scrollY,
+        view: viewHeight,
+        height: Math.max(document.documentElement.scrollHeight, document.body ? document.body.scrollHeight : 0),
+        pendingImages: pendingImages
+    };
+}
+"""
+
+@dataclass
+class ScrollResult:
+    """一次滚动加载的结果"""
+    reason: str        # bottom（到底且高度稳定）、time（超出时间预算）、distance（超出滚动距离上限）、memory（页面内存超出预算）
+    steps: int
+    distance: int
+    elapsed_ms: float
+    height: int
+    grown: int = 0     # 滚动过程中页面增高的像素数
+
+    def __str__(self):
+        ended = {'bottom': "已到底部且高度稳定", 'time': "达到时间上限", 'distance': "达到距离上限",
+                 'memory': "因页面内存超出预算而停止"}[self.reason]
+        return (f"滚动加载{ended}: {self.steps} 步, 滚动 {self.distance}px, 用时 {self.elapsed_ms:.0f}ms, "
+                f"页面高度 {self.height}px (新增 {self.grown}px)")
+
+async def scroll_until_stable(page, network=None, budget_ms=20000, max_distance=60000, stable_ms=500,
+                              step_wait_ms=1000, poll_ms=100, stop=None):
+    """逐屏向下滚动触发懒加载：每一步等视口附近的图片加载完（最多 step_wait_ms），
+    滚到底部后页面高度保持 stable_ms 不变即结束；页面继续增高时接着滚动。
+    总时间不超过 budget_ms，总滚动距离不超过 max_distance；stop() 返回True时立即停止"""
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    probe = await page.evaluate(SCROLL_PROBE_SCRIPT, 0)
+    initial_height = height = probe['height']
+    steps = distance = 0
+    bottom_since = None
+    stuck = False   # 滚动不再改变位置（例如 body 设置了 overflow: hidden）
+
+    def result(reason):
+        return ScrollResult(reason, steps, distance, (loop.time() - start) * 1000, height, height - initial_height)
+
+    while True:
+        now = loop.time()
+        if (now - start) * 1000 >= budget_ms:
+            return result('time')
+        if stop and stop():
+            return result('memory')
+
+        if probe['height'] != height:
+            # 页面增高（懒加载内容插入），到底计时重新开始
+            height, bottom_since, stuck = probe['height'], None, False
+        if stuck or probe['y'] + probe['view'] >= height - 2:
+            if bottom_since is None:
+                bottom_since = now
+            elif (now - bottom_since) * 1000 >= stable_ms:
+                return result('bottom')
+            await asyncio.sleep(poll_ms / 1000)
+            probe = await page.evaluate(SCROLL_PROBE_SCRIPT, 0)
+            continue
+
+        if distance >= max_distance:
+            return result('distance')
+        delta = min(int(probe['view'] * 0.8) or 800, max_distance - distance)
+        last_y = probe['y']
+        probe = await page.evaluate(SCROLL_PROBE_SCRIPT, delta)
+        stuck = probe['y'] <= last_y
+        steps += 1
+        distance += delta
+
+        # 等新进入视口的图片加载完成，网络短暂空闲即可继续，不等待完整的稳定判断
+        step_start = loop.time()
+        while probe['pendingImages'] or (network is not None and network.idle_ms() < poll_ms):
+            if (loop.time() - step_start) * 1000 >= step_wait_ms:
+                break
+            await asyncio.sleep(poll_ms / 1000)
+            probe = await page.evaluate(SCROLL_PROBE_SCRIPT, 0)
+
+class VirtualClock:
+    """用CDP虚拟时间快进页面，定时器和动画不必真的等待。
+    run(budget_ms) 让页面时间确定地前进 budget_ms（有请求在进行时暂停计时），通常只需很少的实际时间，
+    之后页面时间保持暂停：检查页面是否稳定和截图时，定时器驱动的轮播等不会再变化。
+    导航、登录、关闭弹窗和滚动放在 running() 中，期间使用 advance 策略（空闲时跳到下一个定时器）：
+    点击前的可操作性检查和滚动探针依赖 requestAnimationFrame，页面时间暂停时可能一直等不到。
+    Animation.setPlaybackRate 加速由合成线程驱动、不受虚拟时间控制的CSS动画和过渡"""
+
+    def __init__(self, context, page, playback_rate=100, max_wall_ms=2000):
+        self.context = context
+        self.page = page
+        self.playback_rate = playback_rate
+        self.max_wall_ms = max_wall_ms
+        self._cdp = None
+        self._expired = None
+
+    def _on_expired(self, _):
+        if self._expired is not None:
+            self._expired.set()
+
+    async def start(self):
+        """在导航之前调用；策略在下一次导航开始时生效"""
+        self._cdp = await self.context.new_cdp_session(self.page)
+        self._cdp.on("Emulation.virtualTimeBudgetExpired", self._on_expired)
+        await self._cdp.send("Animation.enable")
+        await self._cdp.send("Animation.setPlaybackRate", {'playbackRate': self.playback_rate})
+        await self._cdp.send("Emulation.setVirtualTimePolicy", {'policy': 'advance', 'waitForNavigation': True})
+        return self
+
+    async def run(self, budget_ms, max_wall_ms=None):
+        """让页面时间前进 budget_ms 毫秒后暂停，返回实际用时（毫秒）。
+        有请求一直未完成（例如长轮询）时计时会暂停，实际用时超过 max_wall_ms（默认 self.max_wall_ms）后不再等待"""
+        if max_wall_ms is None:
+            max_wall_ms = self.max_wall_ms
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        self._expired = asyncio.Event()
+        try:
+            # 跨站导航（例如登录跳转）后换了渲染进程，播放倍速需要重新设置
+            await self._cdp.send("Animation.setPlaybackRate", {'playbackRate': self.playback_rate})
+            await self._cdp.send("Emulation.setVirtualTimePolicy",
+                                 {'policy': 'pauseIfNetworkFetchesPending', 'budget': budget_ms})
+            try:
+                await asyncio.wait_for(self._expired.wait(), max_wall_ms / 1000)
+            except asyncio.TimeoutError:
+                print(f"虚拟时间在 {max_wall_ms:.0f}ms 内没有走完 {budget_ms}ms（有请求一直未完成），继续")
+        finally:
+            self._expired = None
+            await self._cdp.send("Emulation.setVirtualTimePolicy", {'policy': 'pause'})
+        return (loop.time() - start) * 1000
+
+    @asynccontextmanager
+    async def running(self):
+        """在这段操作期间让页面时间继续前进，结束后重新暂停"""
+        await self._cdp.send("Emulation.setVirtualTimePolicy", {'policy': 'advance'})
+        try:
+            yield
+        finally:
+            await self._cdp.send("Emulation.setVirtualTimePolicy", {'policy': 'pause'})
+
+@asynccontextmanager
+async def page_time_running(clock):
+    """虚拟时间模式下让页面时间在这段操作期间继续前进；clock 为None时什么也不做"""
+    if clock is None:
+        yield
+        return
+    async with clock.running():
+        yield
+
+@dataclass
+class CaptureProfile:
+    """一种截图规格：视口大小、像素比、整页或首屏、输出格式"""
+    name: str
+    width: int = 1920
+    height: int = 1080
+    device_scale_factor: float = 1.0
+    full_page: bool = True
+    format: str = "png"      # png、jpeg 或 webp
+    is_mobile: bool = False
+    quality: int = 85        # 仅对jpeg和webp有效
+
+    @property
+    def extension(self):
+        return "jpg" if self.format == "jpeg" else self.format
+
+    def context_key(self):
+        """只能在创建上下文时设定的选项；相同的规格可以共用同一个页面"""
+        return (self.device_scale_factor, self.is_mobile)
+
+    def context_options(self):
+        return {
+            'viewport': {'width': self.width, 'height': self.height},
+            'device_scale_factor': self.device_scale_factor,
+            'is_mobile': self.is_mobile,
+            'has_touch': self.is_mobile,
+        }
+
+# 内置的截图规格；平板和手机使用相同的像素比，可以共用一次页面加载
+BUILTIN_PROFILES = {
+    'desktop': CaptureProfile('desktop'),
+    'fold': CaptureProfile('fold', full_page=False),
+    'tablet': CaptureProfile('tablet', 820, 1180, device_scale_factor=2.0, is_mobile=True),
+    'mobile': CaptureProfile('mobile', 390, 844, device_scale_factor=2.0, is_mobile=True),
+}
+
+def parse_profile(spec):
+    """解析截图规格：内置名称（如 mobile），或 名称=宽x高[@像素比][:viewport][:mobile][:png|jpeg|webp]"""
+    spec = spec.strip()
+    if "=" not in spec:
+        if spec not in BUILTIN_PROFILES:
+            raise ValueError(f"未知的截图规格: {spec}（可选: {', '.join(BUILTIN_PROFILES)}）")
+        return BUILTIN_PROFILES[spec]
+
+    name, _, rest = spec.partition("=")
+    size, *flags = rest.split(":")
+    match = re.fullmatch(r'(\d+)x(\d+)(?:@([\d.]+))?', size.strip())
+    if not match:
+        raise ValueError(f"无法解析截图规格尺寸: {spec}")
+    profile = CaptureProfile(name.strip(), int(match.group(1)), int(match.group(2)),
+                             device_scale_factor=float(match.group(3) or 1.0))
+    for flag in (f.strip().lower() for f in flags):
+        if flag == "viewport":
+            profile.full_page = False
+        elif flag == "full":
+            profile.full_page = True
+        elif flag == "mobile":
+            profile.is_mobile = True
+        elif flag in ("png", "jpeg", "jpg", "webp"):
+            profile.format = "jpeg" if flag == "jpg" else flag
+        else:
+            raise ValueError(f"未知的截图规格选项: {flag}")
+    return profile
+
+def profile_output_path(output_path, profile):
+    """每种规格的输出文件名：desktop 沿用 <site_type>.png，其他为 <site_type>.<规格名>.<扩展名>"""
+    base, _ = os.path.splitext(output_path)
+    if profile.name == "desktop":
+        return f"{base}.{profile.extension}"
+    return f"{base}.{profile.name}.{profile.extension}"
+
+def job_output_paths(output_path, profiles):
+    """一个URL在所有截图规格下的输出文件"""
+    return [profile_output_path(output_path, profile) for profile in profiles]
+
+def group_profiles(profiles):
+    """按上下文选项把规格分组，同一组的规格共用一次页面加载，只需调整视口大小"""
+    groups = {}
+    for profile in profiles:
+        groups.setdefault(profile.context_key(), []).append(profile)
+    return list(groups.values())
+
+class StageTimer:
+    """按阶段累计耗时。阶段可以嵌套，内层阶段的时间不计入外层，所以各阶段之和等于总耗时"""
+
+    def __init__(self):
+        self.durations = Counter()
+        self._stack = []
+        self._mark = 0.0
+
+    @contextmanager
+    def stage(self, name):
+        now = time.perf_counter()
+        if self._stack:
+            self.durations[self._stack[-1]] += now - self._mark
+        self._stack.append(name)
+        self._mark = now
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            self.durations[self._stack.pop()] += now - self._mark
+            self._mark = now
+
+    def as_dict(self):
+        return {name: round(seconds, 3) for name, seconds in self.durations.items()}
+
+# 失败类型及其说明
+FAILURE_LABELS = {
+    'navigation_timeout': "导航超时",
+    'http_5xx': "服务端错误(5xx)",
+    'login_failed': "登录失败",
+    'browser_crash': "浏览器崩溃",
+    'screenshot_timeout': "截图超时",
+    'archive_missing': "缺少网络存档",
+    'lease_expired': "租约多次过期",
+    'other': "其他错误",
+}
+
+class CaptureError(Exception):
+    """带失败类型的截图错误，类型见 FAILURE_LABELS"""
+
+    def __init__(self, kind, message):
+        super().__init__(message)
+        self.kind = kind
+
+def classify_failure(exc):
+    """把截图过程中的异常归类为 FAILURE_LABELS 中的一种"""
+    if isinstance(exc, CaptureError):
+        return exc.kind
+    message = str(exc).lower()
+    if any(term in message for term in ("crash", "target closed", "has been closed", "browser closed")):
+        return 'browser_crash'
+    return 'other'
+
+async def navigate(page, url, timeout):
+    """导航到URL（只等待load事件，网络空闲由稳定性检测统一判断），超时和5xx转换为 CaptureError"""
+    try:
+        response = await page.goto(url, wait_until='load', timeout=timeout)
+    except TimeoutError as e:
+        raise CaptureError('navigation_timeout', f"导航超时: {e}") from e
+    if response is not None and response.status >= 500:
+        raise CaptureError('http_5xx', f"服务端返回 HTTP {response.status}")
+    return response
+
+async def prepare_page(page, context, url, timeout, settle, scroll, login_state, timer=None, popup_rules=None,
+                       clock=None):
+    """导航到URL并完成登录、滚动加载、关闭弹窗，让页面进入可截图状态。
+    没有 clock 时注入样式关闭CSS动画和过渡；虚拟时间模式下（传入 VirtualClock）动画被快进，不需要关闭，
+    页面时间只在导航和交互期间前进，检查稳定和截图时保持暂停"""
+    origin, session_cache, started_version = login_state
+    if timer is None:
+        timer = StageTimer()
+
+    async def load():
+        with timer.stage('goto'):
+            async with page_time_running(clock):
+                await navigate(page, url, timeout)
+        if clock is None:
+            print("应用增强截图处理方式...")
+            # 禁用CSS动画和过渡效果；不能覆盖 transform，很多布局（居中、轮播）依赖它
+            await page.add_style_tag(content="""
+                * {
+                    transition: none !important;
+                    animation: none !important;
+                }
+            """)
+
+    print(f"导航到URL: {url}")
+    await load()
+    
+    # 等待页面元素稳定
+    await settle()
+    
+    # 检查是否需要登录
+    with timer.stage('login'):
+        if await is_login_page(page):
+            async with page_time_running(clock):
+                login_successful = await ensure_logged_in(page, context, origin, session_cache, started_version)
+            if not login_successful:
+                raise CaptureError('login_failed', "登录失败")
+            # 总是重新加载目标页面：复用的会话只写入了cookies，当前页面仍是登录前加载的；
+            # 登录页就在目标URL上时 page.url 不变，不重新加载会把有效的会话误判为失效
+            print(f"重新访问URL: {url}")
+            await load()
+            await settle()
+            if await is_login_page(page):
+                if session_cache:
+                    session_cache.invalidate(origin)
+                raise CaptureError('login_failed', "登录后仍是登录页")
+    
+    with timer.stage('scroll'):
+        async with page_time_running(clock):
+            # 模拟正常用户行为：随机鼠标移动
+            print("模拟用户行为...")
+            viewport = page.viewport_size or {'width': 1920, 'height': 1080}
+            for _ in range(3):  # 鼠标移动次数
+                x = viewport['width'] * 0.7  # 在页面上部区域移动
+                y = viewport['height'] * 0.5  # 保持在上半部分
+                await page.mouse.move(x, y)
+                await page.wait_for_timeout(100)  # 短暂停顿
+
+            # 先关掉挡住页面的Cookie通知等弹窗
+            with timer.stage('popups'):
+                await close_popups(page, popup_rules)
+
+            # 逐屏滚动直到不再有新内容加载，触发懒加载
+            print("滚动页面加载懒加载内容...")
+            print(await scroll())
+
+            # 滚动过程中出现的弹窗
+            with timer.stage('popups'):
+                await close_popups(page, popup_rules)
+
+            # 回到顶部，从新开始观察页面加载
+            await page.evaluate('window.scrollTo(0, 0);')
+    
+    # 等待关键内容显示
+    with timer.stage('content_wait'):
+        async with page_time_running(clock):
+            try:
+                # 等待页面主标题或主要内容元素出现
+                await page.wait_for_selector('h1, .main-title, .hero-title, [class*="title"], [class*="heading"]', 
+                                           timeout=10000, state='visible')
+                print("找到页面标题元素")
+            
+                # 尝试获取更多可能的关键内容
+                await page.wait_for_selector('p, .description, article, [class*="content"]', 
+                                           timeout=8000, state='visible')
+                print("找到页面内容元素")
+            except Exception as e:
+                print(f"等待内容元素时出错: {e}")
+    
+    # 最后等待网络、DOM、字体和图片全部稳定，替代固定的等待时间
+    print("最终等待，确保页面完全加载...")
+    await settle()
+
+# WebP 格式支持的最大边长
+WEBP_MAX_DIMENSION = 16383
+
+def save_image_atomic(image, path, fmt, quality=85, png_optimize=False):
+    """用Pillow按指定格式保存图片（原子写入）"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    if fmt == "webp":
+        if max(image.size) > WEBP_MAX_DIMENSION:
+            raise ValueError(f"图片尺寸 {image.size} 超过WebP上限 {WEBP_MAX_DIMENSION}px，请改用jpeg或限制页面高度")
+        image.save(tmp_path, "WEBP", quality=quality, method=4)
+    elif fmt == "jpeg":
+        image.convert("RGB").save(tmp_path, "JPEG", quality=quality, optimize=True)
+    else:
+        image.save(tmp_path, "PNG", optimize=png_optimize)
+    os.replace(tmp_path, path)
+
+def encode_image(data, path, fmt, quality=85, thumbnail_width=0, png_optimize=False):
+    """在进程池中运行：把浏览器返回的截图编码为目标格式写入磁盘，可选生成缩略图。
+    返回 [(文件路径, 字节数), ...]"""
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    written = []
+    if fmt == "webp" or (fmt == "png" and png_optimize):
+        save_image_atomic(image, path, fmt, quality, png_optimize)
+    else:
+        # 浏览器已经输出了目标格式（png或jpeg），直接写入
+        write_file_atomic(path, data)
+    written.append((path, os.path.getsize(path)))
+
+    if thumbnail_width and image.width > thumbnail_width:
+        base, ext = os.path.splitext(path)
+        thumb_path = f"{base}.thumb{ext}"
+        height = max(1, round(image.height * thumbnail_width / image.width))
+        thumb = image.resize((thumbnail_width, height), Image.LANCZOS)
+        save_image_atomic(thumb, thumb_path, fmt, quality, png_optimize)
+        written.append((thumb_path, os.path.getsize(thumb_path)))
+    return written
+
+class ImageEncoder:
+    """截图编码/写盘管道：CPU密集的编码交给进程池，简单写盘交给线程，事件循环不会被阻塞。
+    同时进行中的编码任务数量受 max_pending 限制，浏览器截图速度超过编码速度时 submit() 会等待"""
+
+    def __init__(self, workers=2, max_pending=None, thumbnail_width=0, png_optimize=False):
+        self.workers = max(1, workers)
+        self.thumbnail_width = thumbnail_width
+        self.png_optimize = png_optimize
+        self._slots = asyncio.Semaphore(max_pending or self.workers * 2)
+        self._executor = None
+
+    def needs_pillow(self, fmt):
+        return fmt == "webp" or bool(self.thumbnail_width) or (fmt == "png" and self.png_optimize)
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    async def _encode(self, data, path, fmt, quality):
+        if not self.needs_pillow(fmt):
+            await asyncio.to_thread(write_file_atomic, path, data)
+            return [(path, len(data))]
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._get_executor(), encode_image, data, path, fmt, quality,
+                                          self.thumbnail_width, self.png_optimize)
+
+    async def submit(self, data, path, fmt, quality=85):
+        """提交一张截图，返回后台编码任务；已有 max_pending 个任务在进行时先等待空位"""
+        await self._slots.acquire()
+        task = asyncio.create_task(self._encode(data, path, fmt, quality))
+        task.add_done_callback(lambda _: self._slots.release())
+        return task
+
+    def close(self):
+        """等待进程池中的任务结束并关闭进程池"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+async def get_content_size(page):
+    """返回页面内容的CSS像素尺寸 (宽, 高)"""
+    return tuple(await page.evaluate("""() => [
+        Math.max(document.documentElement.scrollWidth, document.body ? document.body.scrollWidth : 0),
+        Math.max(document.documentElement.scrollHeight, document.body ? document.body.scrollHeight : 0)
+    ]"""))
+
+def downscale_png(data, width):
+    """把PNG按比例缩放到指定宽度，返回PNG数据（分块截图逐块生成缩略图用）"""
+    image = Image.open(io.BytesIO(data))
+    height = max(1, round(image.height * width / image.width))
+    out = io.BytesIO()
+    # 缩略图写入时还会重新压缩，这里用最快的压缩级别
+    image.resize((width, height), Image.LANCZOS).save(out, "PNG", compress_level=1)
+    return out.getvalue()
+
+async def capture_tiled(page, path, width, height, tile_height=4096, timeout=60000, thumbnail_width=0,
+                        png_optimize=False):
+    """用CDP Page.captureScreenshot 按固定高度分块截取整页，并流式拼接写入PNG。
+    缩略图由逐块缩小的分块同样流式拼接，不需要把整张长图载入内存；png_optimize 时使用最高压缩级别。
+    返回 [(文件路径, 字节数), ...]"""
+    cdp = await page.context.new_cdp_session(page)
+    compress_level = 9 if png_optimize else 6
+    writer = TiledPngWriter(path, compress_level)
+    thumb_writer = None
+    if thumbnail_width and width > thumbnail_width:
+        base, ext = os.path.splitext(path)
+        thumb_writer = TiledPngWriter(f"{base}.thumb{ext}", compress_level)
+
+    def append(tile):
+        writer.append(tile)
+        if thumb_writer:
+            thumb_writer.append(downscale_png(tile, thumbnail_width))
+
+    try:
+        for top in range(0, height, tile_height):
+            clip = {'x': 0, 'y': top, 'width': width, 'height': min(tile_height, height - top), 'scale': 1}
+            result = await asyncio.wait_for(
+                cdp.send('Page.captureScreenshot', {'format': 'png', 'clip': clip, 'captureBeyondViewport': True}),
+                timeout / 1000)
+            tile = base64.b64decode(result['data'])
+            # 解压和重新压缩放到线程里，不阻塞事件循环
+            await asyncio.to_thread(append, tile)
+        written = [(path, await asyncio.to_thread(writer.close))]
+        if thumb_writer:
+            written.append((thumb_writer.path, await asyncio.to_thread(thumb_writer.close)))
+        return written
+    except BaseException:
+        writer.abort()
+        if thumb_writer:
+            thumb_writer.abort()
+        raise
+    finally:
+        await cdp.detach()
+
+async def capture_profile(page, profile, path, settings):
+    """按规格截取当前页面到内存，再交给编码管道写盘，返回编码任务。
+    超高页面按 settings.max_page_height 截断，并在需要时改用分块截图"""
+    options = {'full_page': profile.full_page, 'timeout': 60000}
+    if profile.full_page:
+        width, height = await get_content_size(page)
+        if settings.max_page_height and height > settings.max_page_height:
+            print(f"页面高度 {height}px 超过上限，截断为 {settings.max_page_height}px")
+            height = settings.max_page_height
+            options['clip'] = {'x': 0, 'y': 0, 'width': width, 'height': height}
+        use_tiles = settings.tiled == "always" or (settings.tiled == "auto" and height > settings.tile_threshold)
+        if use_tiles and profile.format == "png":
+            print(f"分块截图: {width}x{height}px，每块 {settings.tile_height}px")
+            try:
+                files = await capture_tiled(page, path, width, height, settings.tile_height,
+                                            thumbnail_width=settings.encoder.thumbnail_width,
+                                            png_optimize=settings.encoder.png_optimize)
+            except asyncio.TimeoutError as e:
+                raise CaptureError('screenshot_timeout', "分块截图超时") from e
+            written = asyncio.get_running_loop().create_future()
+            written.set_result(files)
+            return written
+        if use_tiles:
+            print(f"分块截图只支持PNG输出，{profile.format} 格式改用整页截图")
+    if profile.format == "jpeg":
+        options.update(type="jpeg", quality=profile.quality)
+    else:
+        # WebP等格式先取无损PNG，再由编码进程转换
+        options['type'] = "png"
+    try:
+        data = await page.screenshot(**options)
+    except TimeoutError as e:
+        raise CaptureError('screenshot_timeout', f"截图超时: {e}") from e
+    return await settings.encoder.submit(data, path, profile.format, profile.quality)
+
+class NetworkArchive:
+    """网络存档：record 模式把一个URL的全部响应录制为 HAR（响应内容放在zip附件中），
+    replay 模式完全通过请求路由从存档返回响应，不访问网络。
+    每个URL按上下文选项（像素比、是否移动端）各存一份，文件名由URL的哈希决定"""
+
+    INDEX_NAME = "index.jsonl"
+
+    def __init__(self, archive_dir, mode):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"未知的存档模式: {mode}")
+        self.archive_dir = archive_dir
+        self.mode = mode
+        os.makedirs(archive_dir, exist_ok=True)
+
+    def path_for(self, url, profile):
+        key = hashlib.sha1(url.encode("utf-8")).hexdigest()[:20]
+        suffix = f"{profile.device_scale_factor:g}x" + ("-mobile" if profile.is_mobile else "")
+        return os.path.join(self.archive_dir, f"{key}-{suffix}.har.zip")
+
+    async def attach(self, context, url, profile):
+        """在上下文上注册录制或回放路由；录制模式返回临时文件路径，需要在上下文关闭后 commit()"""
+        path = self.path_for(url, profile)
+        if self.mode == "replay":
+            if not os.path.exists(path):
+                raise CaptureError('archive_missing', f"没有找到 {url} 的网络存档: {path}")
+            print(f"从网络存档回放: {path}")
+            await context.route_from_har(path, not_found="abort")
+            return None
+        # HAR在上下文关闭时才写入，先写临时文件，避免中断时留下不完整的存档
+        tmp_path = path[:-len(".har.zip")] + ".recording.har.zip"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        await context.route_from_har(tmp_path, update=True, update_content="attach", update_mode="full")
+        return tmp_path
+
+    def commit(self, tmp_path, url, profile):
+        """上下文关闭后把录制好的存档移动到正式位置，并记录到索引。
+        上下文没有正常关闭时可能没有写出存档，这时只打印提示，不影响截图结果；返回是否保存了存档"""
+        path = self.path_for(url, profile)
+        if not os.path.exists(tmp_path):
+            print(f"警告: 没有生成 {url} 的网络存档（{tmp_path} 不存在），跳过保存")
+            return False
+        os.replace(tmp_path, path)
+        with open(os.path.join(self.archive_dir, self.INDEX_NAME), "a", encoding="utf-8") as f:
+            f.write(json.dumps({'url': url, 'file': os.path.basename(path), 'recorded_at': time.time()},
+                               ensure_ascii=False) + "\n")
+        print(f"网络存档已保存: {path}")
+        return True
+
+@dataclass
+class CaptureResult:
+    """一次截图的结果；可以直接当作布尔值使用"""
+    ok: bool
+    files: list = field(default_factory=list)  # [(文件路径, 字节数), ...]
+    error: str = ""
+    failure: str = ""   # 失败类型，见 FAILURE_LABELS
+    duration: float = 0.0
+    blocked_requests: int = 0
+    stages: dict = field(default_factory=dict)  # 各阶段耗时（秒），见 StageTimer
+    page_height: int = 0
+    memory: dict = field(default_factory=dict)  # 内存峰值，见 PageMemoryMonitor.as_dict()
+    network: dict = field(default_factory=dict)  # 按主机的请求统计，见 NetworkProfiler.summary()['hosts']
+
+    def __bool__(self):
+        return self.ok
+
+    @property
+    def bytes(self):
+        return sum(size for _, size in self.files)
+
+# 导航和页面操作的默认超时（毫秒）
+DEFAULT_TIMEOUT_MS = 90000
+
+async def take_screenshot(url, output_path, timeout=DEFAULT_TIMEOUT_MS, pool=None, settings=None):
+    """使用增强的Playwright方法访问URL并截图，解决网站反爬检测问题。
+    settings.profiles 中的每种规格各输出一个文件，同一组规格共用一次页面加载。返回 CaptureResult"""
+    if settings is None:
+        settings = CaptureSettings()
+    if pool is None:
+        # 未传入浏览器池时（例如被外部直接调用）临时创建一个
+        async with BrowserPool() as temp_pool:
+            return await take_screenshot(url, output_path, timeout, pool=temp_pool, settings=settings)
+
+    # 同一个源的已登录会话直接注入新上下文
+    session_cache = settings.session_cache
+    origin = get_origin(url)
+    started_version = session_cache.version(origin) if session_cache else None
+    login_state = (origin, session_cache, started_version)
+    storage_state = session_cache.get(origin) if started_version else None
+    pending_writes = []
+    blocked_requests = 0
+    start = time.monotonic()
+    timer = StageTimer()
+    page_height = 0
+    monitors = []
+    profiler = NetworkProfiler(settings.request_filter, settings.network_profile_top) \
+        if settings.network_profile_top else None
+
+    def network_hosts():
+        """写出本页的请求汇总 <文件名>.network.json，返回按主机的统计（失败的截图也写，慢的原因往往在这里）"""
+        if not profiler:
+            return {}
+        summary = profiler.summary(url)
+        path = os.path.splitext(output_path)[0] + ".network.json"
+        try:
+            write_file_atomic(path, json.dumps(summary, ensure_ascii=False, indent=1).encode("utf-8"))
+            print(f"网络请求汇总: {summary['requests']} 个请求，{summary['bytes'] / 1024:.0f} KB，"
+                  f"拖慢空闲判断 {summary['blocked_idle_ms']}ms，已写入 {path}")
+        except OSError as e:
+            print(f"写入网络请求汇总失败 ({path}): {e}")
+        return summary['hosts']
+
+    try:
+        with timer.stage('other'):
+            for group in group_profiles(settings.profiles):
+                context_options = group[0].context_options()
+                if storage_state:
+                    context_options['storage_state'] = storage_state
+                recording = None
+                async with pool.context(**context_options) as context:
+                    print(f"使用增强截图方式访问: {url} (规格: {', '.join(p.name for p in group)})")
+                    if started_version:
+                        print(f"使用缓存的登录会话: {origin}")
+                    # 后注册的路由先执行：请求过滤在前，未被拦截的请求再交给网络存档录制或回放
+                    if settings.network_archive:
+                        recording = await settings.network_archive.attach(context, url, group[0])
+                    blocked = await settings.request_filter.attach(context) if settings.request_filter else Counter()
+                    if settings.popup_suppressor:
+                        await settings.popup_suppressor.attach(context, url)
+                    page = await context.new_page()
+                    network = NetworkTracker(page, settings.request_filter)
+                    if profiler:
+                        profiler.attach(page, network)
+                    clock = None
+                    if settings.virtual_time_budget_ms:
+                        clock = await VirtualClock(context, page, settings.animation_playback_rate,
+                                                   settings.virtual_time_wall_ms).start()
+                    monitor = None
+                    if settings.memory_watchdog:
+                        monitor = await settings.memory_watchdog.monitor(pool, context, page).start()
+                        monitors.append(monitor)
+
+                    async def settle(budget_ms=settings.settle_budget_ms):
+                        nonlocal page_height
+                        budget_ms = min(budget_ms, settings.settle_budget_ms)
+                        with timer.stage('settle'):
+                            if clock:
+                                # 先快进页面时间，让延迟执行的脚本和动画走完，再检查网络、DOM和图片；
+                                # 快进用掉的实际时间从这次等待稳定的预算中扣除
+                                wall_ms = await clock.run(settings.virtual_time_budget_ms,
+                                                          min(clock.max_wall_ms, budget_ms))
+                                print(f"虚拟时间前进 {settings.virtual_time_budget_ms}ms，实际用时 {wall_ms:.0f}ms")
+                                budget_ms = max(0, budget_ms - wall_ms)
+                            with profiler.waiting() if profiler else nullcontext():
+                                result = await wait_for_page_settled(page, network, budget_ms,
+                                                                     settings.settle_quiet_ms)
+                        print(result)
+                        page_height = result.height or page_height
+                        return result
+
+                    async def scroll():
+                        # 整页截图有高度上限时，不必滚到上限以外
+                        max_distance = settings.scroll_max_distance
+                        if settings.max_page_height:
+                            max_distance = min(max_distance, settings.max_page_height)
+                        return await scroll_until_stable(page, network, settings.scroll_budget_ms, max_distance,
+                                                         settings.settle_quiet_ms,
+                                                         stop=(lambda: monitor.over_budget) if monitor else None)
+                
+                    # 设置超时
+                    page.set_default_navigation_timeout(timeout)
+                    page.set_default_timeout(timeout)
+
+                    await prepare_page(page, context, url, timeout, settle, scroll, login_state, timer, settings.popup_rules,
+                                       clock=clock)
+
+                    for profile in group:
+                        # 视口大小变化后需要重新等待布局稳定
+                        if page.viewport_size != {'width': profile.width, 'height': profile.height}:
+                            await page.set_viewport_size({'width': profile.width, 'height': profile.height})
+                            await settle()
+                        path = profile_output_path(output_path, profile)
+                        if monitor and monitor.over_budget and profile.full_page:
+                            # 内存已超出预算的页面整页截图很可能让渲染进程崩溃
+                            print(f"页面内存超出预算，{profile.name} 规格改为只截取视口")
+                            profile = replace(profile, full_page=False)
+                            monitor.downgraded = True
+                        print(f"开始截图，URL: {url} (规格: {profile.name})")
+                        with timer.stage('screenshot'):
+                            pending_writes.append(await capture_profile(page, profile, path, settings))
+
+                    if blocked:
+                        print(f"已拦截 {sum(blocked.values())} 个请求: "
+                              + ", ".join(f"{key} {count}" for key, count in blocked.most_common()))
+                    blocked_requests += sum(blocked.values())
+
+                    # 后续分组直接带上当前的登录状态，无需再次登录
+                    storage_state = await context.storage_state()
+                    if monitor:
+                        await monitor.stop()
+                    if profiler:
+                        await profiler.flush()
+
+                # 上下文关闭后HAR才写完
+                if recording:
+                    settings.network_archive.commit(recording, url, group[0])
+
+            # 页面和上下文已释放，再等待后台编码写盘完成
+            with timer.stage('encode'):
+                files = [item for written in await asyncio.gather(*pending_writes) for item in written]
+        for path, size in files:
+            print(f"截图成功保存至: {path} ({size / 1024:.0f} KB)")
+        return CaptureResult(True, files, duration=time.monotonic() - start, blocked_requests=blocked_requests,
+                             stages=timer.as_dict(), page_height=page_height,
+                             memory=PageMemoryMonitor.merge(monitors), network=network_hosts())
+    except CaptureError as ce:
+        print(f"截图失败 ({url}) [{FAILURE_LABELS[ce.kind]}]: {ce}")
+        return CaptureResult(False, error=str(ce), failure=ce.kind, duration=time.monotonic() - start,
+                             stages=timer.as_dict(), page_height=page_height,
+                             memory=PageMemoryMonitor.merge(monitors), network=network_hosts())
+    except TimeoutError as te:
+        print(f"截图时发生超时错误 ({url}): {te}")
+        return CaptureResult(False, error=f"超时: {te}", failure='other', duration=time.monotonic() - start,
+                             stages=timer.as_dict(), page_height=page_height,
+                             memory=PageMemoryMonitor.merge(monitors), network=network_hosts())
+    except Exception as e:
+        print(f"截图时发生一般错误 ({url}): {e}")
+        import traceback
+        print(traceback.format_exc())
+        return CaptureResult(False, error=str(e), failure=classify_failure(e), duration=time.monotonic() - start,
+                             stages=timer.as_dict(), page_height=page_height,
+                             memory=PageMemoryMonitor.merge(monitors), network=network_hosts())
+    finally:
+        # 出错时也要等后台编码任务结束，避免留下未处理的异常
+        if pending_writes:
+            await asyncio.gather(*pending_writes, return_exceptions=True)
+
+def get_clean_folder_name(text):
+    """将文本转换为有效的文件夹名称"""
+    if not text:
+        return "未分类"
+    
+    # 截取前30个字符，避免文件夹名过长
+    text = str(text)[:30]
+    
+    # 移除非法字符
+    text = re.sub(r'[\\/*?:"<>|]', "", text)
+    text = text.strip()
+    
+    # 如果为空，返回默认名称
+    if not text:
+        return "未分类"
+    
+    return text
+
+# 国家顶级域名下常见的二级公共后缀（co.uk、com.cn 等），这类域名要多取一级才是站点本身
+SECOND_LEVEL_SUFFIX_LABELS = {'co', 'com', 'net', 'org', 'gov', 'edu', 'ac', 'or', 'ne', 'go', 'gob', 'mil'}
+
+def get_host_key(url):
+    """返回用于按主机限流的键：取主机名的最后两级（如 xxx.lovable.app -> lovable.app）；
+    二级公共后缀取最后三级（如 shop.foo.co.uk -> foo.co.uk），不会把 co.uk 下的所有网站算作同一个主机"""
+    host = (urlparse(url).hostname or "").lower()
+    if host.replace(".", "").isdigit():
+        return host
+    parts = host.split(".")
+    levels = 2
+    if len(parts) > 2 and len(parts[-1]) == 2 and parts[-2] in SECOND_LEVEL_SUFFIX_LABELS:
+        levels = 3
+    return ".".join(parts[-levels:])
+
+@dataclass
+class CaptureJob:
+    """一个待截图的任务"""
+    case_name: str   # 清理后的分组文件夹名
+    site_type: str
+    url: str
+    output_path: str
+    timeout: int = None  # 按历史耗时得到的导航超时（毫秒），None 表示使用默认值
+    failures: Counter = field(default_factory=Counter, compare=False)  # 各类型的失败次数
+
+    @property
+    def host(self):
+        return get_host_key(self.url)
+
+# 每种失败类型的最大重试次数
+RETRY_BUDGETS = {
+    'navigation_timeout': 2,
+    'http_5xx': 3,
+    'login_failed': 1,
+    'browser_crash': 2,
+    'screenshot_timeout': 1,
+    'archive_missing': 0,
+    'other': 1,
+}
+
+class RetryPolicy:
+    """按失败类型决定是否重试，以及重试前等待多久（指数退避加随机抖动）"""
+
+    def __init__(self, budgets=None, base_delay=5.0, max_delay=120.0):
+        self.budgets = dict(RETRY_BUDGETS if budgets is None else budgets)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def next_delay(self, job, kind):
+        """记录一次失败；还有重试名额时返回等待秒数，否则返回None"""
+        job.failures[kind] += 1
+        attempt = job.failures[kind]
+        if attempt > self.budgets.get(kind, 0):
+            return None
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        # 一半固定一半随机，避免同一主机的任务同时重试
+        return delay / 2 + random.uniform(0, delay / 2)
+
+class RunReport:
+    """一次批量运行的最终结果，以及按失败类型分组的汇总"""
+
+    def __init__(self):
+        self.succeeded = []
+        self.failed = []        # [(job, result), ...]
+        self.retries = Counter()
+
+    def print_failure_summary(self):
+        if self.retries:
+            print("重试次数: " + ", ".join(f"{FAILURE_LABELS.get(kind, kind)} {count}"
+                                           for kind, count in self.retries.most_common()))
+        if not self.failed:
+            return
+        by_kind = {}
+        for job, result in self.failed:
+            by_kind.setdefault(result.failure or 'other', []).append((job, result))
+        print(f"\n失败汇总: 共 {len(self.failed)} 个URL")
+        for kind, items in sorted(by_kind.items(), key=lambda item: -len(item[1])):
+            print(f"  {FAILURE_LABELS.get(kind, kind)} ({kind}): {len(items)} 个")
+            for job, result in items:
+                print(f"    - [{job.case_name}/{job.site_type}] {job.url}: {result.error}")
+
+def percentile(values, q):
+    """线性插值的百分位数，q 取 0-100"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    pos = (len(ordered) - 1) * q / 100
+    low = int(pos)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (pos - low)
+
+def merge_host_stats(total, stats):
+    """把一组按主机的请求统计（requests/bytes/ms/failed/blocked_idle_ms/pages）累加到 total"""
+    for key, value in stats.items():
+        total[key] = round(total.get(key, 0) + value, 1) if key == 'ms' else total.get(key, 0) + value
+    return total
+
+# 汇总中输出的百分位
+METRIC_QUANTILES = (50, 95, 99)
+
+class RunMetrics:
+    """逐个URL记录各阶段耗时，每个URL最终结果写一行JSON；
+    运行结束时输出各阶段的 p50/p95/p99 汇总，并可导出为 Prometheus 文本格式。
+    指定 network_path 时按主机累计请求统计，并与该文件中以往运行的统计合并"""
+
+    # 运行结束时打印的主机数
+    NETWORK_REPORT_HOSTS = 10
+
+    def __init__(self, path, prometheus_path=None, network_path=None):
+        self.path = path
+        self.prometheus_path = prometheus_path
+        self.network_path = network_path
+        self.network_hosts = {}   # 主机 -> 本次运行的请求统计
+        self.stages = {}          # 阶段 -> [秒, ...]
+        self.totals = []
+        self.outcomes = Counter()
+        self.bytes_written = 0
+        self.memory_peaks = {}    # 内存指标 -> 所有URL中的最大值
+        self.downgraded = 0       # 因内存超出预算只截取视口的URL数
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+
+    def record(self, job, result):
+        """记录一个URL的最终结果（重试中的中间失败不记录）"""
+        attempts = sum(job.failures.values()) + (1 if result else 0)
+        outcome = "ok" if result else "failed"
+        entry = {
+            'url': job.url,
+            'case': job.case_name,
+            'site_type': job.site_type,
+            'outcome': outcome,
+            'failure': result.failure or None,
+            'error': result.error or None,
+            'attempts': attempts,
+            'duration': round(result.duration, 3),
+            'stages': result.stages,
+            'page_height': result.page_height,
+            'bytes': result.bytes,
+            'files': [path for path, _ in result.files],
+            'blocked_requests': result.blocked_requests,
+            'memory': result.memory or None,
+            'requests': sum(stats['requests'] for stats in result.network.values()) if result.network else None,
+            'timestamp': time.time(),
+        }
+        self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+        self.outcomes[outcome] += 1
+        self.totals.append(result.duration)
+        self.bytes_written += result.bytes
+        for stage, seconds in result.stages.items():
+            self.stages.setdefault(stage, []).append(seconds)
+        for key, value in result.memory.items():
+            if key == 'downgraded':
+                self.downgraded += bool(value)
+            else:
+                self.memory_peaks[key] = max(self.memory_peaks.get(key, 0), value)
+        for host, stats in result.network.items():
+            merge_host_stats(self.network_hosts.setdefault(host, {}), dict(stats, pages=1))
+
+    def summary(self):
+        """各阶段以及总耗时的百分位汇总"""
+        def describe(values):
+            stats = {f"p{q}": round(percentile(values, q), 3) for q in METRIC_QUANTILES}
+            stats['count'] = len(values)
+            stats['sum'] = round(sum(values), 3)
+            return stats
+
+        summary = {
+            'urls': dict(self.outcomes),
+            'bytes': self.bytes_written,
+            'total': describe(self.totals),
+            'stages': {stage: describe(values) for stage, values in sorted(self.stages.items())},
+        }
+        if self.memory_peaks:
+            summary['memory'] = dict(self.memory_peaks, downgraded=self.downgraded)
+        return summary
+
+    def print_summary(self, summary):
+        if not self.totals:
+            return
+        print(f"\n阶段耗时汇总（秒，共 {len(self.totals)} 个URL）:")
+        print(f"  {'阶段':<14}" + "".join(f"{'p' + str(q):>9}" for q in METRIC_QUANTILES) + f"{'合计':>10}")
+        rows = list(summary['stages'].items()) + [('total', summary['total'])]
+        for stage, stats in rows:
+            print(f"  {stage:<16}" + "".join(f"{stats[f'p{q}']:>9.2f}" for q in METRIC_QUANTILES)
+                  + f"{stats['sum']:>12.1f}")
+        if 'memory' in summary:
+            memory = summary['memory']
+            print(f"内存峰值: 页面JS堆 {memory['js_heap_peak_mb']}MB，渲染进程 {memory['renderer_rss_peak_mb']}MB，"
+                  f"浏览器总计 {memory['browser_rss_peak_mb']}MB；{memory['downgraded']} 个URL降级为只截取视口")
+
+    def write_prometheus(self, summary):
+        """写出 Prometheus 文本格式，可交给 node_exporter 的 textfile collector 采集"""
+        lines = [
+            "# HELP screenshot_stage_seconds Time spent per capture stage.",
+            "# TYPE screenshot_stage_seconds summary",
+        ]
+        for stage, stats in list(summary['stages'].items()) + [('total', summary['total'])]:
+            for q in METRIC_QUANTILES:
+                lines.append(f'screenshot_stage_seconds{{stage="{stage}",quantile="{q / 100}"}} {stats[f"p{q}"]}')
+            lines.append(f'screenshot_stage_seconds_sum{{stage="{stage}"}} {stats["sum"]}')
+            lines.append(f'screenshot_stage_seconds_count{{stage="{stage}"}} {stats["count"]}')
+        lines += [
+            "# HELP screenshot_urls_total URLs processed by final outcome.",
+            "# TYPE screenshot_urls_total counter",
+        ]
+        for outcome, count in sorted(self.outcomes.items()):
+            lines.append(f'screenshot_urls_total{{outcome="{outcome}"}} {count}')
+        lines += [
+            "# HELP screenshot_bytes_written_total Bytes of image files written.",
+            "# TYPE screenshot_bytes_written_total counter",
+            f"screenshot_bytes_written_total {self.bytes_written}",
+        ]
+        write_file_atomic(self.prometheus_path, ("\n".join(lines) + "\n").encode("utf-8"))
+
+    def close(self):
+        """关闭明细文件，打印并写出汇总"""
+        self._file.close()
+        summary = self.summary()
+        self.print_summary(summary)
+        base, _ = os.path.splitext(self.path)
+        write_file_atomic(base + ".summary.json",
+                          json.dumps(summary, ensure_ascii=False, indent=2).encode("utf-8"))
+        if self.prometheus_path:
+            self.write_prometheus(summary)
+        if self.network_path and self.network_hosts:
+            self.write_network_report()
+        print(f"耗时明细已写入: {self.path}")
+        return summary
+
+    def write_network_report(self):
+        """把本次运行按主机的请求统计合并进跨运行的汇总文件，并打印最拖慢页面的主机"""
+        report = {'runs': 0, 'hosts': {}}
+        try:
+            with open(self.network_path, encoding="utf-8") as f:
+                report = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            print(f"读取网络请求汇总失败，重新开始累计 ({self.network_path}): {e}")
+        report['runs'] += 1
+        for host, stats in self.network_hosts.items():
+            merge_host_stats(report['hosts'].setdefault(host, {}), stats)
+        report['hosts'] = dict(sorted(report['hosts'].items(), key=lambda item: -item[1]['blocked_idle_ms']))
+        write_file_atomic(self.network_path, json.dumps(report, ensure_ascii=False, indent=1).encode("utf-8"))
+
+        ranked = sorted(self.network_hosts.items(), key=lambda item: (-item[1]['blocked_idle_ms'], -item[1]['bytes']))
+        print(f"\n请求最拖慢页面的主机（本次运行，共 {len(self.network_hosts)} 个主机）:")
+        for host, stats in ranked[:self.NETWORK_REPORT_HOSTS]:
+            print(f"  {host or '(无主机)'}: {stats['pages']} 个页面，{stats['requests']} 个请求，"
+                  f"{stats['bytes'] / 1024 / 1024:.1f} MB，失败 {stats['failed']}，"
+                  f"拖慢空闲判断 {stats['blocked_idle_ms'] / 1000:.1f}s")
+        print(f"按主机的网络请求汇总已写入: {self.network_path}")
+
+class HostLimitedQueue:
+    """异步任务队列，每个主机同时处理的任务数不超过 per_host_limit。
+    取任务时跳过已达到上限的主机，避免工作协程阻塞在同一个主机上"""
+
+    def __init__(self, per_host_limit=2):
+        self.per_host_limit = per_host_limit
+        self._pending = deque()
+        self._active_hosts = Counter()
+        self._in_flight = 0
+        self._delayed = 0
+        self._timers = set()
+        self._closed = False
+        self._cond = asyncio.Condition()
+
+    def __len__(self):
+        return len(self._pending)
+
+    async def put(self, job):
+        """把任务放到队尾"""
+        async with self._cond:
+            self._pending.append(job)
+            self._cond.notify_all()
+
+    async def wait_for_room(self, max_pending):
+        """等到排队中的任务少于 max_pending 个，用于边读边入队时限制内存"""
+        async with self._cond:
+            while len(self._pending) >= max_pending:
+                await self._cond.wait()
+
+    async def requeue(self, job, delay):
+        """等待 delay 秒后把任务放回队尾，不占用工作协程；等待期间队列不会结束"""
+        async with self._cond:
+            self._delayed += 1
+
+        async def later():
+            await asyncio.sleep(delay)
+            async with self._cond:
+                self._delayed -= 1
+                self._pending.append(job)
+                self._cond.notify_all()
+
+        timer = asyncio.create_task(later())
+        self._timers.add(timer)
+        timer.add_done_callback(self._timers.discard)
+
+    async def close(self):
+        """声明不会再有新任务加入；队列清空且没有进行中的任务后 get() 返回 None"""
+        async with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    async def get(self):
+        """取出第一个所属主机尚有空闲名额的任务，队列结束时返回 None"""
+        async with self._cond:
+            while True:
+                for i, job in enumerate(self._pending):
+                    if not self.per_host_limit or self._active_hosts[job.host] < self.per_host_limit:
+                        del self._pending[i]
+                        self._active_hosts[job.host] += 1
+                        self._in_flight += 1
+                        self._cond.notify_all()
+                        return job
+                if self._closed and not self._pending and self._in_flight == 0 and self._delayed == 0:
+                    return None
+                await self._cond.wait()
+
+    async def task_done(self, job):
+        """释放任务占用的主机名额"""
+        async with self._cond:
+            self._active_hosts[job.host] -= 1
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+# 任务清单默认保存在输出目录下
+MANIFEST_NAME = "manifest.sqlite3"
+
+def hash_files(paths):
+    """计算一组文件内容的SHA-256（按顺序连续计算）"""
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+class JobManifest:
+    """SQLite任务清单：以 (case_name, site_type, url) 为键记录每个截图任务的状态、尝试次数、
+    耗时、字节数和内容哈希。断点续跑和预检查都只需一次带索引的查询，不再逐个检查文件"""
+
+    # 估计耗时分桶的上限，桶号和同主机序号合成一个整数 position
+    MAX_BUCKET = 63
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY,
+            case_name TEXT NOT NULL,
+            site_type TEXT NOT NULL,
+            url TEXT NOT NULL,
+            output_path TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',  -- new / pending / running / done / failed
+            attempts INTEGER NOT NULL DEFAULT 0,
+            duration REAL,
+            bytes INTEGER,
+            content_hash TEXT,
+            error TEXT,
+            run_id INTEGER,
+            updated_at REAL,
+            expected REAL NOT NULL DEFAULT 0,  -- 按历史记录估计的截图耗时（秒），决定处理顺序
+            timeout INTEGER,                   -- 按历史记录得到的导航超时（毫秒）
+            position INTEGER NOT NULL DEFAULT 0,  -- 处理顺序，见 schedule()
+            UNIQUE (case_name, site_type, url)
+        );
+        CREATE INDEX IF NOT EXISTS idx_jobs_run_status ON jobs (run_id, status);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        # 旧版本的清单没有 expected 和 timeout 列
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(jobs)")}
+        with self.conn:
+            if 'expected' not in columns:
+                self.conn.execute("ALTER TABLE jobs ADD COLUMN expected REAL NOT NULL DEFAULT 0")
+            if 'timeout' not in columns:
+                self.conn.execute("ALTER TABLE jobs ADD COLUMN timeout INTEGER")
+            if 'position' not in columns:
+                self.conn.execute("ALTER TABLE jobs ADD COLUMN position INTEGER NOT NULL DEFAULT 0")
+            self.conn.execute("DROP INDEX IF EXISTS idx_jobs_run_expected")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_run_position ON jobs (run_id, position, id)")
+        # 本次运行的编号，用来区分输入文件中已删除的旧任务
+        self.run_id = time.time_ns()
+
+    def close(self):
+        self.conn.close()
+
+    def import_jobs(self, jobs, profiles, batch_size=1000):
+        """把本次输入的任务写入清单，已有的任务更新运行编号，并清除上次运行估计的耗时、超时和处理顺序
+        （由本次的 schedule() 重新计算）。
+        第一次加入清单的任务如果所有输出文件都已存在，直接记为完成（兼容没有清单时的旧输出）；
+        按 id 分批检查和更新，不会一次性载入全部新任务"""
+        now = time.time()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO jobs (case_name, site_type, url, output_path, status, run_id, updated_at) "
+                "VALUES (?, ?, ?, ?, 'new', ?, ?) "
+                "ON CONFLICT (case_name, site_type, url) DO UPDATE SET "
+                "run_id = excluded.run_id, output_path = excluded.output_path, expected = 0, timeout = NULL, position = 0",
+                ((job.case_name, job.site_type, job.url, job.output_path, self.run_id, now) for job in jobs))
+        for rows in self._batches("new", batch_size):
+            with self.conn:
+                self.conn.executemany("UPDATE jobs SET status = ? WHERE id = ?", (
+                    ('done' if all(os.path.exists(path) for path in job_output_paths(output_path, profiles))
+                     else 'pending', job_id)
+                    for job_id, output_path in rows))
+
+    def verify_files(self, profiles, batch_size=1000):
+        """检查本次已完成任务的输出文件是否还在，缺失的重新标记为待处理，返回重置数量"""
+        reset = 0
+        for rows in self._batches("done", batch_size):
+            missing = [(job_id,) for job_id, output_path in rows
+                       if not all(os.path.exists(path) for path in job_output_paths(output_path, profiles))]
+            with self.conn:
+                self.conn.executemany("UPDATE jobs SET status = 'pending' WHERE id = ?", missing)
+            reset += len(missing)
+        return reset
+
+    def _batches(self, status, batch_size):
+        """按 id 分批读取本次状态为 status 的任务 [(id, output_path), ...]；
+        每批读完后才产出，调用方可以在两批之间更新这些行"""
+        last_id = 0
+        while True:
+            rows = self.conn.execute(
+                "SELECT id, output_path FROM jobs WHERE run_id = ? AND status = ? AND id > ? ORDER BY id LIMIT ?",
+                (self.run_id, status, last_id, batch_size)).fetchall()
+            if not rows:
+                return
+            yield rows
+            last_id = rows[-1][0]
+
+    def summary(self):
+        """按分组统计本次任务：[(case_name, 已完成数, 总数), ...]"""
+        return self.conn.execute(
+            "SELECT case_name, SUM(status = 'done'), COUNT(*) FROM jobs WHERE run_id = ? "
+            "GROUP BY case_name ORDER BY case_name", (self.run_id,)).fetchall()
+
+    def schedule(self, history=None, adaptive_timeout=True, batch_size=500):
+        """为本次待处理的任务排定处理顺序，之后 pending() 按这个顺序返回。
+        有 history 时按历史估计耗时和导航超时，估计耗时按约两倍一档分桶，耗时长的桶先处理；
+        同一个桶内按主机轮流排列（每个主机的第1个任务、第2个任务……），
+        否则同主机的任务连成一串，受 per_host 限制只能逐个处理，队列和缓冲区会被它们占满。
+        没有 history 时所有任务在同一个桶内，按输入顺序轮流排列各主机。
+        返回估计来源的统计 {'url': 有该URL记录的任务数, 'host': 参考同主机记录的, 'none': 没有记录的}"""
+        sources = Counter()
+        slots = Counter()  # (桶, 主机) -> 已排入的任务数
+        last_id = 0
+        while True:
+            rows = self.conn.execute(
+                "SELECT id, url FROM jobs WHERE run_id = ? AND status != 'done' AND id > ? ORDER BY id LIMIT ?",
+                (self.run_id, last_id, batch_size)).fetchall()
+            if not rows:
+                return sources
+            estimates = history.estimate([url for _, url in rows]) if history is not None else {}
+            updates = []
+            for job_id, url in rows:
+                source, expected, timeout = estimates.get(url, (None, 0, None))
+                if source:
+                    sources[source] += 1
+                bucket = min(int(expected + 1).bit_length(), self.MAX_BUCKET)
+                key = (bucket, get_host_key(url))
+                slot = slots[key]
+                slots[key] += 1
+                # 桶号越大越先处理，同一桶内按主机的第几个任务排列
+                position = ((self.MAX_BUCKET - bucket) << 32) + slot
+                updates.append((expected, timeout if adaptive_timeout else None, position, job_id))
+            with self.conn:
+                self.conn.executemany("UPDATE jobs SET expected = ?, timeout = ?, position = ? WHERE id = ?", updates)
+            last_id = rows[-1][0]
+
+    def pending(self, batch_size=1000):
+        """本次需要处理的任务（未完成、失败或上次中断在运行中的），按 schedule() 排定的顺序。
+        按 (position, id) 分批读取，不会一次性载入全部任务，也不会在处理期间长时间占用读游标"""
+        last_position, last_id = -1, 0
+        while True:
+            rows = self.conn.execute(
+                "SELECT id, case_name, site_type, url, output_path, timeout, position FROM jobs "
+                "WHERE run_id = ? AND status != 'done' AND (position > ? OR (position = ? AND id > ?)) "
+                "ORDER BY position, id LIMIT ?",
+                (self.run_id, last_position, last_position, last_id, batch_size)).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield CaptureJob(*row[1:6])
+            last_position, last_id = rows[-1][6], rows[-1][0]
+
+    def mark_running(self, job):
+        with self.conn:
+            self.conn.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, updated_at = ? "
+                "WHERE case_name = ? AND site_type = ? AND url = ?",
+                (time.time(), job.case_name, job.site_type, job.url))
+
+    def record(self, job, result, content_hash=None):
+        """记录一次截图的结果"""
+        with self.conn:
+            self.conn.execute(
+                "UPDATE jobs SET status = ?, duration = ?, bytes = ?, content_hash = ?, error = ?, updated_at = ? "
+                "WHERE case_name = ? AND site_type = ? AND url = ?",
+                ('done' if result else 'failed', result.duration, result.bytes, content_hash, result.error or None,
+                 time.time(), job.case_name, job.site_type, job.url))
+
+class DurationHistory:
+    """跨运行记录每个URL的截图耗时（SQLite），用于按预计耗时从长到短调度任务，并为每个URL设置自适应的导航超时。
+    每个URL只保留最近 max_samples 次记录；没有该URL的记录时参考同一主机的其他URL"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS url_history (
+            url TEXT PRIMARY KEY,
+            host TEXT NOT NULL,
+            durations TEXT NOT NULL,  -- 最近每次尝试的总耗时（秒，包括失败的尝试），JSON数组
+            gotos TEXT NOT NULL,      -- 最近每次成功截图的导航耗时（秒），JSON数组
+            updated_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS idx_url_history_host ON url_history (host, updated_at);
+    """
+
+    def __init__(self, path=".capture_history.sqlite3", max_samples=20, min_samples=3, timeout_margin_ms=15000,
+                 max_timeout_ms=DEFAULT_TIMEOUT_MS):
+        self.path = path
+        self.max_samples = max_samples
+        self.min_samples = min_samples          # 计算超时至少需要的导航记录数
+        self.timeout_margin_ms = timeout_margin_ms
+        self.max_timeout_ms = max_timeout_ms
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(self.SCHEMA)
+        self._hosts = {}       # 主机 -> (耗时列表, 导航耗时列表)，估计时缓存
+        self._overall = None   # 所有URL的平均耗时
+
+    def close(self):
+        self.conn.close()
+
+    def record(self, url, result):
+        """记录一次尝试"""
+        row = self.conn.execute("SELECT durations, gotos FROM url_history WHERE url = ?", (url,)).fetchone()
+        durations, gotos = (json.loads(row[0]), json.loads(row[1])) if row else ([], [])
+        durations = (durations + [round(result.duration, 3)])[-self.max_samples:]
+        if result and 'goto' in result.stages:
+            gotos = (gotos + [round(result.stages['goto'], 3)])[-self.max_samples:]
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO url_history (url, host, durations, gotos, updated_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (url) DO UPDATE SET durations = excluded.durations, gotos = excluded.gotos, "
+                "updated_at = excluded.updated_at",
+                (url, get_host_key(url), json.dumps(durations), json.dumps(gotos), time.time()))
+
+    def _host_samples(self, host, limit=200):
+        if host not in self._hosts:
+            durations, gotos = [], []
+            for row_durations, row_gotos in self.conn.execute(
+                    "SELECT durations, gotos FROM url_history WHERE host = ? ORDER BY updated_at DESC LIMIT ?",
+                    (host, limit)):
+                durations += json.loads(row_durations)
+                gotos += json.loads(row_gotos)
+            self._hosts[host] = (durations, gotos)
+        return self._hosts[host]
+
+    def _overall_mean(self, limit=1000):
+        if self._overall is None:
+            durations = [d for (row,) in self.conn.execute(
+                "SELECT durations FROM url_history ORDER BY updated_at DESC LIMIT ?", (limit,)) for d in json.loads(row)]
+            self._overall = sum(durations) / len(durations) if durations else 0.0
+        return self._overall
+
+    def timeout_for(self, gotos):
+        """导航耗时的p99加上余量，不超过默认超时；记录太少时返回None"""
+        if len(gotos) < self.min_samples:
+            return None
+        return min(self.max_timeout_ms, int(percentile(gotos, 99) * 1000 + self.timeout_margin_ms))
+
+    def estimate(self, urls):
+        """返回 {url: (来源, 预计耗时秒数, 导航超时毫秒或None)}，来源为 url / host / none"""
+        rows = {url: (json.loads(durations), json.loads(gotos)) for url, durations, gotos in self.conn.execute(
+            f"SELECT url, durations, gotos FROM url_history WHERE url IN ({','.join('?' * len(urls))})", urls)}
+        estimates = {}
+        for url in urls:
+            durations, gotos = rows.get(url, ([], []))
+            host_durations, host_gotos = self._host_samples(get_host_key(url))
+            if durations:
+                source, expected = 'url', sum(durations) / len(durations)
+            elif host_durations:
+                source, expected = 'host', sum(host_durations) / len(host_durations)
+            else:
+                # 没有任何记录的任务按整体平均值排在中间
+                source, expected = 'none', self._overall_mean()
+            timeout = self.timeout_for(gotos) or self.timeout_for(host_gotos)
+            estimates[url] = (source, round(expected, 3), timeout)
+        return estimates
+
+class JobQueue:
+    """多台机器共享的任务队列：放在共享文件系统上的一个SQLite文件。
+    工作节点以租约领取任务并定期续约；节点宕机或失联导致租约过期后，任务由其他节点重新领取。
+    完成时校验租约令牌，已被别人重新领取的过期租约提交的结果不会被记录，同一结果重复提交也只生效一次。
+    等待共享文件系统上的锁可能很久，工作节点通过 asyncio.to_thread 调用各方法；每个线程使用自己的连接"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS queue (
+            id INTEGER PRIMARY KEY,
+            case_name TEXT NOT NULL,
+            site_type TEXT NOT NULL,
+            url TEXT NOT NULL,
+            output_path TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',  -- pending / leased / done / failed
+            attempts INTEGER NOT NULL DEFAULT 0,     -- 被领取的次数
+            expirations INTEGER NOT NULL DEFAULT 0,  -- 租约过期的次数
+            lease_owner TEXT,
+            lease_token TEXT,
+            lease_expires REAL,
+            duration REAL,
+            bytes INTEGER,
+            content_hash TEXT,
+            failure TEXT,
+            error TEXT,
+            finished_by TEXT,
+            updated_at REAL,
+            UNIQUE (case_name, site_type, url)
+        );
+        CREATE INDEX IF NOT EXISTS idx_queue_status ON queue (status, lease_expires);
+    """
+
+    def __init__(self, path, owner=None, lease_seconds=120, max_expirations=3):
+        self.path = path
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+        self.lease_seconds = lease_seconds
+        self.max_expirations = max_expirations
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        # 网络文件系统上不能使用WAL（依赖共享内存），改用回滚日志和显式写事务
+        self.conn.execute("PRAGMA journal_mode=DELETE")
+        self.conn.executescript(self.SCHEMA)
+
+    @property
+    def conn(self):
+        """当前线程的连接，第一次使用时创建"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # check_same_thread=False 只是为了 close() 能在主线程关闭所有连接，每个连接仍只在一个线程中使用
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA synchronous=FULL")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def close(self):
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+    @contextmanager
+    def _write(self):
+        """写事务：BEGIN IMMEDIATE 开始时就取得写锁，两个节点不会读到同一批待领取的任务"""
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.conn
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    def enqueue(self, jobs, batch_size=1000):
+        """把任务加入队列，已在队列中的任务（无论状态）不会重复加入，返回新加入的数量"""
+        added = 0
+        jobs = iter(jobs)
+        while True:
+            batch = [(job.case_name, job.site_type, job.url, job.output_path, time.time())
+                     for job in islice(jobs, batch_size)]
+            if not batch:
+                return added
+            with self._write() as conn:
+                before = conn.total_changes
+                conn.executemany(
+                    "INSERT INTO queue (case_name, site_type, url, output_path, updated_at) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT (case_name, site_type, url) DO NOTHING", batch)
+                added += conn.total_changes - before
+
+    def lease(self, limit, alone=False):
+        """领取最多 limit 个任务，返回 [(job, 租约), ...]，租约为 (任务编号, 令牌)，
+        任务的 failures['lease_expired'] 为它的租约过期次数。
+        领取前先回收已过期的租约；过期次数超过 max_expirations 的任务（多半每次都让节点崩溃）记为失败。
+        过期过的任务优先级最低，并且只在 alone 为True（节点手上没有其他任务）时单独领取，避免再次牵连其他任务"""
+        now = time.time()
+        leased = []
+        with self._write() as conn:
+            for job_id, expirations in conn.execute(
+                    "SELECT id, expirations FROM queue WHERE status = 'leased' AND lease_expires < ?", (now,)).fetchall():
+                if expirations + 1 > self.max_expirations:
+                    conn.execute("UPDATE queue SET status = 'failed', expirations = expirations + 1, "
+                                 "failure = 'lease_expired', error = ?, lease_token = NULL, updated_at = ? WHERE id = ?",
+                                 (f"租约过期 {expirations + 1} 次", now, job_id))
+                else:
+                    conn.execute("UPDATE queue SET status = 'pending', expirations = expirations + 1, "
+                                 "lease_owner = NULL, lease_token = NULL, updated_at = ? WHERE id = ?", (now, job_id))
+            rows = conn.execute("SELECT id, case_name, site_type, url, output_path, expirations FROM queue "
+                                "WHERE status = 'pending' ORDER BY expirations > 0, id LIMIT ?", (limit,)).fetchall()
+            clean = [row for row in rows if not row[-1]]
+            if clean or not alone:
+                rows = clean
+            else:
+                rows = rows[:1]
+            for row in rows:
+                token = os.urandom(8).hex()
+                conn.execute("UPDATE queue SET status = 'leased', attempts = attempts + 1, lease_owner = ?, "
+                             "lease_token = ?, lease_expires = ?, updated_at = ? WHERE id = ?",
+                             (self.owner, token, now + self.lease_seconds, now, row[0]))
+                job = CaptureJob(*row[1:5])
+                if row[5]:
+                    job.failures['lease_expired'] = row[5]
+                leased.append((job, (row[0], token)))
+        return leased
+
+    def heartbeat(self, leases):
+        """为仍在处理的任务续约，返回已经失去的租约（过期后被回收或被其他节点领取）"""
+        lost = []
+        expires = time.time() + self.lease_seconds
+        with self._write() as conn:
+            for job_id, token in leases:
+                cursor = conn.execute("UPDATE queue SET lease_expires = ? "
+                                      "WHERE id = ? AND lease_token = ? AND status = 'leased'", (expires, job_id, token))
+                if cursor.rowcount == 0:
+                    lost.append((job_id, token))
+        return lost
+
+    def complete(self, lease, result, content_hash=None):
+        """提交任务结果；只有仍持有该租约时才会记录，返回是否记录成功。重复提交时不会再次生效"""
+        job_id, token = lease
+        with self._write() as conn:
+            cursor = conn.execute(
+                "UPDATE queue SET status = ?, duration = ?, bytes = ?, content_hash = ?, failure = ?, error = ?, "
+                "finished_by = ?, lease_token = NULL, updated_at = ? "
+                "WHERE id = ? AND lease_token = ? AND status = 'leased'",
+                ('done' if result else 'failed', result.duration, result.bytes, content_hash, result.failure or None,
+                 result.error or None, self.owner, time.time(), job_id, token))
+        return cursor.rowcount == 1
+
+    def has_work_elsewhere(self):
+        """还有待领取的任务，或其他节点持有的租约（过期后可能需要接手）"""
+        return self.conn.execute(
+            "SELECT EXISTS (SELECT 1 FROM queue WHERE status = 'pending' "
+            "OR (status = 'leased' AND lease_owner != ?))", (self.owner,)).fetchone()[0] == 1
+
+    def counts(self):
+        """各状态的任务数"""
+        return dict(self.conn.execute("SELECT status, COUNT(*) FROM queue GROUP BY status").fetchall())
+
+async def run_jobs(jobs, pool, concurrency=1, per_host_limit=2, progress=None, on_result=None, settings=None,
+                   on_start=None, retry_policy=None, metrics=None, max_queued=1000, on_final=None):
+    """用 concurrency 个工作协程并发处理任务队列中的截图任务，返回 RunReport。
+    失败的任务按 retry_policy 退避后放回队尾重试；每次尝试开始时调用 on_start(job)，
+    每次得到结果后调用 await on_result(job, result)；每个任务的最终结果记录到 metrics 并调用 await on_final(job, result)。
+    jobs 可以是（异步）生成器，边处理边读取，队列中最多排着 max_queued 个任务"""
+    if retry_policy is None:
+        retry_policy = RetryPolicy()
+    report = RunReport()
+    queue = HostLimitedQueue(per_host_limit=per_host_limit)
+
+    async def feed():
+        try:
+            if hasattr(jobs, '__aiter__'):
+                async for job in jobs:
+                    await queue.wait_for_room(max_queued)
+                    await queue.put(job)
+            else:
+                for job in jobs:
+                    await queue.wait_for_room(max_queued)
+                    await queue.put(job)
+        finally:
+            await queue.close()
+
+    async def worker():
+        while True:
+            job = await queue.get()
+            if job is None:
+                return
+            try:
+                print(f"\n正在处理 {job.url} ({job.site_type})")
+                if on_start:
+                    on_start(job)
+                os.makedirs(os.path.dirname(job.output_path) or ".", exist_ok=True)
+                # 自适应超时导致导航超时后，重试时恢复默认超时
+                timeout = job.timeout if job.timeout and not job.failures['navigation_timeout'] else DEFAULT_TIMEOUT_MS
+                result = await take_screenshot(job.url, job.output_path, timeout, pool=pool, settings=settings)
+                if on_result:
+                    await on_result(job, result)
+                if result:
+                    print(f"截图已保存到: {job.output_path}")
+                    report.succeeded.append(job)
+                else:
+                    kind = result.failure or 'other'
+                    delay = retry_policy.next_delay(job, kind)
+                    if delay is not None:
+                        # 放回队尾重试，不阻塞其他正常的任务
+                        print(f"{FAILURE_LABELS.get(kind, kind)}，{delay:.1f} 秒后重试 {job.url} "
+                              f"(第 {job.failures[kind]} 次)")
+                        report.retries[kind] += 1
+                        await queue.requeue(job, delay)
+                        continue
+                    print(f"无法截取 {job.url} 的截图")
+                    report.failed.append((job, result))
+                if metrics is not None:
+                    metrics.record(job, result)
+                if on_final:
+                    await on_final(job, result)
+                if progress is not None:
+                    progress.update(1)
+            finally:
+                await queue.task_done(job)
+
+    feeder = asyncio.create_task(feed())
+    await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    # 读取输入时的异常在工作协程处理完已入队的任务后再抛出
+    await feeder
+    return report
+
+def job_key(job):
+    return (job.case_name, job.site_type, job.url)
+
+def _process_worker(worker_id, args, tasks, events):
+    """工作进程入口：独立的事件循环和浏览器池，从 tasks 取任务，把每次尝试和最终结果发回 events"""
+    asyncio.run(_process_worker_main(worker_id, args, tasks, events))
+
+async def _process_worker_main(worker_id, args, tasks, events):
+    settings = build_settings(args)
+
+    async def receive():
+        while True:
+            job = await asyncio.to_thread(tasks.get)
+            if job is None:
+                return
+            yield job
+
+    async def on_result(job, result):
+        events.put(('result', worker_id, job, result))
+
+    async def on_final(job, result):
+        events.put(('final', worker_id, job, result))
+
+    try:
+        async with BrowserPool(headless=not args.headed, max_pages_per_browser=args.recycle_after) as pool:
+            # 主机限流由协调进程统一控制
+            report = await run_jobs(receive(), pool, args.concurrency, per_host_limit=0, settings=settings,
+                                    on_start=lambda job: events.put(('start', worker_id, job)),
+                                    on_result=on_result, retry_policy=build_retry_policy(args), on_final=on_final)
+        events.put(('exit', worker_id, dict(report.retries)))
+    finally:
+        settings.encoder.close()
+
+class _WorkerProcess:
+    """协调进程中记录的一个工作进程，以及已分配给它但还没有最终结果的任务"""
+
+    def __init__(self, process, tasks):
+        self.process = process
+        self.tasks = tasks
+        self.outstanding = {}   # job_key -> job
+        self.closing = False    # 已发送结束信号
+
+async def run_jobs_in_processes(jobs, args, processes, concurrency=1, per_host_limit=2, progress=None,
+                                on_result=None, on_start=None, retry_policy=None, metrics=None, max_buffered=1000,
+                                max_restarts=None, liveness_interval=1.0):
+    """多进程执行：协调进程把任务分配给 processes 个工作进程，每个工作进程用 args 构建自己的配置、
+    事件循环和浏览器池，同时处理 concurrency 个任务。回调、进度条和 metrics 都在协调进程中执行，返回汇总后的 RunReport。
+    每个主机同时分配出去的任务数不超过 per_host_limit（跨进程统一计数）。
+    工作进程异常退出时，分配给它的任务重新分配给其他进程，并启动一个新进程替代；
+    同一任务遇到崩溃的次数超过 browser_crash 的重试名额后记为失败"""
+    if retry_policy is None:
+        retry_policy = RetryPolicy()
+    if max_restarts is None:
+        max_restarts = processes * 5
+    crash_budget = retry_policy.budgets.get('browser_crash', 0)
+    # 工作进程不再清空会话缓存，图片编码进程数按工作进程数分摊
+    worker_args = argparse.Namespace(**{**vars(args), 'clear_sessions': False,
+                                        'encode_workers': max(1, args.encode_workers // processes)})
+    mp = multiprocessing.get_context("spawn")
+    events = mp.Queue()
+    report = RunReport()
+    workers = {}
+    source = iter(jobs)
+    buffer = deque()
+    exhausted = False
+    host_load = Counter()
+    crashes = Counter()
+    next_id = 0
+    restarts = 0
+
+    def spawn():
+        nonlocal next_id
+        tasks = mp.Queue()
+        # 不能设为守护进程：守护进程不允许再创建子进程，ImageEncoder 的编码进程池会无法启动。
+        # 协调进程退出前在 finally 中结束并回收所有工作进程
+        process = mp.Process(target=_process_worker, args=(next_id, worker_args, tasks, events), daemon=False)
+        process.start()
+        workers[next_id] = _WorkerProcess(process, tasks)
+        next_id += 1
+
+    def take_job(worker):
+        """从缓冲区取出第一个所属主机还有名额的任务。
+        曾导致崩溃的任务只分配给空闲的进程单独运行，再次崩溃时不会牵连其他任务"""
+        nonlocal exhausted
+        while not exhausted and len(buffer) < max_buffered:
+            job = next(source, None)
+            if job is None:
+                exhausted = True
+            else:
+                buffer.append(job)
+        for i, job in enumerate(buffer):
+            if crashes[job_key(job)] and worker.outstanding:
+                continue
+            if not per_host_limit or host_load[job.host] < per_host_limit:
+                del buffer[i]
+                return job
+        return None
+
+    def dispatch():
+        for worker in sorted(workers.values(), key=lambda w: len(w.outstanding)):
+            while (not worker.closing and len(worker.outstanding) < concurrency
+                   and not any(crashes[key] for key in worker.outstanding)):
+                job = take_job(worker)
+                if job is None:
+                    break
+                worker.outstanding[job_key(job)] = job
+                host_load[job.host] += 1
+                worker.tasks.put(job)
+        if exhausted and not buffer:
+            for worker in workers.values():
+                if not worker.closing:
+                    worker.closing = True
+                    worker.tasks.put(None)
+
+    def finish(job, result):
+        if result:
+            report.succeeded.append(job)
+        else:
+            report.failed.append((job, result))
+        if metrics is not None:
+            metrics.record(job, result)
+        if progress is not None:
+            progress.update(1)
+
+    async def reap(worker_id, worker):
+        nonlocal restarts
+        del workers[worker_id]
+        if worker.closing and not worker.outstanding:
+            return
+        print(f"\n工作进程 {worker_id} 异常退出 (退出码 {worker.process.exitcode})，"
+              f"重新分配 {len(worker.outstanding)} 个任务")
+        for key, job in worker.outstanding.items():
+            host_load[job.host] -= 1
+            crashes[key] += 1
+            if crashes[key] > crash_budget:
+                job.failures['browser_crash'] = crashes[key]
+                result = CaptureResult(False, error=f"工作进程崩溃 {crashes[key]} 次", failure='browser_crash')
+                if on_result:
+                    await on_result(job, result)
+                finish(job, result)
+            else:
+                buffer.appendleft(job)
+        if buffer or not exhausted:
+            restarts += 1
+            if restarts > max_restarts:
+                raise RuntimeError(f"工作进程已重启 {restarts - 1} 次，放弃运行")
+            spawn()
+
+    async def handle(event):
+        kind, worker_id = event[0], event[1]
+        worker = workers.get(worker_id)
+        if kind == 'start':
+            if on_start:
+                on_start(event[2])
+        elif kind == 'result':
+            if on_result:
+                await on_result(event[2], event[3])
+        elif kind == 'final':
+            job, result = event[2], event[3]
+            if worker and worker.outstanding.pop(job_key(job), None) is not None:
+                host_load[job.host] -= 1
+            finish(job, result)
+        elif kind == 'exit':
+            report.retries.update(event[2])
+            if worker:
+                worker.process.join()
+                await reap(worker_id, worker)
+
+    loop = asyncio.get_running_loop()
+    try:
+        for _ in range(processes):
+            spawn()
+        last_check = loop.time()
+        while workers:
+            dispatch()
+            try:
+                event = await asyncio.to_thread(events.get, True, 0.5)
+            except Empty:
+                event = None
+            if event is not None:
+                await handle(event)
+            # 有消息不断到达时也要定期检查进程是否存活，否则崩溃的进程手上的任务一直得不到重新分配
+            if event is not None and loop.time() - last_check < liveness_interval:
+                continue
+            last_check = loop.time()
+            dead = [(worker_id, worker) for worker_id, worker in workers.items() if not worker.process.is_alive()]
+            if not dead:
+                continue
+            # 先处理队列中已有的消息：进程退出前发出的结果都已在队列中，不能当作未完成的任务重新分配
+            while True:
+                try:
+                    event = events.get_nowait()
+                except Empty:
+                    break
+                await handle(event)
+            for worker_id, worker in dead:
+                if workers.get(worker_id) is worker:
+                    await reap(worker_id, worker)
+    finally:
+        for worker in workers.values():
+            if worker.process.is_alive():
+                worker.process.terminate()
+            worker.process.join()
+    return report
+
+async def run_queue_worker(job_queue, pool, concurrency=1, per_host_limit=2, settings=None, retry_policy=None,
+                           metrics=None, poll_interval=5.0):
+    """作为工作节点从共享队列领取任务并截图，每 lease_seconds/3 秒为手上的任务续约。
+    队列中既没有待领取的任务、也没有其他节点持有的租约时结束，返回本节点的 RunReport"""
+    leases = {}   # job_key -> 租约
+    held = {}     # job_key -> 已领取还没有最终结果的任务
+    lost = set()  # 已失效的租约，不再续约
+
+    async def receive():
+        while True:
+            if any(job.failures['lease_expired'] for job in held.values()):
+                # 手上有曾导致节点失联的任务时不再领取，让它单独运行
+                await asyncio.sleep(1)
+                continue
+            batch = await asyncio.to_thread(job_queue.lease, concurrency, not held)
+            if not batch:
+                if not await asyncio.to_thread(job_queue.has_work_elsewhere):
+                    return
+                # 其他节点还持有租约，等它们完成或过期后接手
+                await asyncio.sleep(poll_interval)
+                continue
+            for job, lease in batch:
+                leases[job_key(job)] = lease
+                held[job_key(job)] = job
+                yield job
+
+    async def heartbeat():
+        while True:
+            await asyncio.sleep(job_queue.lease_seconds / 3)
+            active = [lease for lease in leases.values() if lease not in lost]
+            for lease in await asyncio.to_thread(job_queue.heartbeat, active):
+                # 续约期间任务可能已经完成
+                url = next((key[2] for key, leased in leases.items() if leased == lease), None)
+                if url is not None:
+                    lost.add(lease)
+                    print(f"\n租约已失效，{url} 可能由其他节点重新截图")
+
+    async def on_final(job, result):
+        lease = leases.pop(job_key(job))
+        held.pop(job_key(job))
+        lost.discard(lease)
+        content_hash = None
+        if result:
+            content_hash = await asyncio.to_thread(hash_files, [path for path, _ in result.files])
+        if not await asyncio.to_thread(job_queue.complete, lease, result, content_hash):
+            print(f"{job.url} 的租约已过期并由其他节点领取，本次结果不记录")
+
+    print(f"工作节点 {job_queue.owner} 开始从队列 {job_queue.path} 领取任务")
+    beat = asyncio.create_task(heartbeat())
+    try:
+        # 只预先领取少量任务，其余留给其他节点
+        return await run_jobs(receive(), pool, concurrency, per_host_limit, settings=settings,
+                              retry_policy=retry_policy, metrics=metrics, max_queued=1, on_final=on_final)
+    finally:
+        beat.cancel()
+
+# 输入文件扩展名 -> 格式
+INPUT_FORMATS = {'.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl'}
+
+def iter_input_rows(path, input_format="auto"):
+    """逐行读取CSV或JSONL输入（path 为 '-' 时读标准输入），每行产出一个dict，不会把整个文件读入内存。
+    auto 模式按扩展名判断格式；标准输入则看第一行是否以 '{' 开头"""
+    f = sys.stdin if path == "-" else open(path, newline="", encoding="utf-8-sig")
+    try:
+        lines = iter(f)
+        if input_format == "auto":
+            input_format = INPUT_FORMATS.get(os.path.splitext(path)[1].lower())
+        if input_format is None:
+            first = next(lines, "")
+            input_format = "jsonl" if first.lstrip().startswith("{") else "csv"
+            lines = chain([first], lines)
+
+        if input_format == "csv":
+            reader = csv.DictReader(lines)
+            if 'prod_url' not in (reader.fieldnames or []):
+                raise ValueError(f"输入中缺少'prod_url'列（列名: {', '.join(reader.fieldnames or [])}）")
+            yield from reader
+        else:
+            for lineno, line in enumerate(lines, 1):
+                if not line.strip():
+                    continue
+                row = json.loads(line)
+                if not isinstance(row, dict):
+                    raise ValueError(f"第 {lineno} 行不是JSON对象")
+                yield row
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+def iter_input_jobs(rows, output_dir):
+    """把输入的每一行转换为截图任务，没有 prod_url 的行跳过"""
+    warned = False
+    for row in rows:
+        url = str(row.get('prod_url') or "").strip()
+        if not url:
+            continue
+        if 'case_name' not in row and not warned:
+            print("警告: 输入中没有'case_name'列，这些截图将保存在同一文件夹中")
+            warned = True
+        clean_case_name = get_clean_folder_name(row.get('case_name'))
+
+        # 创建包含site_type的文件名
+        site_type = str(row.get('site_type') or "Unknown")
+        filename = f"{site_type.lower()}.png"
+
+        yield CaptureJob(clean_case_name, site_type, url, os.path.join(output_dir, clean_case_name, filename))
+
+async def process_csv(csv_path, output_dir, pool=None, concurrency=1, per_host_limit=2, settings=None,
+                      manifest_path=None, verify_files=False, retry_policy=None, metrics=None, input_format="auto",
+                      processes=1, worker_args=None, history=None, adaptive_timeout=True):
+    """处理CSV/JSONL文件（'-' 表示标准输入）并下载截图；输入逐行读入任务清单，
+    任务状态记录在输出目录下的SQLite清单中，中断后可以直接续跑。
+    processes 大于1时由 processes 个工作进程截图（见 run_jobs_in_processes），worker_args 为工作进程使用的命令行参数。
+    传入 history（DurationHistory）时按历史耗时从长到短处理，并按历史导航耗时设置每个URL的超时"""
+    if pool is None and processes <= 1:
+        # 整个CSV共用一个浏览器池，避免每个URL都重新启动Chromium
+        async with BrowserPool() as own_pool:
+            return await process_csv(csv_path, output_dir, own_pool, concurrency, per_host_limit, settings,
+                                     manifest_path, verify_files, retry_policy, metrics, input_format,
+                                     history=history, adaptive_timeout=adaptive_timeout)
+
+    if settings is None:
+        settings = CaptureSettings()
+
+    # 创建输出目录
+    os.makedirs(output_dir, exist_ok=True)
+    
+    manifest = JobManifest(manifest_path or os.path.join(output_dir, MANIFEST_NAME))
+    try:
+        # 逐行读取输入并写入清单，然后一次查询得到每个分组的完成情况
+        print(f"读取任务: {'标准输入' if csv_path == '-' else csv_path}")
+        try:
+            manifest.import_jobs(iter_input_jobs(iter_input_rows(csv_path, input_format), output_dir),
+                                 settings.profiles)
+        except (OSError, ValueError, csv.Error) as e:
+            print(f"读取输入文件时发生错误: {e}")
+            return
+        if verify_files:
+            reset = manifest.verify_files(settings.profiles)
+            print(f"校验输出文件: {reset} 个已完成任务的文件缺失，重新加入待处理")
+
+        summary = manifest.summary()
+        total_urls = sum(total for _, _, total in summary)
+        completed_urls = sum(done for _, done, _ in summary)
+        for clean_case_name, done, total in summary:
+            print(f"组 {clean_case_name}: {done}/{total} 已完成, {total - done} 待处理")
+        if total_urls:
+            print(f"\n总任务状态: {completed_urls}/{total_urls} 已完成 ({completed_urls/total_urls*100:.1f}%), "
+                  f"{total_urls - completed_urls} 待处理")
+
+        pending_urls = total_urls - completed_urls
+        if not pending_urls:
+            print("所有截图任务已完成！无需继续执行。")
+            return
+
+        # 耗时最长的任务先开始，避免运行末尾只剩几个慢任务拖着；同一主机的任务与其他主机交错
+        sources = manifest.schedule(history, adaptive_timeout)
+        if history is not None:
+            print(f"按历史耗时从长到短处理: {sources['url']} 个URL有历史记录，{sources['host']} 个参考同主机记录，"
+                  f"{sources['none']} 个没有记录")
+
+        workers = f"{processes} 个进程 x 并发数 {concurrency}" if processes > 1 else f"并发数 {concurrency}"
+        print(f"\n开始处理待完成的截图任务: 共 {pending_urls} 个URL，{workers}，每个主机最多 {per_host_limit} 个\n")
+
+        async def on_result(job, result):
+            if history is not None:
+                history.record(job.url, result)
+            content_hash = None
+            if result:
+                content_hash = await asyncio.to_thread(hash_files, [path for path, _ in result.files])
+            manifest.record(job, result, content_hash)
+
+        # 所有分组共用一个进度条
+        with tqdm(total=pending_urls, desc="截图进度") as progress:
+            if processes > 1:
+                report = await run_jobs_in_processes(manifest.pending(), worker_args, processes, concurrency,
+                                                     per_host_limit, progress, on_result, on_start=manifest.mark_running,
+                                                     retry_policy=retry_policy, metrics=metrics)
+            else:
+                report = await run_jobs(manifest.pending(), pool, concurrency, per_host_limit, progress, on_result,
+                                        settings, on_start=manifest.mark_running, retry_policy=retry_policy,
+                                        metrics=metrics)
+
+        group_stats = {}
+        for job in report.succeeded:
+            group_stats.setdefault(job.case_name, Counter())['succeeded'] += 1
+        for job, _ in report.failed:
+            group_stats.setdefault(job.case_name, Counter())['failed'] += 1
+        for clean_case_name, stats in sorted(group_stats.items()):
+            print(f"组 {clean_case_name} 处理完成: 成功 {stats['succeeded']}，失败 {stats['failed']}")
+        report.print_failure_summary()
+    finally:
+        manifest.close()
+
+# 截图服务返回的图片类型
+IMAGE_CONTENT_TYPES = {'png': "image/png", 'jpeg': "image/jpeg", 'webp': "image/webp"}
+
+HTTP_REASONS = {200: "OK", 202: "Accepted", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                413: "Payload Too Large", 429: "Too Many Requests", 500: "Internal Server Error",
+                502: "Bad Gateway", 503: "Service Unavailable"}
+
+class HttpError(Exception):
+    """截图服务中需要直接返回给客户端的错误"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+class ScreenshotService:
+    """常驻的截图HTTP服务：浏览器和预热上下文常驻，请求进入有界队列由固定数量的工作协程处理，
+    队列满时直接返回429。只依赖标准库的 asyncio.start_server
+
+    POST /capture   JSON: {"url", "profile", "format", "quality", "timeout", "output"}
+                    不带 output 时直接返回图片内容；带 output 时写入 --outdir 下的该路径并返回JSON
+    GET  /capture?url=...&profile=...  同上，便于用 curl 调试
+    GET  /healthz   存活检查
+    GET  /stats     队列、并发、成功失败数和耗时分位数
+    """
+
+    MAX_BODY = 64 * 1024
+    MAX_TIMEOUT = 5 * 60 * 1000  # 客户端指定的超时（毫秒）不超过这个值
+
+    def __init__(self, pool, settings, output_root, concurrency=2, queue_size=16, timeout=90000):
+        self.pool = pool
+        self.settings = settings
+        self.output_root = os.path.abspath(output_root)
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.started = time.time()
+        self.in_flight = 0
+        self.counts = Counter()
+        self.durations = deque(maxlen=1000)
+        self.stage_totals = Counter()
+        self._workers = []
+
+    async def start(self, host, port):
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        server = await asyncio.start_server(self._handle, host, port)
+        host, port = server.sockets[0].getsockname()[:2]
+        print(f"截图服务已启动: http://{host}:{port} (并发 {self.concurrency}, 队列上限 {self.queue.maxsize})")
+        return server
+
+    async def close(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+
+    # --- 任务处理 ---
+
+    def build_request(self, params):
+        """校验请求参数，返回 (url, settings, output_path, timeout)"""
+        url = str(params.get('url') or "").strip()
+        if urlparse(url).scheme not in ("http", "https"):
+            raise HttpError(400, "缺少有效的 url（需要 http/https）")
+        try:
+            profile = parse_profile(str(params.get('profile') or "desktop"))
+            if params.get('format'):
+                if params['format'] not in IMAGE_CONTENT_TYPES:
+                    raise ValueError(f"不支持的格式: {params['format']}")
+                profile = replace(profile, format=params['format'])
+            if params.get('quality'):
+                profile = replace(profile, quality=int(params['quality']))
+            timeout = self.timeout if params.get('timeout') in (None, "") else int(params['timeout'])
+        except (TypeError, ValueError) as e:
+            raise HttpError(400, str(e))
+        if timeout <= 0:
+            raise HttpError(400, "timeout 必须是正整数（毫秒）")
+        timeout = min(timeout, self.MAX_TIMEOUT)
+        if Image is None and self.settings.encoder.needs_pillow(profile.format):
+            raise HttpError(400, "服务端未安装Pillow，无法输出该格式")
+
+        output_path = None
+        if params.get('output'):
+            # 只允许写到输出根目录之内
+            output_path = os.path.abspath(os.path.join(self.output_root, str(params['output'])))
+            if os.path.commonpath([output_path, self.output_root]) != self.output_root:
+                raise HttpError(400, "output 必须位于服务的输出目录之内")
+        return url, replace(self.settings, profiles=[profile]), output_path, timeout
+
+    async def submit(self, request, reader):
+        """把任务放入队列并等待结果；队列已满时立即返回429。
+        等待期间客户端断开连接时取消任务：还在排队的任务不再截图"""
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((request, future))
+        except asyncio.QueueFull:
+            self.counts['rejected'] += 1
+            raise HttpError(429, "队列已满，请稍后重试")
+        self.counts['accepted'] += 1
+        watcher = asyncio.create_task(self.wait_disconnected(reader))
+        try:
+            await asyncio.wait({future, watcher}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            watcher.cancel()
+        if not future.done():
+            future.cancel()
+            self.counts['abandoned'] += 1
+            raise ConnectionResetError("客户端已断开连接")
+        return future.result()
+
+    @staticmethod
+    async def wait_disconnected(reader):
+        """读到连接结束（EOF）或连接出错时返回；请求之后多发的数据直接丢弃"""
+        try:
+            while await reader.read(4096):
+                pass
+        except ConnectionError:
+            pass
+
+    async def _worker(self):
+        while True:
+            (url, settings, output_path, timeout), future = await self.queue.get()
+            try:
+                # 客户端已断开（future 已被取消）的任务直接跳过
+                if future.done():
+                    continue
+                self.in_flight += 1
+                try:
+                    result = await take_screenshot(url, output_path, timeout, pool=self.pool, settings=settings)
+                finally:
+                    self.in_flight -= 1
+                self.counts['succeeded' if result else 'failed'] += 1
+                self.durations.append(result.duration)
+                self.stage_totals.update(result.stages)
+                if not future.done():
+                    future.set_result(result)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                self.queue.task_done()
+
+    async def capture(self, params, reader, writer):
+        url, settings, output_path, timeout = self.build_request(params)
+        if output_path:
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            result = await self.submit((url, settings, output_path, timeout), reader)
+            await self.send_json(writer, 200 if result else 502, self.result_json(url, result))
+            return
+
+        # 不指定输出路径时截到临时目录，读回后直接返回图片
+        with tempfile.TemporaryDirectory(prefix="screenshot-") as tmp_dir:
+            result = await self.submit((url, settings, os.path.join(tmp_dir, "capture.png"), timeout), reader)
+            if not result:
+                await self.send_json(writer, 502, self.result_json(url, result))
+                return
+            path = result.files[0][0]
+            profile = settings.profiles[0]
+            headers = {
+                'Content-Type': IMAGE_CONTENT_TYPES[profile.format],
+                'X-Capture-Duration': f"{result.duration:.3f}",
+                'X-Capture-Page-Height': str(result.page_height),
+            }
+            await self.send_file(writer, path, headers)
+
+    def result_json(self, url, result):
+        return {
+            'url': url,
+            'ok': result.ok,
+            'failure': result.failure or None,
+            'error': result.error or None,
+            'files': [{'path': path, 'bytes': size} for path, size in result.files],
+            'duration': round(result.duration, 3),
+            'stages': result.stages,
+            'page_height': result.page_height,
+        }
+
+    def stats(self):
+        durations = list(self.durations)
+        return {
+            'uptime': round(time.time() - self.started, 1),
+            'queue': {'depth': self.queue.qsize(), 'capacity': self.queue.maxsize},
+            'in_flight': self.in_flight,
+            'concurrency': self.concurrency,
+            'requests': dict(self.counts),
+            'duration': {f"p{q}": round(percentile(durations, q), 3) for q in METRIC_QUANTILES},
+            'stage_seconds': {stage: round(seconds, 3) for stage, seconds in self.stage_totals.items()},
+            'browser_launches': self.pool.launches,
+        }
+
+    # --- HTTP ---
+
+    async def _handle(self, reader, writer):
+        try:
+            method, target, headers = await self.read_head(reader)
+            parsed = urlparse(target)
+            if parsed.path == "/healthz":
+                await self.send_json(writer, 200, {'status': "ok", 'browser_launches': self.pool.launches})
+            elif parsed.path == "/stats":
+                await self.send_json(writer, 200, self.stats())
+            elif parsed.path == "/capture":
+                if method == "GET":
+                    params = {key: values[-1] for key, values in parse_qs(parsed.query).items()}
+                elif method == "POST":
+                    params = await self.read_json(reader, headers)
+                else:
+                    raise HttpError(405, "只支持 GET 和 POST")
+                await self.capture(params, reader, writer)
+            else:
+                raise HttpError(404, "未知路径")
+        except HttpError as e:
+            await self.send_json(writer, e.status, {'error': str(e)},
+                                 {'Retry-After': "5"} if e.status == 429 else None)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            print(f"处理请求时出错: {e}")
+            try:
+                await self.send_json(writer, 500, {'error': str(e)})
+            except Exception:
+                pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    async def read_head(self, reader):
+        request_line = (await reader.readline()).decode("latin-1").strip()
+        parts = request_line.split()
+        if len(parts) != 3:
+            raise HttpError(400, "无效的请求行")
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1")
+            if line in ("\r\n", "\n", ""):
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+            if len(headers) > 100:
+                raise HttpError(400, "请求头过多")
+        return parts[0].upper(), parts[1], headers
+
+    async def read_json(self, reader, headers):
+        length = int(headers.get('content-length') or 0)
+        if length > self.MAX_BODY:
+            raise HttpError(413, "请求体过大")
+        try:
+            params = json.loads(await reader.readexactly(length) or b"{}")
+        except ValueError:
+            raise HttpError(400, "请求体不是有效的JSON")
+        if not isinstance(params, dict):
+            raise HttpError(400, "请求体必须是JSON对象")
+        return params
+
+    def send_head(self, writer, status, headers):
+        lines = [f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}"]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        lines.append("Connection: close")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+
+    async def send_json(self, writer, status, payload, extra_headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        headers = {'Content-Type': "application/json; charset=utf-8", 'Content-Length': str(len(body))}
+        headers.update(extra_headers or {})
+        self.send_head(writer, status, headers)
+        writer.write(body)
+        await writer.drain()
+
+    async def send_file(self, writer, path, headers):
+        """分块发送文件，每块之后等待发送缓冲区排空，大图不会整块留在内存里"""
+        headers['Content-Length'] = str(os.path.getsize(path))
+        self.send_head(writer, 200, headers)
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(256 * 1024), b""):
+                writer.write(chunk)
+                await writer.drain()
+
+async def serve(args, pool, settings):
+    """以HTTP服务方式常驻运行，直到被中断"""
+    service = ScreenshotService(pool, settings, args.outdir, concurrency=args.concurrency,
+                                queue_size=args.queue_size)
+    # 提前启动浏览器并准备预热上下文，第一个请求不必等待Chromium启动
+    await pool.warm_up(**settings.profiles[0].context_options())
+    server = await service.start(args.host, args.port)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.close()
+
+async def main():
+    # 解析命令行参数
+    parser = argparse.ArgumentParser(description="增强版网页截图工具，支持从CSV批量截图或单个URL截图。")
+    parser.add_argument("--url", type=str, help="需要单独截图的URL。")
+    parser.add_argument("--output", type=str, help="单个URL截图的输出文件名（可选，可包含路径）。")
+    parser.add_argument("--csv", "--input", dest="csv", type=str, default="case_urls.csv",
+                        help="CSV或JSONL任务文件路径，'-' 表示从标准输入读取（可选，默认为case_urls.csv）")
+    parser.add_argument("--input-format", choices=["auto", "csv", "jsonl"], default="auto",
+                        help="输入格式（默认auto：按扩展名判断，标准输入看第一行）")
+    parser.add_argument("--outdir", type=str, default="enhanced_screenshots", help="输出目录名（可选，默认为enhanced_screenshots）")
+    parser.add_argument("--manifest", type=str, help=f"任务清单SQLite文件路径（默认为输出目录下的{MANIFEST_NAME}）")
+    parser.add_argument("--history", type=str, default=".capture_history.sqlite3",
+                        help="跨运行记录每个URL截图耗时的文件，用于按耗时排序和自适应超时（默认.capture_history.sqlite3）")
+    parser.add_argument("--no-history", action="store_true", help="不记录也不使用历史耗时，按输入顺序处理")
+    parser.add_argument("--no-adaptive-timeout", action="store_true", help="不按历史导航耗时调整超时，始终使用默认的90秒")
+    parser.add_argument("--timeout-margin", type=int, default=15000, help="自适应超时在历史导航耗时p99之上增加的余量，毫秒（默认15000）")
+    parser.add_argument("--verify-files", action="store_true", help="续跑前校验已完成任务的输出文件是否存在，缺失的重新截图")
+    parser.add_argument("--max-retries", type=int, help="每种失败类型的最大重试次数（默认按类型: "
+                        + ", ".join(f"{kind}={count}" for kind, count in RETRY_BUDGETS.items()) + "）")
+    parser.add_argument("--retry-delay", type=float, default=5.0, help="重试退避的基础等待秒数，每次翻倍（默认5）")
+    parser.add_argument("--headed", action="store_true", help="使用有头模式启动浏览器（默认无头模式）")
+    parser.add_argument("--recycle-after", type=int, default=50, help="每个浏览器实例分发多少个页面后重启（默认50）")
+    parser.add_argument("--concurrency", type=int, default=1, help="CSV模式下同时截图的URL数量（默认1）")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="CSV模式下的工作进程数，每个进程有自己的事件循环和浏览器池，--concurrency 为每个进程的并发数（默认1）")
+    parser.add_argument("--per-host", type=int, default=2, help="同一主机同时截图的URL数量上限（默认2，0表示不限制）")
+    parser.add_argument("--settle-budget", type=int, default=15000, help="每次等待页面稳定的最长时间，毫秒（默认15000）")
+    parser.add_argument("--settle-quiet", type=int, default=500, help="网络/DOM/布局需要保持不变的时长，毫秒（默认500）")
+    parser.add_argument("--session-cache", type=str, default=".session_cache", help="登录会话缓存目录（默认.session_cache）")
+    parser.add_argument("--session-ttl", type=float, default=12, help="登录会话缓存有效期，小时（默认12）")
+    parser.add_argument("--no-session-cache", action="store_true", help="不使用登录会话缓存，每次都重新登录")
+    parser.add_argument("--clear-sessions", action="store_true", help="启动时清空登录会话缓存")
+    parser.add_argument("--profiles", type=str, default="desktop",
+                        help="逗号分隔的截图规格（默认desktop）。内置: desktop, fold, tablet, mobile；"
+                             "自定义: 名称=宽x高[@像素比][:viewport][:mobile][:jpeg]")
+    parser.add_argument("--format", choices=["png", "jpeg", "webp"], help="覆盖所有截图规格的输出格式")
+    parser.add_argument("--quality", type=int, help="jpeg/webp的压缩质量（1-100，默认85）")
+    parser.add_argument("--thumbnail", type=int, default=0, help="同时生成指定宽度的缩略图 <文件名>.thumb.<扩展名>（默认不生成）")
+    parser.add_argument("--png-optimize", action="store_true", help="对PNG输出做无损重新压缩")
+    parser.add_argument("--block-domains", type=str, help="额外拦截的域名，逗号分隔（包含子域名）")
+    parser.add_argument("--block-types", type=str, help="拦截的资源类型，逗号分隔，如 media,font")
+    parser.add_argument("--block-patterns", type=str, help="拦截的URL通配符模式，逗号分隔，如 */ads/*")
+    parser.add_argument("--blocklist", type=str, help="拦截规则文件，每行 domain:/type:/pattern:/ignore: 开头的一条规则")
+    parser.add_argument("--no-default-blocklist", action="store_true", help="不使用内置的统计分析/广告/客服域名拦截列表")
+    parser.add_argument("--no-block", action="store_true", help="完全关闭请求拦截")
+    archive_group = parser.add_mutually_exclusive_group()
+    archive_group.add_argument("--record", type=str, metavar="DIR", help="把每个URL的全部网络响应录制到该目录")
+    archive_group.add_argument("--replay", type=str, metavar="DIR", help="完全从该目录下录制的网络存档回放页面，不访问网络")
+    parser.add_argument("--tiled", choices=["auto", "always", "never"], default="auto",
+                        help="分块截图模式（默认auto：页面高于--tile-threshold时分块）")
+    parser.add_argument("--tile-height", type=int, default=4096, help="分块截图每块的高度，CSS像素（默认4096）")
+    parser.add_argument("--tile-threshold", type=int, default=16384, help="auto模式下启用分块截图的页面高度（默认16384）")
+    parser.add_argument("--popup-rules", type=str, default=".popup_rules.json", help="按域名记住关闭弹窗规则的缓存文件（默认.popup_rules.json）")
+    parser.add_argument("--no-popup-rules", action="store_true", help="不记住关闭弹窗的规则")
+    parser.add_argument("--suppress", action="store_true",
+                        help="在首次绘制前隐藏常见Cookie同意平台的弹窗（内置规则，默认关闭：隐藏后截图中看不到同意横幅）")
+    parser.add_argument("--suppress-rules", type=str,
+                        help="按域名在首次绘制前隐藏弹窗的规则文件（JSON，见 PopupSuppressor）；只使用文件中的规则，加 --suppress 时同时使用内置规则")
+    parser.add_argument("--scroll-budget", type=int, default=20000, help="滚动加载懒加载内容的最长时间，毫秒（默认20000）")
+    parser.add_argument("--scroll-max-distance", type=int, default=60000, help="滚动加载的最大滚动距离，像素（默认60000）")
+    parser.add_argument("--memory-watchdog", action="store_true",
+                        help="截图期间采样页面JS堆和浏览器进程内存，超出预算时降级或回收浏览器，峰值写入耗时明细")
+    parser.add_argument("--page-heap-budget", type=int, default=1024, help="单个页面的JS堆预算，MB；超出后只截取视口（默认1024）")
+    parser.add_argument("--browser-rss-limit", type=int, default=4096, help="浏览器所有进程的内存上限，MB；超出后回收浏览器（默认4096）")
+    parser.add_argument("--virtual-time", action="store_true",
+                        help="用CDP虚拟时间快进页面定时器和动画，代替关闭CSS动画；每次等待稳定前快进--virtual-time-budget")
+    parser.add_argument("--virtual-time-budget", type=int, default=5000, help="虚拟时间模式下每次快进的页面时间，毫秒（默认5000）")
+    parser.add_argument("--virtual-time-wall", type=int, default=2000,
+                        help="虚拟时间模式下每次快进最多等待的实际时间，毫秒，计入--settle-budget（默认2000）")
+    parser.add_argument("--animation-rate", type=float, default=100, help="虚拟时间模式下CSS动画和过渡的播放倍速（默认100）")
+    parser.add_argument("--max-page-height", type=int, default=0, help="整页截图的最大高度，超出部分截断（默认0不限制）")
+    parser.add_argument("--metrics", type=str, help="每个URL的阶段耗时明细（JSONL）写入路径（CSV模式默认为输出目录下的metrics.jsonl）")
+    parser.add_argument("--network-profile", action="store_true",
+                        help="记录每个页面的所有请求，在截图旁写出 <文件名>.network.json，并按主机累计到 --network-report")
+    parser.add_argument("--network-top", type=int, default=10, help="每个页面汇总中列出的最慢/最大请求数（默认10）")
+    parser.add_argument("--network-report", type=str,
+                        help="按主机的跨运行请求汇总文件（默认为输出目录下的network_hosts.json）")
+    parser.add_argument("--prometheus", type=str, help="运行结束时把耗时汇总以Prometheus文本格式写入该文件")
+    parser.add_argument("--queue", type=str, metavar="PATH",
+                        help="多机共享的任务队列（共享文件系统上的SQLite文件）；配合--enqueue写入任务，否则作为工作节点领取任务")
+    parser.add_argument("--enqueue", action="store_true", help="把--csv输入的任务加入--queue后退出（输出路径按--outdir生成，需为各节点共享的路径）")
+    parser.add_argument("--queue-status", action="store_true", help="打印--queue中各状态的任务数后退出")
+    parser.add_argument("--lease-seconds", type=float, default=120, help="任务租约时长，秒；每1/3时长续约一次（默认120）")
+    parser.add_argument("--max-lease-expirations", type=int, default=3, help="任务租约过期超过该次数后记为失败（默认3）")
+    parser.add_argument("--serve", action="store_true", help="以HTTP服务方式常驻运行（见 ScreenshotService），--concurrency 为并发截图数")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="服务监听地址（默认127.0.0.1）")
+    parser.add_argument("--port", type=int, default=8765, help="服务监听端口（默认8765）")
+    parser.add_argument("--queue-size", type=int, default=16, help="服务排队任务上限，超出时返回429（默认16）")
+    parser.add_argument("--warm-contexts", type=int, default=2, help="服务模式下预先创建的空白浏览器上下文数量（默认2）")
+    parser.add_argument("--encode-workers", type=int, default=min(4, os.cpu_count() or 1), help="图片编码进程数（默认为CPU核数，最多4）")
+    
+    args = parser.parse_args()
+
+    settings = build_settings(args)
+    try:
+        if (args.processes > 1 and not (args.serve or args.url or args.queue)) or args.enqueue or args.queue_status:
+            # 多进程模式下协调进程不启动浏览器，每个工作进程有自己的浏览器池；写入和查看队列也不需要浏览器
+            await run(args, None, settings)
+            return
+        # 整个运行期间共享一个浏览器池
+        async with BrowserPool(headless=not args.headed, max_pages_per_browser=args.recycle_after,
+                               spare_contexts=args.warm_contexts if args.serve else 0) as pool:
+            await run(args, pool, settings)
+    finally:
+        settings.encoder.close()
+
+def build_settings(args):
+    """根据命令行参数构建截图配置"""
+    session_cache = None
+    if not args.no_session_cache:
+        session_cache = SessionCache(args.session_cache, ttl_seconds=args.session_ttl * 3600)
+        if args.clear_sessions:
+            session_cache.clear()
+            print("已清空登录会话缓存")
+
+    profiles = []
+    for spec in args.profiles.split(","):
+        if not spec.strip():
+            continue
+        profile = parse_profile(spec)
+        # 命令行指定的格式和质量覆盖所有规格
+        if args.format:
+            profile = replace(profile, format=args.format)
+        if args.quality:
+            profile = replace(profile, quality=args.quality)
+        profiles.append(profile)
+
+    encoder = ImageEncoder(workers=args.encode_workers, thumbnail_width=args.thumbnail,
+                           png_optimize=args.png_optimize)
+    if Image is None and any(encoder.needs_pillow(profile.format) for profile in profiles):
+        raise SystemExit("WebP输出、PNG压缩和缩略图需要安装Pillow: pip install Pillow")
+
+    return CaptureSettings(
+        settle_budget_ms=args.settle_budget,
+        settle_quiet_ms=args.settle_quiet,
+        session_cache=session_cache,
+        profiles=profiles,
+        encoder=encoder,
+        request_filter=build_request_filter(args),
+        network_archive=NetworkArchive(args.record or args.replay, "record" if args.record else "replay")
+        if (args.record or args.replay) else None,
+        tiled=args.tiled,
+        tile_height=args.tile_height,
+        tile_threshold=args.tile_threshold,
+        max_page_height=args.max_page_height,
+        scroll_budget_ms=args.scroll_budget,
+        scroll_max_distance=args.scroll_max_distance,
+        popup_rules=None if args.no_popup_rules else PopupRuleCache(args.popup_rules),
+        popup_suppressor=(PopupSuppressor.from_file(args.suppress_rules, use_defaults=args.suppress)
+                          if args.suppress or args.suppress_rules else None),
+        memory_watchdog=MemoryWatchdog(args.page_heap_budget, args.browser_rss_limit) if args.memory_watchdog else None,
+        network_profile_top=max(1, args.network_top) if args.network_profile else 0,
+        virtual_time_budget_ms=args.virtual_time_budget if args.virtual_time else 0,
+        virtual_time_wall_ms=args.virtual_time_wall,
+        animation_playback_rate=args.animation_rate,
+    )
+
+def split_list(value):
+    """把逗号分隔的命令行参数拆成列表"""
+    return [item.strip() for item in (value or "").split(",") if item.strip()]
+
+def build_request_filter(args):
+    """根据命令行参数构建请求过滤规则，--no-block 时返回None"""
+    if args.no_block:
+        return None
+    return RequestFilter.from_options(
+        use_defaults=not args.no_default_blocklist,
+        domains=split_list(args.block_domains),
+        resource_types=split_list(args.block_types),
+        patterns=split_list(args.block_patterns),
+        blocklist_file=args.blocklist,
+    )
+
+def build_retry_policy(args):
+    """根据命令行参数构建重试策略"""
+    budgets = None
+    if args.max_retries is not None:
+        budgets = {kind: args.max_retries for kind in RETRY_BUDGETS}
+    return RetryPolicy(budgets, base_delay=args.retry_delay)
+
+async def run(args, pool, settings):
+    """根据命令行参数执行单个URL截图、CSV批量截图或常驻服务"""
+    if args.serve:
+        await serve(args, pool, settings)
+        return
+
+    if args.url:
+        # 单个URL截图模式
+        single_url = args.url
+        output_file_path = args.output
         
-        print("\n开始处理待完成的截图任务...\n")
-    except Exception as e:
-        print(f"预检查任务状态时出错: {e}")
+        if not output_file_path:
+            # 如果未指定输出路径，创建默认路径和文件名
+            domain = urlparse(single_url).netloc.replace(".", "_")
+            # 移除非法字符并截断
+            safe_domain = re.sub(r'[\\/*?:"<>|]', '', domain)[:50]
+            filename = f"enhanced_{safe_domain}_{time.strftime('%Y%m%d_%H%M%S')}.png"
+            output_dir_single = "enhanced_single"
+            os.makedirs(output_dir_single, exist_ok=True)
+            output_file_path = os.path.join(output_dir_single, filename)
+        else:
+            # 如果指定了输出路径，确保目录存在
+            output_dir_single = os.path.dirname(output_file_path)
+            if output_dir_single:
+                 os.makedirs(output_dir_single, exist_ok=True)
+
+        print(f"开始为单个URL截图: {single_url}")
+        print(f"截图将保存至: {', '.join(job_output_paths(output_file_path, settings.profiles))}")
+        
+        retry_policy = build_retry_policy(args)
+        job = CaptureJob("", "", single_url, output_file_path)
+        while True:
+            success = await take_screenshot(single_url, output_file_path, pool=pool, settings=settings)
+            delay = None if success else retry_policy.next_delay(job, success.failure or 'other')
+            if delay is None:
+                break
+            print(f"{FAILURE_LABELS.get(success.failure, success.failure)}，{delay:.1f} 秒后重试")
+            await asyncio.sleep(delay)
+        print("阶段耗时（秒）: " + ", ".join(f"{stage} {seconds:.2f}" for stage, seconds in success.stages.items()))
+        if success.memory:
+            print("内存峰值: " + ", ".join(f"{key} {value}" for key, value in success.memory.items()))
+        if args.metrics or args.prometheus or args.network_profile:
+            network_path = args.network_report or os.path.join(output_dir_single or ".", "network_hosts.json")
+            metrics = RunMetrics(args.metrics or os.path.splitext(output_file_path)[0] + ".metrics.jsonl",
+                                 args.prometheus, network_path if args.network_profile else None)
+            metrics.record(job, success)
+            metrics.close()
+        if success:
+            # 各规格的文件名由 profile_output_path 决定，以实际写出的文件为准
+            print(f"单个URL截图成功: {', '.join(path for path, _ in success.files)}")
+        else:
+            print(f"单个URL截图失败: {single_url}")
+        return
+
+    if args.queue:
+        await run_queue(args, pool, settings)
+        return
+
+    # 批量CSV处理模式
+    csv_path = args.csv
+    output_dir = args.outdir 
     
-    # 处理CSV
-    await process_csv(csv_path, output_dir)
+    # 处理CSV，每个URL的阶段耗时追加到明细文件
+    metrics = RunMetrics(args.metrics or os.path.join(output_dir, "metrics.jsonl"), args.prometheus,
+                         (args.network_report or os.path.join(output_dir, "network_hosts.json"))
+                         if args.network_profile else None)
+    history = None if args.no_history else DurationHistory(args.history, timeout_margin_ms=args.timeout_margin)
+    try:
+        await process_csv(csv_path, output_dir, pool=pool, concurrency=args.concurrency,
+                          per_host_limit=args.per_host, settings=settings,
+                          manifest_path=args.manifest, verify_files=args.verify_files,
+                          retry_policy=build_retry_policy(args), metrics=metrics, input_format=args.input_format,
+                          processes=args.processes, worker_args=args, history=history,
+                          adaptive_timeout=not args.no_adaptive_timeout)
+    finally:
+        metrics.close()
+        if history is not None:
+            history.close()
     
     print("增强截图下载完成！")
 
+async def run_queue(args, pool, settings):
+    """共享队列模式：写入任务、查看状态，或作为工作节点领取任务"""
+    job_queue = JobQueue(args.queue, lease_seconds=args.lease_seconds, max_expirations=args.max_lease_expirations)
+    try:
+        if args.enqueue:
+            try:
+                added = job_queue.enqueue(iter_input_jobs(iter_input_rows(args.csv, args.input_format), args.outdir))
+            except (OSError, ValueError, csv.Error) as e:
+                print(f"读取输入文件时发生错误: {e}")
+                return
+            print(f"已加入 {added} 个新任务")
+        elif not args.queue_status:
+            # 每个节点写自己的耗时明细，避免多台机器追加同一个文件
+            node = re.sub(r'[^\w.-]', '_', job_queue.owner)
+            metrics = RunMetrics(args.metrics or os.path.join(args.outdir, f"metrics.{node}.jsonl"), args.prometheus,
+                                 (args.network_report or os.path.join(args.outdir, f"network_hosts.{node}.json"))
+                                 if args.network_profile else None)
+            try:
+                report = await run_queue_worker(job_queue, pool, args.concurrency, args.per_host, settings,
+                                                retry_policy=build_retry_policy(args), metrics=metrics)
+            finally:
+                metrics.close()
+            print(f"\n本节点完成: 成功 {len(report.succeeded)}，失败 {len(report.failed)}")
+            report.print_failure_summary()
+        counts = job_queue.counts()
+        print("队列状态: " + ", ".join(f"{status} {counts.get(status, 0)}"
+                                       for status in ('pending', 'leased', 'done', 'failed')))
+    finally:
+        job_queue.close()
+
 if __name__ == "__main__":
     # 运行主异步函数
     asyncio.run(main()) 
\ No newline at end of file
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""截图脚本和对比工具共用的PNG与文件写入工具，只依赖标准库"""
+
+import os
+import struct
+import zlib
+
+
+def write_file_atomic(path, data):
+    """先写入临时文件再重命名，避免中断时留下不完整的图片"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+def _png_chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+def _read_png(data):
+    """解析PNG，返回 (IHDR字段, 解压后的扫描线数据)"""
+    if data[:8] != PNG_SIGNATURE:
+        raise ValueError("不是PNG数据")
+    pos = 8
+    header = None
+    idat = []
+    while pos < len(data):
+        length, kind = struct.unpack(">I4s", data[pos:pos + 8])
+        body = data[pos + 8:pos + 8 + length]
+        if kind == b'IHDR':
+            header = struct.unpack(">IIBBBBB", body)
+        elif kind == b'IDAT':
+            idat.append(body)
+        elif kind == b'IEND':
+            break
+        pos += length + 12
+    return header, zlib.decompress(b"".join(idat))
+
+def _unfilter_first_row(row, bpp):
+    """把分块第一行还原为未过滤数据（上一行视为全0），并改写为 None 过滤。
+    拼接后该行的"上一行"变成了前一块的最后一行，Up/Average/Paeth 过滤必须先还原"""
+    filter_type, data = row[0], bytearray(row[1:])
+    if filter_type in (1, 4):  # Sub；上一行为0时 Paeth 等价于 Sub
+        for i in range(bpp, len(data)):
+            data[i] = (data[i] + data[i - bpp]) & 0xff
+    elif filter_type == 3:  # Average
+        for i in range(bpp, len(data)):
+            data[i] = (data[i] + (data[i - bpp] >> 1)) & 0xff
+    # None 和 Up（上一行为0）不需要处理
+    return b"\x00" + bytes(data)
+
+class TiledPngWriter:
+    """把多张等宽的PNG分块按顺序流式拼接成一张PNG写入磁盘，内存中只保留当前分块。
+    只依赖zlib：分块的扫描线直接重新压缩，只需修正每块的第一行"""
+
+    CHANNELS = {0: 1, 2: 3, 4: 2, 6: 4}  # PNG颜色类型 -> 通道数
+
+    def __init__(self, path, compress_level=6):
+        self.path = path
+        self._tmp_path = f"{path}.{os.getpid()}.tmp"
+        self._file = open(self._tmp_path, "wb")
+        self._compressor = zlib.compressobj(compress_level)
+        self._header = None
+        self.height = 0
+
+    def append(self, png_data):
+        """追加一个分块"""
+        header, raw = _read_png(png_data)
+        width, height, bit_depth, color_type, _, _, interlace = header
+        if bit_depth != 8 or interlace or color_type not in self.CHANNELS:
+            raise ValueError(f"不支持的PNG分块格式: {header}")
+        if self._header is None:
+            self._header = header
+            # 先写入占位的IHDR，总高度在结束时回填
+            self._file.write(PNG_SIGNATURE + _png_chunk(b'IHDR', struct.pack(">IIBBBBB", *header)))
+        elif (width, bit_depth, color_type) != (self._header[0], self._header[2], self._header[3]):
+            raise ValueError("PNG分块的宽度或颜色格式不一致")
+
+        bpp = self.CHANNELS[color_type]
+        stride = width * bpp + 1
+        first_row = _unfilter_first_row(raw[:stride], bpp)
+        compressed = self._compressor.compress(first_row) + self._compressor.compress(raw[stride:])
+        if compressed:
+            self._file.write(_png_chunk(b'IDAT', compressed))
+        self.height += height
+
+    def close(self):
+        """写入结尾、回填总高度并原子替换目标文件，返回文件大小"""
+        if self._header is None:
+            self._file.close()
+            os.remove(self._tmp_path)
+            raise ValueError("没有任何分块")
+        self._file.write(_png_chunk(b'IDAT', self._compressor.flush()) + _png_chunk(b'IEND', b''))
+        header = list(self._header)
+        header[1] = self.height
+        self._file.seek(len(PNG_SIGNATURE))
+        self._file.write(_png_chunk(b'IHDR', struct.pack(">IIBBBBB", *header)))
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+        return os.path.getsize(self.path)
+
+    def abort(self):
+        """出错时删除临时文件"""
+        self._file.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)